@@ -29,9 +29,10 @@ class TargetBalancingAnalyser(Analyser):
      described as adaptive station weighting in Heimann (2011).
      """
 
-    def __init__(self, niter):
+    def __init__(self, niter, nbatch=10):
         Analyser.__init__(self)
         self.niter = niter
+        self.nbatch = nbatch
 
     def log_progress(self, problem, iiter, niter):
         t = time.time()
@@ -72,29 +73,34 @@ class TargetBalancingAnalyser(Analyser):
         isbad_mask = None
 
         self._tlog_last = 0
-        for iiter in range(self.niter):
+        for iiter in range(0, self.niter, self.nbatch):
             self.log_progress(problem, iiter, self.niter)
-            while True:
-                x = []
-                for ipar in range(npar):
-                    v = rstate.uniform(xbounds[ipar, 0], xbounds[ipar, 1])
-                    x.append(v)
-
-                try:
-                    x = wproblem.preconstrain(x)
-                    break
-
-                except Forbidden:
-                    pass
+            nbatch = min(self.nbatch, self.niter - iiter)
+            xs = num.zeros((nbatch, npar))
+            for ibatch in range(nbatch):
+                while True:
+                    x = []
+                    for ipar in range(npar):
+                        v = rstate.uniform(
+                            xbounds[ipar, 0], xbounds[ipar, 1])
+                        x.append(v)
+
+                    try:
+                        xs[ibatch, :] = wproblem.preconstrain(x)
+                        break
+
+                    except Forbidden:
+                        pass
 
             if isbad_mask is not None and num.any(isbad_mask):
                 isok_mask = num.logical_not(isbad_mask)
             else:
                 isok_mask = None
-            ms = wproblem.misfits(x, mask=isok_mask)[:, 1]
-            mss[iiter, :] = ms
 
-            isbad_mask = num.isnan(ms)
+            mss[iiter:iiter+nbatch, :] = wproblem.misfits_many(
+                xs, mask=isok_mask)[:, :, 1]
+
+            isbad_mask = num.isnan(mss[iiter+nbatch-1, :])
 
         mean_ms = num.mean(mss, axis=0)
         weights = 1. / mean_ms
@@ -119,9 +125,13 @@ class TargetBalancingAnalyserConfig(AnalyserConfig):
     niterations = Int.T(default=1000,
                         help='Number of random forward models for mean \
                              phase amplitude estimation')
+    nbatch = Int.T(default=10,
+                   help='Number of random forward models computed together \
+                        in one call to the modelling engine')
 
     def get_analyser(self):
-        return TargetBalancingAnalyser(niter=self.niterations)
+        return TargetBalancingAnalyser(
+            niter=self.niterations, nbatch=self.nbatch)
 
 
 __all__ = '''
@@ -588,6 +588,17 @@ def command_go(args):
             '--parallel', dest='nparallel', type=int, default=1,
             help='set number of events to process in parallel, '
                  'If set to more than one, --status=quiet is implied.')
+        parser.add_option(
+            '--workers', dest='nworkers', type=int, default=1,
+            help='set number of worker processes computing forward models '
+                 'for a single event in parallel. Cannot be combined with '
+                 '--parallel.')
+        parser.add_option(
+            '--resume', dest='resume', action='store_true',
+            help='continue an interrupted optimisation in an existing run '
+                 'directory, from its last checkpoint. The continued run only '
+                 'repeats the course of an uninterrupted one with '
+                 '--workers=1.')
 
     parser, options, args = cl_parse('go', args, setup)
 
@@ -603,7 +614,9 @@ def command_go(args):
             force=options.force,
             preserve=options.preserve,
             status=status,
-            nparallel=options.nparallel)
+            nparallel=options.nparallel,
+            nworkers=options.nworkers,
+            resume=options.resume)
         if len(env.get_selected_event_names()) == 1:
             logger.info(CLIHints(
                 'go', rundir=env.get_rundir_path()))
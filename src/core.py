@@ -16,7 +16,7 @@ from pyrocko import parimap, model, marker as pmarker
 
 from .dataset import NotFound
 from .problems.base import Problem, load_problem_info_and_data, \
-    load_problem_data, load_optimiser_info
+    load_problem_data, load_optimiser_info, load_problem_info
 
 from .optimisers.base import BadProblem
 from .targets.waveform.target import WaveformMisfitResult
@@ -196,10 +196,10 @@ def harvest(rundir, problem=None, nbest=10, force=False, weed=0):
 
     if problem is None:
         problem, xs, misfits, bootstrap_misfits = \
-            load_problem_info_and_data(rundir, nchains=nchains)
+            load_problem_info_and_data(rundir, nchains=nchains, memmap=True)
     else:
         xs, misfits, bootstrap_misfits = \
-            load_problem_data(rundir, problem, nchains=nchains)
+            load_problem_data(rundir, problem, nchains=nchains, memmap=True)
 
     logger.info('harvesting problem %s...' % problem.name)
 
@@ -476,10 +476,15 @@ g_state = {}
 
 def go(environment,
        force=False, preserve=False,
-       nparallel=1, status='state'):
+       nparallel=1, status='state', nworkers=1, resume=False):
+
+    if nparallel > 1 and nworkers > 1:
+        raise GrondError(
+            'parallel processing of events cannot be combined with parallel '
+            'forward modelling within the events')
 
     g_data = (environment, force, preserve,
-              status, nparallel)
+              status, nparallel, nworkers, resume)
     g_state[id(g_data)] = g_data
 
     nevents = environment.nevents_selected
@@ -494,7 +499,7 @@ def go(environment,
 
 def process_event(ievent, g_data_id):
 
-    environment, force, preserve, status, nparallel = \
+    environment, force, preserve, status, nparallel, nworkers, resume = \
         g_state[g_data_id]
 
     config = environment.get_config()
@@ -517,8 +522,19 @@ def process_event(ievent, g_data_id):
         dict(problem_name=problem.name))
     environment.set_rundir_path(rundir)
 
+    resuming = False
     if op.exists(rundir):
-        if preserve:
+        if resume:
+            if not all(op.exists(op.join(rundir, fn))
+                       for fn in ('problem.yaml', 'optimiser.yaml')):
+
+                logger.warning(
+                    'skipping problem %s: cannot resume, rundir is '
+                    'incomplete: %s' % (problem.name, rundir))
+                return
+
+            resuming = True
+        elif preserve:
             nold_rundirs = len(glob.glob(rundir + '*'))
             shutil.move(rundir, rundir+'-old-%d' % (nold_rundirs))
         elif force:
@@ -535,20 +551,31 @@ def process_event(ievent, g_data_id):
 
     logger.info('rundir: %s' % rundir)
 
-    logger.info('analysing problem %s' % problem.name)
+    if resuming:
+        # analyser results and bootstrap weights are restored from the
+        # rundir, so that the misfits of old and new models are compatible
+        problem = load_problem_info(rundir)
+        config.setup_modelling_environment(problem)
+        for target in problem.targets:
+            target.set_dataset(ds)
+
+        optimiser = load_optimiser_info(rundir)
+
+    else:
+        logger.info('analysing problem %s' % problem.name)
 
-    for analyser_conf in config.analyser_configs:
-        analyser = analyser_conf.get_analyser()
-        analyser.analyse(problem, ds)
+        for analyser_conf in config.analyser_configs:
+            analyser = analyser_conf.get_analyser()
+            analyser.analyse(problem, ds)
 
-    basepath = config.get_basepath()
-    config.change_basepath(rundir)
-    guts.dump(config, filename=op.join(rundir, 'config.yaml'))
-    config.change_basepath(basepath)
+        basepath = config.get_basepath()
+        config.change_basepath(rundir)
+        guts.dump(config, filename=op.join(rundir, 'config.yaml'))
+        config.change_basepath(basepath)
 
-    optimiser = config.optimiser_config.get_optimiser()
-    optimiser.init_bootstraps(problem)
-    problem.dump_problem_info(rundir)
+        optimiser = config.optimiser_config.get_optimiser()
+        optimiser.init_bootstraps(problem)
+        problem.dump_problem_info(rundir)
 
     monitor = None
     if status == 'state':
@@ -556,7 +583,7 @@ def process_event(ievent, g_data_id):
 
     xs_inject = None
     synt = ds.synthetic_test
-    if synt and synt.inject_solution:
+    if synt and synt.inject_solution and not resuming:
         xs_inject = synt.get_x()[num.newaxis, :]
 
     try:
@@ -569,9 +596,16 @@ def process_event(ievent, g_data_id):
             optimiser.sampler_phases[0:0] = [
                 highscore.InjectionSamplerPhase(xs_inject=xs_inject)]
 
+        if nworkers > 1:
+            logger.info(
+                'computing forward models with %i worker processes'
+                % nworkers)
+
         optimiser.optimise(
             problem,
-            rundir=rundir)
+            rundir=rundir,
+            nworkers=nworkers,
+            resume=resuming)
 
         harvest(rundir, problem, force=True)
 
@@ -711,7 +745,7 @@ def export(what, rundirs, type=None, pnames=None, filename=None):
     header = None
     for rundir in rundirs:
         problem, xs, misfits, bootstrap_misfits = load_problem_info_and_data(
-            rundir, subset='harvest')
+            rundir, subset='harvest', memmap=True)
 
         if type == 'vector':
             pnames_take = pnames_clean or \
@@ -196,7 +196,8 @@ class Environment(object):
                 ModelHistory(
                     self.get_problem(),
                     nchains=self.get_optimiser().nchains,
-                    path=meta.xjoin(self.get_rundir_path(), subset))
+                    path=meta.xjoin(self.get_rundir_path(), subset),
+                    memmap=True)
 
             self._histories[subset].ensure_bootstrap_misfits(
                 self.get_optimiser())
@@ -1,2 +1,3 @@
 from .base import *  # noqa
 from .highscore.optimiser import *  # noqa
+from .differential_evolution.optimiser import *  # noqa
@@ -1,6 +1,13 @@
 import logging
+import itertools
+import os
+import os.path as op
 
-from pyrocko.guts import Object
+import numpy as num
+
+from pyrocko import guts, parimap
+from pyrocko.guts import Object, Int, Float, StringChoice
+from pyrocko.guts_array import Array
 from grond.meta import GrondError, has_get_plot_classes
 
 guts_prefix = 'grond'
@@ -12,10 +19,171 @@ class BadProblem(GrondError):
     pass
 
 
+class BootstrapTypeChoice(StringChoice):
+    choices = ['bayesian', 'classic']
+
+
+def make_bayesian_weights(nbootstrap, nmisfits,
+                          type='bayesian', rstate=None):
+    ws = num.zeros((nbootstrap, nmisfits))
+    if rstate is None:
+        rstate = num.random.RandomState()
+
+    for ibootstrap in range(nbootstrap):
+        if type == 'classic':
+            ii = rstate.randint(0, nmisfits, size=nmisfits)
+            ws[ibootstrap, :] = num.histogram(
+                ii, nmisfits, (-0.5, nmisfits - 0.5))[0]
+        elif type == 'bayesian':
+            f = rstate.uniform(0., 1., size=nmisfits+1)
+            f[0] = 0.
+            f[-1] = 1.
+            f = num.sort(f)
+            g = f[1:] - f[:-1]
+            ws[ibootstrap, :] = g * nmisfits
+        else:
+            assert False
+    return ws
+
+
+class OptimiserCheckpoint(Object):
+    '''
+    State of an optimisation, needed to resume it after an interruption.
+
+    Holds the number of models in the rundir at the time of the checkpoint
+    and the state of the global random number generator used to draw the
+    candidate models following them.
+    '''
+
+    nmodels = Int.T(
+        help='Number of models in the rundir at the time of the checkpoint.')
+    random_state_keys = Array.T(
+        shape=(None,),
+        dtype=num.uint32,
+        serialize_as='base64')
+    random_state_pos = Int.T()
+    random_state_has_gauss = Int.T()
+    random_state_cached_gaussian = Float.T()
+
+    @classmethod
+    def capture(cls, nmodels, random_state=None, **kwargs):
+        '''
+        Create checkpoint at *nmodels* models.
+
+        :param random_state: state of the global random number generator, as
+            returned by :py:func:`numpy.random.get_state`, from before the
+            model at *nmodels* was drawn. Defaults to the current state.
+        '''
+        if random_state is None:
+            random_state = num.random.get_state()
+
+        _, keys, pos, has_gauss, cached_gaussian = random_state
+        return cls(
+            nmodels=nmodels,
+            random_state_keys=keys,
+            random_state_pos=int(pos),
+            random_state_has_gauss=int(has_gauss),
+            random_state_cached_gaussian=float(cached_gaussian),
+            **kwargs)
+
+    def restore_random_state(self):
+        num.random.set_state((
+            'MT19937',
+            self.random_state_keys.astype(num.uint32),
+            self.random_state_pos,
+            self.random_state_has_gauss,
+            self.random_state_cached_gaussian))
+
+
+def dump_checkpoint(checkpoint, rundir):
+    '''
+    Write checkpoint to rundir, replacing an existing one atomically.
+    '''
+
+    fn = op.join(rundir, 'checkpoint.yaml')
+    fn_temp = fn + '.tmp'
+    checkpoint.dump(filename=fn_temp)
+    os.rename(fn_temp, fn)
+
+
+def load_checkpoint(rundir):
+    '''
+    Read checkpoint from rundir.
+
+    :returns: :py:class:`OptimiserCheckpoint` object or ``None`` if the
+        rundir has no checkpoint.
+    '''
+
+    fn = op.join(rundir, 'checkpoint.yaml')
+    if not op.exists(fn):
+        return None
+
+    return guts.load(filename=fn)
+
+
+g_state = {}
+
+
+def init_worker(g_state_id, problem, optimiser, pid):
+    '''
+    Register problem and optimiser in a worker process.
+
+    Used as startup function of :py:func:`pyrocko.parimap.parimap`. Problem
+    and optimiser are passed as startup arguments, so that the workers get
+    them with any start method of :py:mod:`multiprocessing` (with ``spawn``,
+    they are pickled). Cached GF stores inherited from the parent process
+    *pid* by forking are closed, to not share open file handles.
+    '''
+
+    if pid != os.getpid():
+        engine = problem.get_engine()
+        if engine is not None:
+            engine.close_cashed_stores()
+
+    g_state[g_state_id] = problem, optimiser
+
+
+def evaluate_samples(task, g_state_id):
+    '''
+    Compute misfits for a batch of candidate models (used by the workers).
+
+    The problem is looked up in the global state set up by
+    :py:func:`init_worker`, so that each worker holds its own engine and
+    dataset.
+
+    The travel time cache lookups done for the batch are returned as
+    ``(nhits, nmisses)``, to be added to the statistics of the main process.
+    '''
+
+    from grond.targets.base import traveltime_cache
+
+    problem, optimiser = g_state[g_state_id]
+    iiter, xs, isok_mask, rejection = task
+    nhits, nmisses = traveltime_cache.nhits, traveltime_cache.nmisses
+    misfits = optimiser.evaluate_models(
+        problem, xs, mask=isok_mask, rejection=rejection)
+
+    return iiter, xs, misfits, traveltime_cache.take_statistics(
+        nhits, nmisses)
+
+
 @has_get_plot_classes
 class Optimiser(Object):
+    '''
+    Base class for optimisers.
 
-    def optimise(self, problem):
+    The bootstrap setup and the checks of misfit availability are shared by
+    all optimisers. Optimisers using them must provide the attributes
+    ``nbootstrap`` and ``rstate``.
+    '''
+
+    def __init__(self, **kwargs):
+        Object.__init__(self, **kwargs)
+        self._bootstrap_weights = None
+        self._bootstrap_residuals = None
+        self._isbad_mask = None
+
+    def optimise(self, problem, rundir=None, nworkers=1, resume=False):
         raise NotImplementedError
 
     @property
@@ -26,7 +194,198 @@ class Optimiser(Object):
         pass
 
     def init_bootstraps(self, problem):
-        raise NotImplementedError
+        self.init_bootstrap_weights(problem)
+        self.init_bootstrap_residuals(problem)
+
+    def init_bootstrap_weights(self, problem):
+        logger.info('Initializing Bayesian bootstrap weights')
+        bootstrap_targets = set([t for t in problem.targets
+                                 if t.can_bootstrap_weights])
+
+        ws = make_bayesian_weights(
+            self.nbootstrap,
+            nmisfits=problem.nmisfits,
+            rstate=self.rstate)
+
+        imf = 0
+        for it, t in enumerate(bootstrap_targets):
+            t.set_bootstrap_weights(ws[:, imf:imf+t.nmisfits])
+            imf += t.nmisfits
+
+        for t in set(problem.targets) - bootstrap_targets:
+            t.set_bootstrap_weights(
+                num.ones((self.nbootstrap, t.nmisfits)))
+
+    def init_bootstrap_residuals(self, problem):
+        logger.info('Initializing Bayesian bootstrap residuals')
+        residual_targets = set([t for t in problem.targets
+                                if t.can_bootstrap_residuals])
+
+        for t in residual_targets:
+            t.init_bootstrap_residuals(self.nbootstrap, rstate=self.rstate)
+
+        for t in set(problem.targets) - residual_targets:
+            t.set_bootstrap_residuals(num.zeros((self.nbootstrap, t.nmisfits)))
+
+    def get_bootstrap_weights(self, problem):
+        if self._bootstrap_weights is None:
+            try:
+                problem.targets[0].get_bootstrap_weights()
+            except Exception:
+                self.init_bootstraps(problem)
+
+            bootstrap_weights = num.hstack(
+                [t.get_bootstrap_weights()
+                 for t in problem.targets])
+
+            self._bootstrap_weights = num.vstack((
+                num.ones((1, problem.nmisfits)),
+                bootstrap_weights))
+
+        return self._bootstrap_weights
+
+    def get_bootstrap_residuals(self, problem):
+        if self._bootstrap_residuals is None:
+            try:
+                problem.targets[0].get_bootstrap_residuals()
+            except Exception:
+                self.init_bootstraps(problem)
+
+            bootstrap_residuals = num.hstack(
+                [t.get_bootstrap_residuals()
+                 for t in problem.targets])
+
+            self._bootstrap_residuals = num.vstack((
+                num.zeros((1, problem.nmisfits)),
+                bootstrap_residuals))
+
+        return self._bootstrap_residuals
+
+    @property
+    def nchains(self):
+        return self.nbootstrap + 1
+
+    def get_isok_mask(self, problem):
+        if self._isbad_mask is not None and num.any(self._isbad_mask):
+            isok_mask = num.logical_not(
+                problem.get_target_mask(self._isbad_mask))
+        else:
+            isok_mask = None
+
+        return problem.get_modelling_mask(isok_mask)
+
+    def check_misfits(self, problem, iiter, misfits):
+        isbad_mask = self._isbad_mask
+        isbad_mask_new = num.isnan(misfits[:, 0])
+        if isbad_mask is not None and num.any(
+                isbad_mask != isbad_mask_new):
+
+            errmess = [
+                'problem %s: inconsistency in data availability'
+                ' at iteration %i' %
+                (problem.name, iiter)]
+
+            for target, isbad_new, isbad in zip(
+                    problem.targets, isbad_mask_new, isbad_mask):
+
+                if isbad_new != isbad:
+                    errmess.append('  %s, %s -> %s' % (
+                        target.string_id(), isbad, isbad_new))
+
+            raise BadProblem('\n'.join(errmess))
+
+        self._isbad_mask = isbad_mask_new
+
+        if num.all(self._isbad_mask):
+            raise BadProblem(
+                'problem %s: all target misfit values are NaN'
+                % problem.name)
+
+    def evaluate_models(self, problem, xs, mask=None, rejection=None):
+        '''
+        Compute misfits for a batch of models.
+
+        :param rejection: optimiser specific early rejection setup, ``None``
+            to evaluate the models completely
+        '''
+
+        return problem.misfits_many(xs, mask=mask)
+
+    def evaluate_samples_parallel(self, problem, tasks, nworkers=1):
+        '''
+        Evaluate batches of candidate models in *nworkers* worker processes.
+
+        :param tasks: iterable of tuples ``(iiter, xs, isok_mask,
+            rejection)``
+        :returns: generator yielding tuples ``(iiter, xs, misfits)``, in
+            order of the tasks
+        '''
+
+        from grond.targets.base import traveltime_cache
+
+        if nworkers > 1:
+            # open stores can not be passed to the workers
+            engine = problem.get_engine()
+            if engine is not None:
+                engine.close_cashed_stores()
+
+        g_state_id = id(problem)
+        try:
+            for iiter, xs, misfits, cache_stats in parimap.parimap(
+                    evaluate_samples,
+                    tasks,
+                    itertools.repeat(g_state_id),
+                    nprocs=nworkers,
+                    startup=init_worker,
+                    startup_args=(g_state_id, problem, self, os.getpid())):
+
+                traveltime_cache.add_statistics(*cache_stats)
+                yield iiter, xs, misfits
+
+        finally:
+            g_state.pop(g_state_id, None)
+
+    def log_pruning(self, problem):
+        '''
+        Log which targets are left out from modelling because of zero weight.
+        '''
+
+        prunable = problem.get_prunable_mask()
+        nzero = sum(
+            1 for target in problem.targets
+            if num.all(target.get_combined_weight() == 0.0))
+
+        if num.any(prunable):
+            logger.info(
+                'problem %s: skipping modelling of %i of %i targets with '
+                'zero weight (%.0f%%)' % (
+                    problem.name, num.sum(prunable), problem.ntargets,
+                    100. * num.sum(prunable) / problem.ntargets))
+
+        if nzero > num.sum(prunable):
+            logger.info(
+                'problem %s: %i targets with zero weight are modelled '
+                'nevertheless, they enter the normalisation of their '
+                'family' % (problem.name, nzero - num.sum(prunable)))
+
+    def log_cache_statistics(self, problem):
+        '''
+        Log usage of the travel time cache and reset it.
+
+        Lookups done in worker processes are included, as far as their counts
+        have been passed back with the results (see
+        :py:meth:`grond.targets.base.TravelTimeCache.take_statistics`). Each
+        worker fills its own cache.
+        '''
+
+        from grond.targets.base import traveltime_cache
+        if traveltime_cache.nlookups:
+            logger.info(
+                'problem %s: travel time cache: %i lookups, hit rate %.3f'
+                % (problem.name, traveltime_cache.nlookups,
+                   traveltime_cache.hit_rate))
+
+        traveltime_cache.clear()
 
     @classmethod
     def get_plot_classes(cls):
@@ -63,6 +422,10 @@ class OptimiserStatus(object):
 
 __all__ = '''
     BadProblem
+    BootstrapTypeChoice
+    OptimiserCheckpoint
+    dump_checkpoint
+    load_checkpoint
     Optimiser
     OptimiserConfig
 '''.split()
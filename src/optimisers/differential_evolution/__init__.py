@@ -0,0 +1 @@
+from .optimiser import *  # noqa
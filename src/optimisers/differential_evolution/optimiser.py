@@ -0,0 +1,485 @@
+from __future__ import print_function
+import os.path as op
+import logging
+import time
+import numpy as num
+from collections import OrderedDict
+
+from pyrocko.guts import StringChoice, Int, Float
+
+from grond.meta import GrondError, Forbidden
+from grond.problems.base import ModelHistory, truncate_problem_data
+from grond.optimisers.base import Optimiser, OptimiserConfig, \
+    OptimiserStatus, OptimiserCheckpoint, BootstrapTypeChoice, \
+    dump_checkpoint, load_checkpoint
+
+guts_prefix = 'grond'
+
+logger = logging.getLogger('grond.optimisers.differential_evolution.optimiser')
+
+
+class MutationStrategyChoice(StringChoice):
+    choices = ['rand_1', 'current_to_best_1']
+
+
+class Population(object):
+    '''
+    Population of the differential evolution, kept up to date with the model
+    history.
+
+    Each generation occupies *npop* consecutive models in the history. Member
+    *i* of a generation competes with member *i* of the population, using
+    bootstrap misfit *i* modulo *nchains* (0 is the global misfit), so that
+    the population covers the ensemble of bootstrap realisations.
+    '''
+
+    def __init__(self, problem, history, npop, nchains):
+        self.problem = problem
+        self.history = history
+        self.npop = npop
+        self.nchains = nchains
+        self.imodels = num.zeros(npop, dtype=num.int)
+        self.icolumns = num.arange(npop) % nchains
+        self.nread = 0
+        history.add_listener(self)
+        self.goto()
+
+    def goto(self, n=None):
+        if n is None:
+            n = self.history.nmodels
+
+        n = min(self.history.nmodels, n)
+
+        assert self.nread <= n
+
+        gbmss = self.history.bootstrap_misfits
+        while self.nread < n:
+            imodel = self.nread
+            imember = imodel % self.npop
+            if imodel >= self.npop:
+                icolumn = self.icolumns[imember]
+                misfit_new = gbmss[imodel, icolumn]
+                misfit_old = gbmss[self.imodels[imember], icolumn]
+                if misfit_new <= misfit_old or (
+                        num.isnan(misfit_old) and not num.isnan(misfit_new)):
+
+                    self.imodels[imember] = imodel
+            else:
+                self.imodels[imember] = imodel
+
+            self.nread += 1
+
+    def append(self, iiter, model, misfits):
+        self.goto(iiter)
+
+    def extend(self, ioffset, n, models, misfits):
+        self.goto(ioffset + n)
+
+    @property
+    def complete(self):
+        return self.nread >= self.npop
+
+    @property
+    def ngenerations(self):
+        return self.nread // self.npop
+
+    def models(self):
+        return self.history.models[self.imodels, :]
+
+    def misfits(self):
+        return self.history.bootstrap_misfits[self.imodels, self.icolumns]
+
+    def global_misfits(self):
+        return self.history.bootstrap_misfits[self.imodels, 0]
+
+    def best_member(self, icolumn):
+        misfits = self.history.bootstrap_misfits[self.imodels, icolumn]
+        if num.all(num.isnan(misfits)):
+            return None
+
+        return num.nanargmin(misfits)
+
+
+class DifferentialEvolutionOptimiser(Optimiser):
+    '''
+    Differential evolution with bootstrap.
+
+    The candidates of a whole generation are drawn at once and evaluated
+    together, split into one batch per worker process.
+    '''
+
+    ngenerations = Int.T(
+        default=200,
+        help='Number of generations.')
+    population_size = Int.T(
+        optional=True,
+        help='Number of models in the population, defaults to '
+             'nbootstrap + 1.')
+    mutation_strategy = MutationStrategyChoice.T(
+        default='rand_1',
+        help='\'rand_1\': mutant is a random member plus the scaled '
+             'difference of two others. \'current_to_best_1\': the member '
+             'is moved towards the best member of its bootstrap realisation '
+             'and by the scaled difference of two random members.')
+    mutation_factor = Float.T(
+        default=0.7,
+        help='Scale factor applied to difference vectors.')
+    crossover_rate = Float.T(
+        default=0.9,
+        help='Probability to take a parameter from the mutant (binomial '
+             'crossover).')
+    ntries_preconstrain_limit = Int.T(
+        default=1000,
+        help='Tries to find a valid preconstrained sample.')
+    nbootstrap = Int.T(default=100)
+    bootstrap_type = BootstrapTypeChoice.T(default='bayesian')
+    bootstrap_seed = Int.T(default=23)
+
+    checkpoint_interval = 10.
+
+    def __init__(self, **kwargs):
+        Optimiser.__init__(self, **kwargs)
+        self._status_population = None
+        self.rstate = num.random.RandomState(self.bootstrap_seed)
+
+    @property
+    def npop(self):
+        if self.population_size is not None:
+            return self.population_size
+        else:
+            return self.nchains
+
+    @property
+    def niterations(self):
+        return self.ngenerations * self.npop
+
+    def population(self, problem, history):
+        if self.npop < 4:
+            raise GrondError(
+                'differential evolution needs a population of at least 4 '
+                'models')
+
+        return Population(problem, history, self.npop, self.nchains)
+
+    def get_mutant(self, population, imember):
+        xs = population.models()
+        npop = population.npop
+        others = num.delete(num.arange(npop), imember)
+        ia, ib, ic = num.random.choice(others, size=3, replace=False)
+        f = self.mutation_factor
+
+        if self.mutation_strategy == 'rand_1':
+            return xs[ia] + f * (xs[ib] - xs[ic])
+
+        elif self.mutation_strategy == 'current_to_best_1':
+            ibest = population.best_member(population.icolumns[imember])
+            if ibest is None:
+                ibest = imember
+
+            return xs[imember] + f * (xs[ibest] - xs[imember]) \
+                + f * (xs[ia] - xs[ib])
+
+        else:
+            assert False, 'invalid mutation_strategy choice: %s' % (
+                self.mutation_strategy)
+
+    def get_trial(self, problem, population, imember):
+        '''
+        Draw a trial model for one member: mutation and binomial crossover.
+
+        Parameters leaving the bounds are put halfway between the parent's
+        value and the violated bound.
+        '''
+
+        xbounds = problem.get_parameter_bounds()
+        x = population.models()[imember]
+        npar = problem.nparameters
+
+        for ntries_preconstrain in range(self.ntries_preconstrain_limit):
+            mutant = self.get_mutant(population, imember)
+
+            cross = num.random.random(npar) < self.crossover_rate
+            cross[num.random.randint(0, npar)] = True
+            trial = num.where(cross, mutant, x)
+
+            trial = num.where(
+                trial < xbounds[:, 0], 0.5 * (xbounds[:, 0] + x), trial)
+            trial = num.where(
+                trial > xbounds[:, 1], 0.5 * (xbounds[:, 1] + x), trial)
+
+            try:
+                return problem.preconstrain(
+                    problem.reset_solved_parameters(trial))
+
+            except Forbidden:
+                pass
+
+        raise GrondError(
+            'could not find any suitable candidate sample within %i tries' % (
+                self.ntries_preconstrain_limit))
+
+    def get_generation(self, problem, population):
+        xs = num.zeros((self.npop, problem.nparameters), dtype=num.float)
+        for imember in range(self.npop):
+            if population.complete:
+                xs[imember, :] = self.get_trial(problem, population, imember)
+            else:
+                xs[imember, :] = problem.get_random_model()
+
+        return xs
+
+    def log_progress(self, problem, igeneration, population):
+        t = time.time()
+        if self._tlog_last < t - 10. \
+                or igeneration == self.ngenerations - 1:
+
+            ibest = None
+            if population.complete:
+                ibest = population.best_member(0)
+
+            if ibest is not None:
+                misfit_best = population.global_misfits()[ibest]
+            else:
+                misfit_best = num.nan
+
+            logger.info(
+                '%s at generation %i/%i, best global misfit %g' % (
+                    problem.name, igeneration, self.ngenerations,
+                    misfit_best))
+
+            self._tlog_last = t
+
+    def open_history(self, problem, rundir):
+        '''
+        Reopen the model history of an interrupted run for appending.
+
+        Models written after the last checkpoint or belonging to an
+        incomplete generation are discarded.
+        '''
+
+        checkpoint = load_checkpoint(rundir)
+        nmodels = truncate_problem_data(
+            rundir, problem,
+            nmodels=checkpoint.nmodels if checkpoint else None,
+            nchains=self.nchains)
+
+        nmodels = truncate_problem_data(
+            rundir, problem,
+            nmodels=nmodels - nmodels % self.npop,
+            nchains=self.nchains)
+
+        if checkpoint is not None and checkpoint.nmodels == nmodels:
+            checkpoint.restore_random_state()
+        else:
+            logger.warning(
+                'problem %s: no usable checkpoint found in rundir, '
+                'continuing with new random state' % problem.name)
+
+        history = ModelHistory(
+            problem, nchains=self.nchains, path=rundir, mode='a')
+
+        if history.nmodels != 0 and history.bootstrap_misfits is None:
+            raise GrondError(
+                'cannot resume: no bootstrap misfits found in rundir %s'
+                % rundir)
+
+        logger.info(
+            'problem %s: resuming at generation %i/%i' % (
+                problem.name, history.nmodels // self.npop,
+                self.ngenerations))
+
+        return history
+
+    def optimise(self, problem, rundir=None, nworkers=1, resume=False):
+        '''
+        Run the optimisation.
+
+        :param problem: :py:class:`grond.Problem` instance
+        :param rundir: path to rundir, defaults to None
+        :param nworkers: number of worker processes to compute the misfits
+            of a generation in parallel
+        :param resume: continue an interrupted run from the models and
+            checkpoint found in *rundir*
+        '''
+
+        if resume:
+            history = self.open_history(problem, rundir)
+        else:
+            if rundir is not None:
+                self.dump(filename=op.join(rundir, 'optimiser.yaml'))
+
+            history = ModelHistory(problem,
+                                   nchains=self.nchains,
+                                   path=rundir, mode='w')
+
+        population = self.population(problem, history)
+
+        self._isbad_mask = None
+        if history.nmodels != 0:
+            self._isbad_mask = num.logical_or(
+                num.isnan(history.misfits[-1, :, 0]),
+                problem.get_misfit_mask(problem.get_prunable_mask()))
+
+        bootstrap_weights = self.get_bootstrap_weights(problem)
+        bootstrap_residuals = self.get_bootstrap_residuals(problem)
+
+        self.log_pruning(problem)
+
+        self._tlog_last = 0
+        tcheckpoint_last = time.time()
+
+        try:
+            for igeneration in range(
+                    population.ngenerations, self.ngenerations):
+
+                self.log_progress(problem, igeneration, population)
+
+                xs = self.get_generation(problem, population)
+                isok_mask = self.get_isok_mask(problem)
+                iiter = history.nmodels
+                xs_batches = num.array_split(xs, min(nworkers, self.npop))
+                ioffsets = num.cumsum(
+                    [0] + [xs_batch.shape[0] for xs_batch in xs_batches])
+
+                tasks = [
+                    (iiter + int(ioffset), xs_batch, isok_mask, None)
+                    for (ioffset, xs_batch) in zip(ioffsets, xs_batches)]
+
+                misfits = num.concatenate([
+                    misfits_batch for (_, _, misfits_batch)
+                    in self.evaluate_samples_parallel(
+                        problem, tasks, nworkers)])
+
+                for isample in range(xs.shape[0]):
+                    self.check_misfits(
+                        problem, iiter+isample, misfits[isample, :, :])
+
+                bootstrap_misfits = problem.combine_misfits(
+                    misfits,
+                    extra_weights=bootstrap_weights,
+                    extra_residuals=bootstrap_residuals)
+
+                history.extend(xs, misfits, bootstrap_misfits)
+
+                t = time.time()
+                if rundir is not None \
+                        and t - tcheckpoint_last > self.checkpoint_interval:
+
+                    history.flush()
+                    dump_checkpoint(
+                        OptimiserCheckpoint.capture(history.nmodels), rundir)
+
+                    tcheckpoint_last = t
+
+            if rundir is not None:
+                history.flush()
+                dump_checkpoint(
+                    OptimiserCheckpoint.capture(history.nmodels), rundir)
+
+            self.log_cache_statistics(problem)
+
+        finally:
+            history.close()
+
+    def get_status(self, history):
+        sparks = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+        problem = history.problem
+        if self._status_population is None:
+            self._status_population = self.population(problem, history)
+
+        population = self._status_population
+        population.goto(history.nmodels)
+
+        row_names = [p.name_nogroups for p in problem.parameters]
+        row_names.append('Misfit')
+
+        def colum_array(data):
+            arr = num.full(len(row_names), fill_value=num.nan)
+            arr[:data.size] = data
+            return arr
+
+        xs = population.models()
+        misfits = population.global_misfits()
+        ibest = population.best_member(0)
+
+        pop_mean = colum_array(num.mean(xs, axis=0))
+        pop_mean[-1] = num.nanmean(misfits)
+        pop_std = colum_array(num.std(xs, axis=0))
+        pop_std[-1] = num.nanstd(misfits)
+        if ibest is not None:
+            pop_best = colum_array(xs[ibest])
+            pop_best[-1] = misfits[ibest]
+        else:
+            pop_best = colum_array(num.array([]))
+
+        def spark_plot(data, bins):
+            hist, _ = num.histogram(data, bins)
+            hist_max = num.max(hist)
+            if hist_max == 0.0:
+                hist_max = 1.0
+            hist = hist / hist_max
+            vec = num.digitize(hist, num.linspace(0., 1., len(sparks)))
+            return ''.join([sparks[b-1] for b in vec])
+
+        return OptimiserStatus(
+            row_names=row_names,
+            column_data=OrderedDict(
+                zip(['Pop mean', 'Pop std', 'Pop best'],
+                    [pop_mean, pop_std, pop_best])),
+            extra_header=  # noqa
+                u'Generation {igeneration}/{ngenerations}, '  # noqa
+                u'population of {npop}\n'
+                u'Global misfit distribution: \u2080{mf_dist}\xb9'
+                .format(
+                    igeneration=population.ngenerations,
+                    ngenerations=self.ngenerations,
+                    npop=population.npop,
+                    mf_dist=spark_plot(
+                        misfits, num.linspace(0., 1., 25))))
+
+    def get_movie_maker(
+            self, problem, history, xpar_name, ypar_name, movie_filename):
+
+        raise GrondError('optimiser does not support movies')
+
+
+class DifferentialEvolutionOptimiserConfig(OptimiserConfig):
+
+    ngenerations = Int.T(
+        default=200,
+        help='Number of generations.')
+    population_size = Int.T(
+        optional=True,
+        help='Number of models in the population, defaults to '
+             'nbootstrap + 1.')
+    mutation_strategy = MutationStrategyChoice.T(
+        default='rand_1',
+        help='Mutation strategy: \'rand_1\' or \'current_to_best_1\'.')
+    mutation_factor = Float.T(
+        default=0.7,
+        help='Scale factor applied to difference vectors.')
+    crossover_rate = Float.T(
+        default=0.9,
+        help='Probability to take a parameter from the mutant.')
+    nbootstrap = Int.T(
+        default=100,
+        help='Number of bootstrap realisations to be tracked simultaneously in'
+             ' the optimisation.')
+
+    def get_optimiser(self):
+        return DifferentialEvolutionOptimiser(
+            ngenerations=self.ngenerations,
+            population_size=self.population_size,
+            mutation_strategy=self.mutation_strategy,
+            mutation_factor=self.mutation_factor,
+            crossover_rate=self.crossover_rate,
+            nbootstrap=self.nbootstrap)
+
+
+__all__ = '''
+    MutationStrategyChoice
+    Population
+    DifferentialEvolutionOptimiser
+    DifferentialEvolutionOptimiserConfig
+'''.split()
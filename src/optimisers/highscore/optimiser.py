@@ -4,16 +4,23 @@ import os.path as op
 import os
 import logging
 import time
+import copy
 import numpy as num
 from collections import OrderedDict
+from scipy.spatial import cKDTree
+from scipy.special import ndtr, ndtri
 
-from pyrocko.guts import StringChoice, Int, Float, Object, List
+from pyrocko.guts import StringChoice, Int, Float, Object, List, String, \
+    Bool
 from pyrocko.guts_array import Array
 
 from grond.meta import GrondError, Forbidden
-from grond.problems.base import ModelHistory
-from grond.optimisers.base import Optimiser, OptimiserConfig, BadProblem, \
-    OptimiserStatus
+from grond.problems.base import ModelHistory, truncate_problem_data, \
+    load_problem_info_and_data, ProblemInfoNotAvailable, \
+    ProblemDataNotAvailable
+from grond.optimisers.base import Optimiser, OptimiserConfig, \
+    OptimiserStatus, OptimiserCheckpoint, BootstrapTypeChoice, \
+    dump_checkpoint, load_checkpoint
 
 guts_prefix = 'grond'
 
@@ -24,11 +31,18 @@ def excentricity_compensated_probabilities(xs, sbx, factor):
     inonflat = num.where(sbx != 0.0)[0]
     scale = num.zeros_like(sbx)
     scale[inonflat] = 1.0 / (sbx[inonflat] * (factor if factor != 0. else 1.0))
-    distances_sqr_all = num.sum(
-        ((xs[num.newaxis, :, :] - xs[:, num.newaxis, :]) *
-         scale[num.newaxis, num.newaxis, :])**2, axis=2)
-    probabilities = 1.0 / num.sum(distances_sqr_all < 1.0, axis=1)
-    # print(num.sort(num.sum(distances_sqr_all < 1.0, axis=1)))
+
+    if inonflat.size == 0:
+        return num.full(xs.shape[0], 1.0 / xs.shape[0])
+
+    # count neighbours within unit (scaled) distance, including the model
+    # itself, using a spatial index instead of all pairwise distances
+    xs_scaled = xs[:, inonflat] * scale[num.newaxis, inonflat]
+    tree = cKDTree(xs_scaled)
+    nneighbours = tree.query_ball_point(
+        xs_scaled, r=num.nextafter(1.0, 0.0), return_length=True)
+
+    probabilities = 1.0 / nneighbours
     probabilities /= num.sum(probabilities)
     return probabilities
 
@@ -42,6 +56,105 @@ def excentricity_compensated_choice(xs, sbx, factor):
     return ichoice
 
 
+def truncated_normal(mean, std, xmin, xmax):
+    '''
+    Draw from normal distributions truncated to given bounds.
+
+    All arguments are arrays of equal size, one entry per parameter. Values
+    are drawn for all parameters at once by inverting the cumulative
+    distribution function in the truncation interval. Bounds in the upper
+    tail are mirrored to the lower tail, to keep precision.
+
+    :returns: tuple ``(x, ok)``, where ``ok`` is ``False`` for parameters
+        where the probability mass within the bounds is too small to sample
+        from and for zero-width distributions centred outside the bounds.
+    '''
+
+    mean, std, xmin, xmax = [
+        num.asarray(v, dtype=num.float) for v in (mean, std, xmin, xmax)]
+
+    x = mean.copy()
+    ok = num.logical_and(xmin <= mean, mean <= xmax)
+
+    iscatter = num.where(std > 0.)[0]
+    if iscatter.size == 0:
+        return x, ok
+
+    mu = mean[iscatter]
+    sigma = std[iscatter]
+    a = (xmin[iscatter] - mu) / sigma
+    b = (xmax[iscatter] - mu) / sigma
+
+    flip = a > 0.
+    a, b = num.where(flip, -b, a), num.where(flip, -a, b)
+
+    pa = ndtr(a)
+    pb = ndtr(b)
+    ok_scatter = pb - pa > 0.
+    pb = num.where(ok_scatter, pb, 1.)
+    pa = num.where(ok_scatter, pa, 0.)
+
+    u = num.random.uniform(pa, pb)
+    z = num.clip(ndtri(u), a, b)
+    z = num.where(flip, -z, z)
+
+    x[iscatter] = num.clip(mu + sigma * z, xmin[iscatter], xmax[iscatter])
+    ok[iscatter] = ok_scatter
+    return x, ok
+
+
+def first_primes(n):
+    primes = []
+    candidate = 2
+    while len(primes) < n:
+        if all(candidate % p != 0 for p in primes):
+            primes.append(candidate)
+
+        candidate += 1
+
+    return primes
+
+
+def scrambled_halton(indices, permutations):
+    '''
+    Get points of the Halton sequence, with randomly permuted digits.
+
+    :param indices: 1D integer array with indices of the points
+    :param permutations: list with one permutation of the digits for each
+        dimension, the length of each permutation is the base used for that
+        dimension
+    :returns: 2D array ``u[ipoint, idim]`` with values in [0, 1[
+    '''
+
+    indices = num.asarray(indices, dtype=num.int64)
+    u = num.zeros((indices.size, len(permutations)))
+    for idim, permutation in enumerate(permutations):
+        base = permutation.size
+        ndigits = int(math.ceil(53. / math.log(base, 2)))
+        n = indices.copy()
+        f = 1.0 / base
+        for idigit in range(ndigits):
+            u[:, idim] += permutation[n % base] * f
+            n //= base
+            f /= base
+
+    return u
+
+
+def latin_hypercube(npoints, ndim, rstate):
+    '''
+    Get a Latin hypercube design of *npoints* in *ndim* dimensions.
+
+    :returns: 2D array ``u[ipoint, idim]`` with values in [0, 1[
+    '''
+
+    u = rstate.uniform(0., 1., size=(npoints, ndim))
+    for idim in range(ndim):
+        u[:, idim] += rstate.permutation(npoints)
+
+    return u / npoints
+
+
 def local_std(xs):
     ssbx = num.sort(xs, axis=0)
     dssbx = num.diff(ssbx, axis=0)
@@ -60,12 +173,16 @@ class StandardDeviationEstimatorChoice(StringChoice):
         'standard_deviation_single_chain']
 
 
-class SamplerStartingPointChoice(StringChoice):
-    choices = ['excentricity_compensated', 'random', 'mean']
+class UniformSequenceChoice(StringChoice):
+    choices = ['random', 'halton', 'latin_hypercube']
 
 
-class BootstrapTypeChoice(StringChoice):
-    choices = ['bayesian', 'classic']
+class ScatterScaleModeChoice(StringChoice):
+    choices = ['schedule', 'adaptive']
+
+
+class SamplerStartingPointChoice(StringChoice):
+    choices = ['excentricity_compensated', 'random', 'mean']
 
 
 class SamplerPhase(Object):
@@ -74,6 +191,10 @@ class SamplerPhase(Object):
     ntries_preconstrain_limit = Int.T(
         default=1000,
         help='Tries to find a valid preconstrained sample.')
+    nbatch = Int.T(
+        default=1,
+        help='Number of models drawn from the current state of the chains '
+             'and evaluated together in each step of this phase.')
 
     def get_raw_sample(self, problem, iiter, chains):
         raise NotImplementedError
@@ -84,8 +205,8 @@ class SamplerPhase(Object):
         ntries_preconstrain = 0
         for ntries_preconstrain in range(self.ntries_preconstrain_limit):
             try:
-                return problem.preconstrain(
-                    self.get_raw_sample(problem, iiter, chains))
+                return problem.preconstrain(problem.reset_solved_parameters(
+                    self.get_raw_sample(problem, iiter, chains)))
 
             except Forbidden:
                 pass
@@ -94,6 +215,76 @@ class SamplerPhase(Object):
             'could not find any suitable candidate sample within %i tries' % (
                 self.ntries_preconstrain_limit))
 
+    def get_samples(self, problem, iiter, chains, nsamples):
+        '''
+        Get a batch of samples, all drawn from the current state of the chains.
+
+        :returns: 2D array ``xs[isample, iparameter]``
+        '''
+        assert 0 <= iiter and iiter + nsamples <= self.niterations
+
+        xs = num.zeros((nsamples, problem.nparameters), dtype=num.float)
+        for isample in range(nsamples):
+            xs[isample, :] = self.get_sample(problem, iiter+isample, chains)
+
+        return xs
+
+    def update(self, problem, iiter, chains):
+        '''
+        Called before each batch of samples is drawn, chains are up to date.
+        '''
+        pass
+
+    def replay_samples(self, problem, iiter, chains, xs):
+        '''
+        Called on resume, for each batch of this phase found in the rundir.
+
+        Phases which keep track of their samples until the misfits are known
+        rebuild this bookkeeping here, from the models *xs* drawn at
+        iteration *iiter* of the phase, without drawing new samples. Chains
+        are in the state in which the batch was drawn.
+        '''
+        pass
+
+    def check_convergence(self, problem, iiter, chains):
+        '''
+        Check if the phase can be ended before *iiter* reaches niterations.
+
+        :returns: ``None`` to continue, or a message giving the reason to
+            end the phase
+        '''
+        return None
+
+    def get_report(self):
+        '''
+        Get a summary of phase specific statistics, logged at the end of a run.
+
+        :returns: ``None`` or a message
+        '''
+        return None
+
+
+class SamplerPhaseRecord(Object):
+    '''
+    Actual extent of a sampler phase in an optimisation run.
+    '''
+
+    phase = String.T(
+        help='Class name of the sampler phase.')
+    iiter_begin = Int.T(
+        help='First iteration of the phase.')
+    iiter_end = Int.T(
+        optional=True,
+        help='Iteration after the last one of the phase, unset while the '
+             'phase is running.')
+    termination = String.T(
+        optional=True,
+        help='Reason why the phase has been ended early.')
+
+
+class HighScoreOptimiserCheckpoint(OptimiserCheckpoint):
+    phase_records = List.T(SamplerPhaseRecord.T())
+
 
 class InjectionSamplerPhase(SamplerPhase):
     xs_inject = Array.T(
@@ -104,12 +295,185 @@ class InjectionSamplerPhase(SamplerPhase):
         return self.xs_inject[iiter, :]
 
 
+class WarmStartSamplerPhase(SamplerPhase):
+    '''
+    Start from the models of a previous optimisation of the same event.
+
+    The models are re-evaluated under the current problem, best ones (as
+    judged in the previous optimisation) first. Parameters are matched by
+    name. Parameters not present in the previous optimisation are set to the
+    centre of their range, and values are clipped to the current ranges. If
+    the phase has more iterations than there are models, the remaining
+    samples are drawn uniformly.
+    '''
+
+    rundir = String.T(
+        help='Rundir of the previous optimisation.')
+    subset = String.T(
+        optional=True,
+        default='harvest',
+        help='Subset of models to start from, \'harvest\' for the ensemble '
+             'of best models in the bootstrap chains. If unset, all models '
+             'of the previous optimisation are used.')
+
+    def __init__(self, *args, **kwargs):
+        SamplerPhase.__init__(self, *args, **kwargs)
+        self._xs_warm = None
+
+    def get_warm_models(self, problem):
+        if self._xs_warm is not None:
+            return self._xs_warm
+
+        try:
+            problem_old, xs_old, misfits_old, _ = load_problem_info_and_data(
+                self.rundir, subset=self.subset)
+
+        except (ProblemInfoNotAvailable, ProblemDataNotAvailable) as e:
+            raise GrondError(
+                'cannot warm-start from rundir %s: %s' % (self.rundir, e))
+
+        _, iunique = num.unique(xs_old, axis=0, return_index=True)
+        gms_old = problem_old.combine_misfits(misfits_old[iunique, :, :])
+        iunique = iunique[num.argsort(gms_old)]
+
+        xbounds = problem.get_parameter_bounds()
+        xs = num.zeros((iunique.size, problem.nparameters))
+        xs[:, :] = num.mean(xbounds, axis=1)[num.newaxis, :]
+
+        pnames_old = problem_old.parameter_names[:problem_old.nparameters]
+        for ipar, pname in enumerate(
+                problem.parameter_names[:problem.nparameters]):
+
+            if pname in pnames_old:
+                xs[:, ipar] = num.clip(
+                    xs_old[iunique, pnames_old.index(pname)],
+                    xbounds[ipar, 0], xbounds[ipar, 1])
+            else:
+                logger.warning(
+                    'warm start: parameter %s not present in rundir %s, '
+                    'starting at centre of its range' % (pname, self.rundir))
+
+        logger.info('warm start: %i models from rundir %s' % (
+            xs.shape[0], self.rundir))
+
+        self._xs_warm = xs
+        return self._xs_warm
+
+    def get_raw_sample(self, problem, iiter, chains):
+        xs = self.get_warm_models(problem)
+        if iiter < xs.shape[0]:
+            return xs[iiter, :]
+        else:
+            xbounds = problem.get_parameter_bounds()
+            return problem.random_uniform(xbounds)
+
+    def get_sample(self, problem, iiter, chains):
+        try:
+            return problem.preconstrain(
+                self.get_raw_sample(problem, iiter, chains))
+
+        except Forbidden:
+            # the warm model is not allowed in the current problem
+            logger.debug(
+                'warm start: model %i is forbidden, drawing uniform sample '
+                'instead' % iiter)
+
+            uniform_phase = UniformSamplerPhase(
+                niterations=self.niterations,
+                ntries_preconstrain_limit=self.ntries_preconstrain_limit)
+
+            return uniform_phase.get_sample(problem, iiter, chains)
+
+
 class UniformSamplerPhase(SamplerPhase):
+    sequence = UniformSequenceChoice.T(
+        default='random',
+        help='Sequence of the samples: \'random\' for independent random '
+             'samples, \'halton\' for a scrambled Halton sequence or '
+             '\'latin_hypercube\' for a Latin hypercube design over the '
+             'iterations of this phase. The latter two cover the model space '
+             'more evenly with fewer samples.')
+    seed = Int.T(
+        default=23,
+        help='Random seed for the scrambling of the Halton sequence and for '
+             'the Latin hypercube design.')
+
+    def __init__(self, *args, **kwargs):
+        SamplerPhase.__init__(self, *args, **kwargs)
+        self._sequence_state = None
+
+    def get_sequence_point(self, problem, ipoint):
+        '''
+        Get point from the configured quasi-random sequence.
+
+        Points with ``ipoint >= niterations`` are used as replacements for
+        forbidden ones. For the Latin hypercube design, these are
+        independent random points.
+        '''
+
+        npar = problem.nparameters
+        if self.sequence == 'halton':
+            if self._sequence_state is None \
+                    or len(self._sequence_state) != npar:
+
+                rstate = num.random.RandomState(self.seed)
+                self._sequence_state = [
+                    rstate.permutation(base)
+                    for base in first_primes(npar)]
+
+            return scrambled_halton([ipoint + 1], self._sequence_state)[0]
+
+        elif self.sequence == 'latin_hypercube':
+            if ipoint >= self.niterations:
+                rstate = num.random.RandomState((self.seed, ipoint))
+                return rstate.uniform(0., 1., size=npar)
+
+            if self._sequence_state is None \
+                    or self._sequence_state.shape[1] != npar:
+
+                rstate = num.random.RandomState(self.seed)
+                self._sequence_state = latin_hypercube(
+                    self.niterations, npar, rstate)
+
+            return self._sequence_state[ipoint]
+
+        else:
+            assert False, 'invalid sequence choice: %s' % self.sequence
 
     def get_raw_sample(self, problem, iiter, chains):
         xbounds = problem.get_parameter_bounds()
         return problem.random_uniform(xbounds)
 
+    def get_sample(self, problem, iiter, chains):
+        if self.sequence == 'random':
+            return SamplerPhase.get_sample(self, problem, iiter, chains)
+
+        assert 0 <= iiter < self.niterations
+
+        # on forbidden samples, continue with points beyond the end of the
+        # sequence, which only depend on iiter and the number of tries
+        xbounds = problem.get_parameter_bounds()
+        ntries_limit = self.ntries_preconstrain_limit
+        for ntries_preconstrain in range(ntries_limit):
+            if ntries_preconstrain == 0:
+                ipoint = iiter
+            else:
+                ipoint = self.niterations + iiter * ntries_limit \
+                    + ntries_preconstrain - 1
+
+            u = self.get_sequence_point(problem, ipoint)
+
+            try:
+                return problem.preconstrain(
+                    problem.random_uniform(xbounds, u=u))
+
+            except Forbidden:
+                pass
+
+        raise GrondError(
+            'could not find any suitable candidate sample within %i tries' % (
+                self.ntries_preconstrain_limit))
+
 
 class DirectedSamplerPhase(SamplerPhase):
     scatter_scale = Float.T(
@@ -117,10 +481,29 @@ class DirectedSamplerPhase(SamplerPhase):
         help='Scales search radius around the current `highscore` models')
     scatter_scale_begin = Float.T(
         optional=True,
-        help='Scaling factor at beginning of the phase.')
+        help='Scaling factor at beginning of the phase. Defaults to '
+             '`scatter_scale_end` if only that is set.')
     scatter_scale_end = Float.T(
         optional=True,
-        help='Scaling factor at the end of the directed phase.')
+        help='Scaling factor at the end of the directed phase. Defaults to '
+             '`scatter_scale_begin` if only that is set.')
+    scatter_scale_mode = ScatterScaleModeChoice.T(
+        default='schedule',
+        help='\'schedule\': scatter scale decreases exponentially from '
+             '`scatter_scale_begin` to `scatter_scale_end` over the phase. '
+             '\'adaptive\': scatter scale is tuned to reach '
+             '`acceptance_rate_target`, starting from `scatter_scale_begin` '
+             'and kept between `scatter_scale_begin` and `scatter_scale_end` '
+             '(or within a factor of 10 of `scatter_scale`).')
+    acceptance_rate_target = Float.T(
+        default=0.2,
+        help='Adaptive scatter scale: target for the mean acceptance rate '
+             'of the bootstrap chains.')
+    scatter_scale_gain = Float.T(
+        default=1.0,
+        help='Adaptive scatter scale: change of the logarithm of the scatter '
+             'scale per 100 iterations and unit deviation of the acceptance '
+             'rate from its target.')
     starting_point = SamplerStartingPointChoice.T(
         default='excentricity_compensated',
         help='Tunes to the center value of the sampler distribution.'
@@ -136,12 +519,411 @@ class DirectedSamplerPhase(SamplerPhase):
 
     ntries_sample_limit = Int.T(default=1000)
 
-    def get_scatter_scale_factor(self, iiter):
-        s = self.scatter_scale
+    convergence_window = Int.T(
+        default=1000,
+        help='Number of iterations over which the convergence criteria are '
+             'evaluated. The phase is not ended within its first window.')
+    convergence_misfit_rtol = Float.T(
+        optional=True,
+        help='Convergence criterion: relative change of the best misfit in '
+             'each bootstrap chain within the convergence window.')
+    convergence_spread_rtol = Float.T(
+        optional=True,
+        help='Convergence criterion: relative change of the standard '
+             'deviation of each parameter over all bootstrap chains within '
+             'the convergence window.')
+    convergence_acceptance_rate_min = Float.T(
+        optional=True,
+        help='Convergence criterion: mean acceptance rate of the bootstrap '
+             'chains below which the phase is ended.')
+
+    surrogate = Bool.T(
+        default=False,
+        help='Pre-screen candidates with a nearest-neighbour regression of '
+             'the bootstrap misfits in the model history and discard those '
+             'predicted to be rejected by all chains.')
+    surrogate_nneighbors = Int.T(
+        default=8,
+        help='Surrogate: number of nearest neighbours in the model history '
+             'used to predict the misfits of a candidate.')
+    surrogate_margin = Float.T(
+        default=1.0,
+        help='Surrogate: a candidate is discarded if its predicted misfit '
+             'exceeds the acceptance threshold times this factor in all '
+             'chains.')
+    surrogate_audit_fraction = Float.T(
+        default=0.05,
+        help='Surrogate: fraction of the candidates predicted to be rejected '
+             'which are evaluated nevertheless, to monitor the false '
+             'rejection rate.')
+    surrogate_ntries_limit = Int.T(
+        default=20,
+        help='Surrogate: maximum number of candidates discarded in a row, '
+             'before a candidate is taken regardless of the prediction.')
+
+    # maximum number of recent models the surrogate is fitted to
+    surrogate_nmodels_max = 20000
+
+    def __init__(self, *args, **kwargs):
+        SamplerPhase.__init__(self, *args, **kwargs)
+        self._chains_state_key = None
+        self._chains_state = None
+        self._convergence_snapshots = []
+        self._adaptive_state = None
+        self._surrogate_state = None
+        self._surrogate_pending = {}
+        self._surrogate_nchecked = 0
+        self._surrogate_stats = dict(
+            ndiscarded=0,
+            naccept_predicted=0,
+            naccept_predicted_ok=0,
+            nreject_predicted=0,
+            nreject_predicted_false=0)
+
+    def get_chains_state(self, chains):
+        '''
+        Get chain choice and model spread estimates for the next sample.
+
+        These only change when the chains are updated, so they are shared by
+        all samples of a batch.
+        '''
+
+        key = (id(chains), chains.nread)
+        if self._chains_state_key != key:
+            ichain_choice = num.argmin(chains.accept_sum)
+
+            # parameters solved for in the modelling are not sampled
+            solved = chains.problem.get_solved_parameter_mask()
+
+            sx = None
+            if self.starting_point == 'excentricity_compensated' \
+                    or self.sampler_distribution == 'normal':
+
+                sx = chains.standard_deviation_models(
+                    ichain_choice, self.standard_deviation_estimator)
+
+                sx[solved] = 0.
+
+            probabilities = None
+            if self.starting_point == 'excentricity_compensated':
+                probabilities = excentricity_compensated_probabilities(
+                    chains.models(ichain_choice), sx, 2.)
+
+            cov_factor = None
+            if self.sampler_distribution == 'multivariate_normal':
+                cov = chains.covariance_models(ichain_choice)
+                if num.any(solved):
+                    cov[solved, :] = 0.
+                    cov[:, solved] = 0.
+
+                _, s, vh = num.linalg.svd(cov)
+                cov_factor = num.sqrt(s)[:, num.newaxis] * vh
+
+            self._chains_state_key = key
+            self._chains_state = ichain_choice, sx, probabilities, cov_factor
+
+        return self._chains_state
+
+    def check_convergence(self, problem, iiter, chains):
+        '''
+        Check configured convergence criteria.
+
+        The phase is ended when all of the configured criteria are met.
+        '''
+
+        if all(v is None for v in (
+                self.convergence_misfit_rtol,
+                self.convergence_spread_rtol,
+                self.convergence_acceptance_rate_min)):
+            return None
+
+        snapshots = self._convergence_snapshots
+        if snapshots and snapshots[-1][0] > iiter:
+            snapshots[:] = []
+
+        def get_spread():
+            if self.convergence_spread_rtol is None:
+                return None
+
+            return chains.standard_deviation_models(
+                None, 'standard_deviation_all_chains')
+
+        best_misfits = chains.chains_m[:, 0].copy()
+        spread = None
+
+        nwindow = self.convergence_window
+        if not snapshots or \
+                iiter - snapshots[-1][0] >= max(1, nwindow // 10):
+            spread = get_spread()
+            snapshots.append((iiter, best_misfits, spread))
+
+        ireference = None
+        for i, (iiter_snapshot, _, _) in enumerate(snapshots):
+            if iiter - iiter_snapshot >= nwindow:
+                ireference = i
+
+        if ireference is None:
+            return None
+
+        _, best_misfits_ref, spread_ref = snapshots[ireference]
+        del snapshots[:ireference]
+
+        reasons = []
+        if self.convergence_misfit_rtol is not None:
+            rtol = self.convergence_misfit_rtol
+            if not num.all(num.abs(best_misfits - best_misfits_ref)
+                           <= rtol * num.abs(best_misfits_ref)):
+                return None
+
+            reasons.append(
+                'best misfits changed by less than %g' % rtol)
+
+        if self.convergence_spread_rtol is not None:
+            rtol = self.convergence_spread_rtol
+            if spread is None:
+                spread = get_spread()
+
+            if not num.all(num.abs(spread - spread_ref)
+                           <= rtol * num.abs(spread_ref)):
+                return None
+
+            reasons.append(
+                'model spread changed by less than %g' % rtol)
+
+        if self.convergence_acceptance_rate_min is not None:
+            rate = num.mean(chains.acceptance_rate)
+            if not rate < self.convergence_acceptance_rate_min:
+                return None
+
+            reasons.append(
+                'acceptance rate %g below %g' % (
+                    rate, self.convergence_acceptance_rate_min))
+
+        return 'converged after %i iterations (%s)' % (
+            iiter, ', '.join(reasons))
+
+    def get_scatter_scale_begin_end(self):
+        '''
+        Get scatter scale at the begin and at the end of the phase.
+
+        If only one of them is configured, it is used for both.
+
+        :returns: tuple ``(begin, end)``, ``(None, None)`` if neither is set
+        '''
+
         sa = self.scatter_scale_begin
         sb = self.scatter_scale_end
 
-        assert s is None or (sa is None and sb is None)
+        if sa is None:
+            sa = sb
+        elif sb is None:
+            sb = sa
+
+        return sa, sb
+
+    def get_scatter_scale_limits(self):
+        s = self.scatter_scale
+        sa, sb = self.get_scatter_scale_begin_end()
+
+        if sa is not None:
+            return sa, min(sa, sb), max(sa, sb)
+        else:
+            s = s or 1.0
+            return s, s / 10., s * 10.
+
+    def update_surrogate(self, problem, chains):
+        '''
+        Check predictions against evaluated models and refit the surrogate.
+
+        The surrogate is fitted to the most recent models, at most
+        ``surrogate_nmodels_max``, and refitted whenever 10% of that number
+        (at least 100 models) have been added since the last fit. The
+        bootstrap misfits of the neighbours are looked up in the model
+        history when a prediction is made.
+        '''
+
+        history = chains.history
+        nmodels = chains.nread
+        if nmodels == 0 or history.bootstrap_misfits is None:
+            return
+
+        models = history.models[:nmodels]
+        gbmss = history.bootstrap_misfits[:nmodels]
+
+        stats = self._surrogate_stats
+        for imodel in range(min(self._surrogate_nchecked, nmodels), nmodels):
+            pending = self._surrogate_pending.pop(
+                problem.get_model_key(models[imodel, :]), None)
+
+            if pending is None:
+                continue
+
+            reject_predicted, thresholds = pending
+            accepted = num.any(gbmss[imodel, :] < thresholds)
+            if reject_predicted:
+                stats['nreject_predicted'] += 1
+                stats['nreject_predicted_false'] += int(accepted)
+            else:
+                stats['naccept_predicted'] += 1
+                stats['naccept_predicted_ok'] += int(accepted)
+
+        self._surrogate_nchecked = nmodels
+
+        state = self._surrogate_state
+        if state is None or state[0] > nmodels \
+                or nmodels >= state[0] + max(
+                    100, (state[0] - state[1]) // 10):
+
+            xbounds = problem.get_parameter_bounds()
+            scale = xbounds[:, 1] - xbounds[:, 0]
+            scale[scale == 0.0] = 1.0
+
+            imodel_begin = max(0, nmodels - self.surrogate_nmodels_max)
+            self._surrogate_state = (
+                nmodels,
+                imodel_begin,
+                cKDTree(models[imodel_begin:] / scale[num.newaxis, :]),
+                history,
+                scale)
+
+    def predict_rejection(self, x, thresholds):
+        '''
+        Predict if a candidate model will be rejected by all chains.
+
+        :returns: ``None`` if no prediction is available yet, otherwise
+            ``True`` or ``False``
+        '''
+
+        state = self._surrogate_state
+        if state is None or num.any(num.isinf(thresholds)):
+            return None
+
+        nmodels, imodel_begin, tree, history, scale = state
+        k = min(self.surrogate_nneighbors, nmodels - imodel_begin)
+        distances, imodels = tree.query(x / scale, k=k)
+        distances = num.atleast_1d(distances)
+        imodels = num.atleast_1d(imodels)
+
+        neighbors = history.bootstrap_misfits[imodel_begin + imodels, :]
+        weights = (1.0 / num.maximum(distances, 1e-12))[:, num.newaxis] \
+            * num.isfinite(neighbors)
+
+        with num.errstate(invalid='ignore'):
+            predicted = num.nansum(weights * neighbors, axis=0) \
+                / num.sum(weights, axis=0)
+
+            return bool(num.all(
+                predicted >= self.surrogate_margin * thresholds))
+
+    def replay_samples(self, problem, iiter, chains, xs):
+        '''
+        Restore the pending surrogate predictions of models in the rundir.
+        '''
+
+        if not self.surrogate:
+            return
+
+        thresholds = chains.acceptance_thresholds()
+        for x in xs:
+            reject_predicted = self.predict_rejection(x, thresholds)
+            if reject_predicted is not None:
+                self._surrogate_pending[problem.get_model_key(x)] = (
+                    reject_predicted, thresholds)
+
+    def get_sample(self, problem, iiter, chains):
+        if not self.surrogate:
+            return SamplerPhase.get_sample(self, problem, iiter, chains)
+
+        thresholds = chains.acceptance_thresholds()
+        for itry in range(self.surrogate_ntries_limit):
+            x = SamplerPhase.get_sample(self, problem, iiter, chains)
+            reject_predicted = self.predict_rejection(x, thresholds)
+            if reject_predicted is None:
+                return x
+
+            if not reject_predicted or \
+                    num.random.random() < self.surrogate_audit_fraction:
+
+                self._surrogate_pending[problem.get_model_key(x)] = (
+                    reject_predicted, thresholds)
+
+                return x
+
+            self._surrogate_stats['ndiscarded'] += 1
+
+        return x
+
+    def get_report(self):
+        if not self.surrogate:
+            return None
+
+        stats = self._surrogate_stats
+        nresolved = stats['naccept_predicted'] + stats['nreject_predicted']
+        nhits = stats['naccept_predicted_ok'] \
+            + stats['nreject_predicted'] - stats['nreject_predicted_false']
+
+        return 'surrogate discarded %i candidates, hit rate %s, ' \
+            'false rejection rate %s (%i audited)' % (
+                stats['ndiscarded'],
+                '%.2f' % (nhits / nresolved) if nresolved else 'n/a',
+                '%.2f' % (
+                    stats['nreject_predicted_false']
+                    / stats['nreject_predicted'])
+                if stats['nreject_predicted'] else 'n/a',
+                stats['nreject_predicted'])
+
+    def update(self, problem, iiter, chains):
+        '''
+        Update the surrogate and tune the adaptive scatter scale.
+
+        The acceptance rate for the adaptive scatter scale is measured over
+        the models which were read into the chains since the last update.
+        '''
+
+        if self.surrogate:
+            self.update_surrogate(problem, chains)
+
+        if self.scatter_scale_mode != 'adaptive':
+            return
+
+        state = self._adaptive_state
+        if state is None or state[0] != id(chains) or state[1] > chains.nread \
+                or iiter == 0:
+
+            scale, _, _ = self.get_scatter_scale_limits()
+            self._adaptive_state = (
+                id(chains), chains.nread, chains.accept_sum.copy(), scale)
+            return
+
+        _, nread_last, accept_sum_last, scale = state
+        nnew = chains.nread - nread_last
+        if nnew == 0:
+            return
+
+        rate = num.mean(chains.accept_sum - accept_sum_last) / nnew
+        _, scale_min, scale_max = self.get_scatter_scale_limits()
+        scale = min(scale_max, max(scale_min, scale * math.exp(
+            self.scatter_scale_gain * (rate - self.acceptance_rate_target)
+            * nnew / 100.)))
+
+        logger.debug(
+            'adaptive scatter scale: acceptance rate %g, scale %g'
+            % (rate, scale))
+
+        self._adaptive_state = (
+            id(chains), chains.nread, chains.accept_sum.copy(), scale)
+
+    def get_scatter_scale_factor(self, iiter):
+        if self.scatter_scale_mode == 'adaptive':
+            if self._adaptive_state is None:
+                return self.get_scatter_scale_limits()[0]
+
+            return self._adaptive_state[3]
+
+        s = self.scatter_scale
+        sa, sb = self.get_scatter_scale_begin_end()
+
+        assert s is None or sa is None
 
         if sa != sb:
             tb = float(self.niterations-1)
@@ -150,6 +932,9 @@ class DirectedSamplerPhase(SamplerPhase):
             t = float(iiter)
             return num.exp(-(t-t0) / tau)
 
+        elif sa is not None:
+            return sa
+
         else:
             return s or 1.0
 
@@ -160,15 +945,13 @@ class DirectedSamplerPhase(SamplerPhase):
         pnames = problem.parameter_names
         xbounds = problem.get_parameter_bounds()
 
-        ichain_choice = num.argmin(chains.accept_sum)
+        ichain_choice, sx, probabilities, cov_factor = \
+            self.get_chains_state(chains)
 
         if self.starting_point == 'excentricity_compensated':
-            models = chains.models(ichain_choice)
-            ilink_choice = excentricity_compensated_choice(
-                models,
-                chains.standard_deviation_models(
-                    ichain_choice, self.standard_deviation_estimator),
-                2.)
+            r = num.random.random()
+            ilink_choice = num.searchsorted(num.cumsum(probabilities), r)
+            ilink_choice = min(ilink_choice, chains.nlinks-1)
 
             xchoice = chains.model(ichain_choice, ilink_choice)
 
@@ -183,56 +966,46 @@ class DirectedSamplerPhase(SamplerPhase):
             assert False, 'invalid starting_point choice: %s' % (
                 self.starting_point)
 
-        ntries_sample = 0
+        xchoice = problem.reset_solved_parameters(xchoice)
+
         if self.sampler_distribution == 'normal':
-            x = num.zeros(npar, dtype=num.float)
-            sx = chains.standard_deviation_models(
-                ichain_choice, self.standard_deviation_estimator)
-
-            for ipar in range(npar):
-                ntries = 0
-                while True:
-                    if sx[ipar] > 0.:
-                        v = num.random.normal(
-                            xchoice[ipar],
-                            factor*sx[ipar])
-                    else:
-                        v = xchoice[ipar]
-
-                    if xbounds[ipar, 0] <= v and \
-                            v <= xbounds[ipar, 1]:
-
-                        break
-
-                    if ntries > self.ntries_sample_limit:
-                        logger.warning(
-                            'failed to produce a suitable '
-                            'candidate sample from normal '
-                            'distribution for parameter \'%s\''
-                            '- drawing from uniform instead.' %
-                            pnames[ipar])
-                        v = num.random.uniform(xbounds[ipar, 0],
-                                               xbounds[ipar, 1])
-                        break
-
-                    ntries += 1
-
-                x[ipar] = v
+            x, ok = truncated_normal(
+                xchoice, factor*sx, xbounds[:, 0], xbounds[:, 1])
+
+            for ipar in num.where(~ok)[0]:
+                logger.warning(
+                    'failed to produce a suitable '
+                    'candidate sample from normal '
+                    'distribution for parameter \'%s\''
+                    '- drawing from uniform instead.' %
+                    pnames[ipar])
+                x[ipar] = num.random.uniform(
+                    xbounds[ipar, 0], xbounds[ipar, 1])
 
         elif self.sampler_distribution == 'multivariate_normal':
+            # rejection sampling, with candidates drawn in blocks of
+            # increasing size
             ok_mask_sum = num.zeros(npar, dtype=num.int)
+            ntries_sample = 0
+            nblock = 8
             while True:
-                ntries_sample += 1
-                xcandi = num.random.multivariate_normal(
-                    xchoice, factor**2 * chains.cov(ichain_choice))
+                nblock = min(nblock, self.ntries_sample_limit + 1 -
+                             ntries_sample)
+                xcandis = xchoice[num.newaxis, :] + factor * num.dot(
+                    num.random.normal(size=(nblock, npar)), cov_factor)
 
                 ok_mask = num.logical_and(
-                    xbounds[:, 0] <= xcandi, xcandi <= xbounds[:, 1])
+                    xbounds[num.newaxis, :, 0] <= xcandis,
+                    xcandis <= xbounds[num.newaxis, :, 1])
 
-                if num.all(ok_mask):
+                iok = num.where(num.all(ok_mask, axis=1))[0]
+                if iok.size != 0:
+                    xcandi = xcandis[iok[0], :]
                     break
 
-                ok_mask_sum += ok_mask
+                ok_mask_sum += num.sum(ok_mask, axis=0)
+                ntries_sample += nblock
+                nblock *= 2
 
                 if ntries_sample > self.ntries_sample_limit:
                     logger.warning(
@@ -250,27 +1023,263 @@ class DirectedSamplerPhase(SamplerPhase):
         return x
 
 
-def make_bayesian_weights(nbootstrap, nmisfits,
-                          type='bayesian', rstate=None):
-    ws = num.zeros((nbootstrap, nmisfits))
-    if rstate is None:
-        rstate = num.random.RandomState()
-
-    for ibootstrap in range(nbootstrap):
-        if type == 'classic':
-            ii = rstate.randint(0, nmisfits, size=nmisfits)
-            ws[ibootstrap, :] = num.histogram(
-                ii, nmisfits, (-0.5, nmisfits - 0.5))[0]
-        elif type == 'bayesian':
-            f = rstate.uniform(0., 1., size=nmisfits+1)
-            f[0] = 0.
-            f[-1] = 1.
-            f = num.sort(f)
-            g = f[1:] - f[:-1]
-            ws[ibootstrap, :] = g * nmisfits
-        else:
-            assert False
-    return ws
+class RefinementState(object):
+    '''
+    State of the pattern search around the best model of one chain.
+    '''
+
+    def __init__(self, ichain, x, misfit, step):
+        self.ichain = ichain
+        self.x = x
+        self.misfit = misfit
+        self.step = step
+        self.x_best = None
+        self.misfit_best = misfit
+        self.nqueued = 0
+        self.noutstanding = 0
+        self.polling = False
+
+
+class LocalRefinementSamplerPhase(SamplerPhase):
+    '''
+    Polish the best models of selected chains with a compass search.
+
+    Around the current best model of each selected chain, all parameters are
+    stepped up and down, one at a time. If one of these poll models improves
+    the misfit of the chain, the search moves there, otherwise the step size
+    is reduced. All evaluated models go to the model history and the chains
+    as usual. The phase ends when the step size of all searches has dropped
+    below `step_end`.
+    '''
+
+    ichains = List.T(
+        Int.T(),
+        default=[0],
+        help='Chains whose best models are refined: 0 is the chain of the '
+             'global misfit, 1 to nbootstrap are the bootstrap chains.')
+    step_begin = Float.T(
+        default=0.05,
+        help='Initial step size, relative to the parameter ranges.')
+    step_end = Float.T(
+        default=0.001,
+        help='Step size, relative to the parameter ranges, below which the '
+             'refinement is considered converged.')
+    step_factor = Float.T(
+        default=0.5,
+        help='Factor to reduce the step size after an unsuccessful poll.')
+
+    def __init__(self, *args, **kwargs):
+        SamplerPhase.__init__(self, *args, **kwargs)
+        self._states = None
+        self._queue = []
+        self._pending = {}
+        self._nchecked = 0
+
+    def init_states(self, problem, chains):
+        self._states = []
+        self._queue = []
+        self._pending = {}
+        self._nchecked = chains.nread
+        for ichain in self.ichains:
+            if not 0 <= ichain < chains.nchains:
+                raise GrondError(
+                    'LocalRefinementSamplerPhase: no chain with index %i'
+                    % ichain)
+
+            self._states.append(RefinementState(
+                ichain,
+                chains.best_model(ichain).copy(),
+                chains.best_model_misfit(ichain),
+                self.step_begin))
+
+    def update(self, problem, iiter, chains):
+        '''
+        Gather the misfits of evaluated poll models and advance the searches.
+        '''
+
+        if chains.nlinks == 0:
+            return
+
+        if self._states is None or iiter == 0 \
+                or self._nchecked > chains.nread:
+            self.init_states(problem, chains)
+
+        history = chains.history
+        models = history.models
+        gbmss = history.bootstrap_misfits
+        for imodel in range(self._nchecked, chains.nread):
+            istates = self._pending.get(
+                problem.get_model_key(models[imodel, :]), None)
+            if not istates:
+                continue
+
+            state = self._states[istates.pop(0)]
+            state.noutstanding -= 1
+            misfit = gbmss[imodel, state.ichain]
+            if misfit < state.misfit_best:
+                state.x_best = models[imodel, :].copy()
+                state.misfit_best = misfit
+
+        self._nchecked = chains.nread
+
+        for state in self._states:
+            if state.polling and state.nqueued == 0 \
+                    and state.noutstanding == 0:
+
+                if state.x_best is not None:
+                    state.x = state.x_best
+                    state.misfit = state.misfit_best
+                else:
+                    state.step *= self.step_factor
+
+                state.x_best = None
+                state.polling = False
+
+            misfit_chain = chains.best_model_misfit(state.ichain)
+            if not state.polling and misfit_chain < state.misfit:
+                state.x = chains.best_model(state.ichain).copy()
+                state.misfit = misfit_chain
+
+            state.misfit_best = min(state.misfit_best, state.misfit)
+
+    def check_convergence(self, problem, iiter, chains):
+        if self._states and all(
+                state.step < self.step_end for state in self._states):
+
+            return 'step size of all searches below %g after %i ' \
+                'iterations' % (self.step_end, iiter)
+
+        return None
+
+    def poll(self, problem):
+        '''
+        Queue the poll models of all searches which are not busy.
+        '''
+
+        xbounds = problem.get_parameter_bounds()
+        xranges = xbounds[:, 1] - xbounds[:, 0]
+        free = num.logical_and(
+            xranges > 0.,
+            num.logical_not(problem.get_solved_parameter_mask()))
+
+        for istate, state in enumerate(self._states):
+            if state.polling:
+                continue
+
+            for ipar in num.where(free)[0]:
+                for sign in (-1., 1.):
+                    x = state.x.copy()
+                    x[ipar] = num.clip(
+                        x[ipar] + sign * state.step * xranges[ipar],
+                        xbounds[ipar, 0], xbounds[ipar, 1])
+
+                    if x[ipar] != state.x[ipar]:
+                        self._queue.append((istate, x))
+                        state.nqueued += 1
+
+            state.polling = True
+
+    def get_probe(self, problem):
+        '''
+        Get next poll model or, if all searches wait for results, a random
+        model at the current step size around one of the search centres.
+        '''
+
+        if not self._queue:
+            self.poll(problem)
+
+        if self._queue:
+            istate, x = self._queue.pop(0)
+            self._states[istate].nqueued -= 1
+            return istate, x
+
+        xbounds = problem.get_parameter_bounds()
+        istate = num.random.randint(0, len(self._states))
+        state = self._states[istate]
+        direction = num.random.normal(size=problem.nparameters)
+        direction /= max(num.sqrt(num.sum(direction**2)), 1e-12)
+        x = num.clip(
+            state.x + state.step * (xbounds[:, 1] - xbounds[:, 0])
+            * direction,
+            xbounds[:, 0], xbounds[:, 1])
+
+        return istate, x
+
+    def replay_samples(self, problem, iiter, chains, xs):
+        '''
+        Restore the queue and the pending poll models from models in the
+        rundir.
+
+        The queue is consumed exactly as in :py:meth:`get_sample`. Models
+        which were drawn at random around a search centre are assigned to the
+        nearest centre.
+        '''
+
+        if chains.nlinks == 0:
+            return
+
+        if self._states is None:
+            self.init_states(problem, chains)
+
+        xbounds = problem.get_parameter_bounds()
+        xranges = xbounds[:, 1] - xbounds[:, 0]
+        xranges[xranges == 0.] = 1.
+        free = num.logical_not(problem.get_solved_parameter_mask())
+
+        for x in xs:
+            istate = None
+            for ntries_preconstrain in range(self.ntries_preconstrain_limit):
+                if not self._queue:
+                    self.poll(problem)
+
+                if not self._queue:
+                    break
+
+                istate_probe, x_probe = self._queue.pop(0)
+                self._states[istate_probe].nqueued -= 1
+                try:
+                    problem.preconstrain(
+                        problem.reset_solved_parameters(x_probe))
+                except Forbidden:
+                    continue
+
+                istate = istate_probe
+                break
+
+            if istate is None:
+                istate = num.argmin([
+                    num.sum(((x - state.x)[free] / xranges[free])**2)
+                    for state in self._states])
+
+            self._pending.setdefault(
+                problem.get_model_key(x), []).append(istate)
+            self._states[istate].noutstanding += 1
+
+    def get_sample(self, problem, iiter, chains):
+        assert 0 <= iiter < self.niterations
+
+        if chains.nlinks == 0:
+            return UniformSamplerPhase(niterations=1).get_sample(
+                problem, 0, chains)
+
+        if self._states is None:
+            self.init_states(problem, chains)
+
+        for ntries_preconstrain in range(self.ntries_preconstrain_limit):
+            istate, x = self.get_probe(problem)
+            try:
+                x = problem.preconstrain(problem.reset_solved_parameters(x))
+            except Forbidden:
+                continue
+
+            self._pending.setdefault(
+                problem.get_model_key(x), []).append(istate)
+            self._states[istate].noutstanding += 1
+            return x
+
+        raise GrondError(
+            'could not find any suitable candidate sample within %i tries' % (
+                self.ntries_preconstrain_limit))
 
 
 class Chains(object):
@@ -296,6 +1305,72 @@ class Chains(object):
         self.nread = 0
         history.add_listener(self)
 
+    def _bisect(self, gbms):
+        '''
+        Find insertion positions of new misfits in all chains at once.
+
+        Equal misfits are placed behind existing links, NaN goes last.
+        '''
+
+        nlinks = self.nlinks
+        ichains = num.arange(self.nchains)
+        ilo = num.zeros(self.nchains, dtype=num.int)
+        ihi = num.full(self.nchains, nlinks, dtype=num.int)
+        isnan = num.isnan(gbms)
+        while True:
+            active = ilo < ihi
+            if not num.any(active):
+                return ilo
+
+            imid = (ilo + ihi) // 2
+            m_mid = self.chains_m[ichains, num.minimum(imid, nlinks-1)]
+            right = active & ((m_mid <= gbms) | isnan)
+            ilo = num.where(right, imid + 1, ilo)
+            ihi = num.where(active & ~right, imid, ihi)
+
+    def _insert(self, gbms, imodel):
+        '''
+        Insert a new model into all chains, evicting the worst link if full.
+
+        :returns: boolean array, which chains accepted the model
+        '''
+
+        nlinks = self.nlinks
+        ipos = self._bisect(gbms)
+
+        if nlinks + 1 == self.nlinks_cap:
+            accept = ipos < nlinks
+        else:
+            accept = num.ones(self.nchains, dtype=num.bool)
+
+        if num.any(accept):
+            ichains = num.where(accept)[0]
+            ipos = ipos[ichains]
+            jfirst = int(num.min(ipos))
+            jj = num.arange(jfirst, nlinks + 1)[num.newaxis, :]
+            ii = ipos[:, num.newaxis]
+            jsrc = num.maximum(num.where(jj < ii, jj, jj - 1), 0)
+            at = jj == ii
+            ic = ichains[:, num.newaxis]
+
+            self.chains_m[ic, jj] = num.where(
+                at, gbms[ic], self.chains_m[ic, jsrc])
+            self.chains_i[ic, jj] = num.where(
+                at, imodel, self.chains_i[ic, jsrc])
+
+        if nlinks + 1 < self.nlinks_cap:
+            self.nlinks += 1
+
+        return accept
+
+    def _log_accept(self, accept):
+        n = accept.shape[0]
+        iaccept = (self.nread + num.arange(n)) % self.accept_log_len
+        nlog = min(n, self.accept_log_len)
+        self.accept_log[:, iaccept[-nlog:]] = accept[-nlog:, :].T
+        self.accept_sum += num.sum(accept, axis=0)
+        self.nread += n
+
     def goto(self, n=None):
         if n is None:
             n = self.history.nmodels
@@ -304,36 +1379,44 @@ class Chains(object):
 
         assert self.nread <= n
 
-        while self.nread < n:
+        while self.nread < n and self.nlinks + 1 < self.nlinks_cap:
             gbms = self.history.bootstrap_misfits[self.nread, :]
+            accept = self._insert(gbms, self.nread)
+            self._log_accept(accept[num.newaxis, :])
+
+        if self.nread < n:
+            # Chains are full: the worst misfit in each chain can only
+            # decrease, so models not better than it now are rejected also
+            # after inserting the rest of the block.
+            gbmss = self.history.bootstrap_misfits[self.nread:n, :]
+            if self.nlinks > 0:
+                candidates = gbmss < self.chains_m[:, self.nlinks-1]
+            else:
+                candidates = num.zeros(gbmss.shape, dtype=num.bool)
 
-            self.chains_m[:, self.nlinks] = gbms
-            self.chains_i[:, self.nlinks] = n-1
-            nbootstrap = self.chains_m.shape[0]
+            accept = num.zeros(gbmss.shape, dtype=num.bool)
+            for i in num.where(num.any(candidates, axis=1))[0]:
+                accept[i, :] = self._insert(gbmss[i, :], self.nread + i)
 
-            self.nlinks += 1
-            chains_m = self.chains_m
-            chains_i = self.chains_i
-
-            for ichain in range(nbootstrap):
-                isort = num.argsort(chains_m[ichain, :self.nlinks])
-                chains_m[ichain, :self.nlinks] = chains_m[ichain, isort]
-                chains_i[ichain, :self.nlinks] = chains_i[ichain, isort]
-
-            if self.nlinks == self.nlinks_cap:
-                accept = (chains_i[:, self.nlinks_cap-1] != n-1) \
-                    .astype(num.bool)
-                self.nlinks -= 1
-            else:
-                accept = num.ones(self.nchains, dtype=num.bool)
-            self.accept_log[:, n % self.accept_log_len] = accept
-            self.accept_sum += accept
-            self.nread += 1
+            self._log_accept(accept)
 
     @property
     def acceptance_rate(self):
         return self.accept_log.sum(axis=1) / self.accept_log_len
 
+    def acceptance_thresholds(self):
+        '''
+        Get the misfit a new model must beat to be accepted, for each chain.
+
+        As long as the chains are not full, any model is accepted and the
+        thresholds are infinite.
+        '''
+
+        if self.nlinks > 0 and self.nlinks + 1 == self.nlinks_cap:
+            return self.chains_m[:, self.nlinks-1].copy()
+        else:
+            return num.full(self.nchains, num.inf)
+
     def append(self, iiter, model, misfits):
         self.goto(iiter)
 
@@ -388,6 +1471,61 @@ class Chains(object):
         return num.cov(xs.T)
 
 
+class EarlyRejection(object):
+    '''
+    Rejection test for staged misfit evaluation.
+
+    A model is rejected as soon as a lower bound of its global and all of its
+    bootstrap misfits is not below the acceptance thresholds of the chains.
+    The bound is obtained by summing only the contributions of the targets
+    evaluated so far. As the normalisation of not yet evaluated targets is
+    unknown, it is taken from a reference model. The bound is strict when the
+    normalisation contributions do not depend on the model.
+
+    The misfit contributions of the targets skipped on rejection are set to
+    infinity, to mark the model as rejected. The optimiser records the
+    skipped contributions as NaN and flags the model in the ``rejected``
+    attribute of the model history. When the rundir is loaded, the skipped
+    contributions of flagged models are set to infinity again.
+    '''
+
+    def __init__(
+            self, problem, bootstrap_weights, bootstrap_residuals,
+            thresholds, misfits_ref):
+
+        self.problem = problem
+        self.bootstrap_weights = bootstrap_weights
+        self.bootstrap_residuals = bootstrap_residuals
+        self.thresholds = thresholds
+        self.misfits_ref = misfits_ref
+
+    def __call__(self, misfits, evaluated):
+        if num.all(num.isinf(self.thresholds)):
+            return None
+
+        _, root = self.problem.get_norm_functions()
+
+        pending = num.logical_not(evaluated)
+        misfits = misfits.copy()
+        misfits[pending, 0] = 0.0
+        misfits[pending, 1] = self.misfits_ref[pending, 1]
+
+        contributions = self.problem.combine_misfits(
+            misfits,
+            extra_weights=self.bootstrap_weights,
+            extra_residuals=self.bootstrap_residuals,
+            get_contributions=True)
+
+        bounds = root(num.nansum(contributions[:, evaluated], axis=1))
+        if num.all(bounds >= self.thresholds):
+            misfits[pending, 0] = num.inf
+            isnan = pending & num.isnan(self.misfits_ref[:, 0])
+            misfits[isnan, :] = num.nan
+            return misfits
+
+        return None
+
+
 class HighScoreOptimiser(Optimiser):
     '''Monte-Carlo-based directed search optimisation with bootstrap.'''
 
@@ -396,103 +1534,91 @@ class HighScoreOptimiser(Optimiser):
     nbootstrap = Int.T(default=100)
     bootstrap_type = BootstrapTypeChoice.T(default='bayesian')
     bootstrap_seed = Int.T(default=23)
+    early_rejection = Bool.T(default=False)
+    early_rejection_nstages = Int.T(default=4)
+
+    checkpoint_interval = 10.
 
     def __init__(self, **kwargs):
         Optimiser.__init__(self, **kwargs)
-        self._bootstrap_weights = None
-        self._bootstrap_residuals = None
         self._status_chains = None
+        self._misfits_ref = None
+        self._early_rejection = False
+        self._rejected = []
+        self._phase_records = []
+        self._random_states = {}
         self.rstate = num.random.RandomState(self.bootstrap_seed)
 
-    def init_bootstraps(self, problem):
-        self.init_bootstrap_weights(problem)
-        self.init_bootstrap_residuals(problem)
-
-    def init_bootstrap_weights(self, problem):
-        logger.info('Initializing Bayesian bootstrap weights')
-        bootstrap_targets = set([t for t in problem.targets
-                                 if t.can_bootstrap_weights])
-
-        ws = make_bayesian_weights(
-            self.nbootstrap,
-            nmisfits=problem.nmisfits,
-            rstate=self.rstate)
-
-        imf = 0
-        for it, t in enumerate(bootstrap_targets):
-            t.set_bootstrap_weights(ws[:, imf:imf+t.nmisfits])
-            imf += t.nmisfits
-
-        for t in set(problem.targets) - bootstrap_targets:
-            t.set_bootstrap_weights(
-                num.ones((self.nbootstrap, t.nmisfits)))
-
-    def init_bootstrap_residuals(self, problem):
-        logger.info('Initializing Bayesian bootstrap residuals')
-        residual_targets = set([t for t in problem.targets
-                                if t.can_bootstrap_residuals])
+    def chains(self, problem, history):
+        nlinks_cap = int(round(
+            self.chain_length_factor * problem.nparameters + 1))
 
-        for t in residual_targets:
-            t.init_bootstrap_residuals(self.nbootstrap, rstate=self.rstate)
+        return Chains(
+            problem, history,
+            nchains=self.nchains, nlinks_cap=nlinks_cap)
 
-        for t in set(problem.targets) - residual_targets:
-            t.set_bootstrap_residuals(num.zeros((self.nbootstrap, t.nmisfits)))
+    def locate_sampler_phase(self, iiter):
+        '''
+        Get index of sampler phase and iteration within the phase.
 
-    def get_bootstrap_weights(self, problem):
-        if self._bootstrap_weights is None:
-            try:
-                problem.targets[0].get_bootstrap_weights()
-            except Exception:
-                self.init_bootstraps(problem)
+        Phases which have been ended early are taken into account.
 
-            bootstrap_weights = num.hstack(
-                [t.get_bootstrap_weights()
-                 for t in problem.targets])
+        :returns: tuple ``(iphase, iiter_phase)`` or ``None`` if *iiter* is
+            beyond the last phase
+        '''
 
-            self._bootstrap_weights = num.vstack((
-                num.ones((1, problem.nmisfits)),
-                bootstrap_weights))
+        iiter_begin = 0
+        for iphase, phase in enumerate(self.sampler_phases):
+            iiter_end = iiter_begin + phase.niterations
+            if iphase < len(self._phase_records):
+                record = self._phase_records[iphase]
+                iiter_begin = record.iiter_begin
+                if record.iiter_end is not None:
+                    iiter_end = record.iiter_end
+                else:
+                    iiter_end = iiter_begin + phase.niterations
 
-        return self._bootstrap_weights
+            if iiter < iiter_end:
+                return iphase, iiter - iiter_begin
 
-    def get_bootstrap_residuals(self, problem):
-        if self._bootstrap_residuals is None:
-            try:
-                problem.targets[0].get_bootstrap_residuals()
-            except Exception:
-                self.init_bootstraps(problem)
+            iiter_begin = iiter_end
 
-            bootstrap_residuals = num.hstack(
-                [t.get_bootstrap_residuals()
-                 for t in problem.targets])
+        return None
 
-            self._bootstrap_residuals = num.vstack((
-                num.zeros((1, problem.nmisfits)),
-                bootstrap_residuals))
+    def get_sampler_phase(self, iiter):
+        located = self.locate_sampler_phase(iiter)
+        assert located is not None, 'sample out of bounds'
+        iphase, iiter_phase = located
+        return self.sampler_phases[iphase], iiter_phase
 
-        return self._bootstrap_residuals
+    def get_phase_record(self, iphase):
+        records = self._phase_records
+        while len(records) <= iphase:
+            if records and records[-1].iiter_end is None:
+                records[-1].iiter_end = records[-1].iiter_begin \
+                    + self.sampler_phases[len(records)-1].niterations
 
-    @property
-    def nchains(self):
-        return self.nbootstrap + 1
+            records.append(SamplerPhaseRecord(
+                phase=self.sampler_phases[len(records)].__class__.__name__,
+                iiter_begin=records[-1].iiter_end if records else 0))
 
-    def chains(self, problem, history):
-        nlinks_cap = int(round(
-            self.chain_length_factor * problem.nparameters + 1))
+        return records[iphase]
 
-        return Chains(
-            problem, history,
-            nchains=self.nchains, nlinks_cap=nlinks_cap)
+    def set_phase_records(self, records, nmodels):
+        '''
+        Restore sampler phase records, as seen after *nmodels* iterations.
+        '''
 
-    def get_sampler_phase(self, iiter):
-        niter = 0
-        for phase in self.sampler_phases:
-            if iiter < niter + phase.niterations:
-                return phase, iiter - niter
+        self._phase_records = []
+        for record in records:
+            if record.iiter_begin > nmodels:
+                break
 
-            niter += phase.niterations
+            if record.iiter_end is not None and record.iiter_end > nmodels:
+                record.iiter_end = None
+                record.termination = None
 
-        assert False, 'sample out of bounds'
+            self._phase_records.append(record)
 
     def log_progress(self, problem, iiter, niter, phase, iiter_phase):
         t = time.time()
@@ -508,62 +1634,330 @@ class HighScoreOptimiser(Optimiser):
 
             self._tlog_last = t
 
-    def optimise(self, problem, rundir=None):
+    def get_rejection(self, chains):
+        if not self._early_rejection or self._misfits_ref is None:
+            return None
 
-        if rundir is not None:
-            self.dump(filename=op.join(rundir, 'optimiser.yaml'))
-
-        history = ModelHistory(problem,
-                               nchains=self.nchains,
-                               path=rundir, mode='w')
-        chains = self.chains(problem, history)
+        return chains.acceptance_thresholds(), self._misfits_ref
 
+    def iter_samples(self, problem, chains, iiter_start=0):
         niter = self.niterations
-        isbad_mask = None
-        self._tlog_last = 0
-        for iiter in range(niter):
-            phase, iiter_phase = self.get_sampler_phase(iiter)
-            self.log_progress(problem, iiter, niter, phase, iiter_phase)
+        iiter = iiter_start
+        while True:
+            located = self.locate_sampler_phase(iiter)
+            if located is None:
+                break
+
+            iphase, iiter_phase = located
+            phase = self.sampler_phases[iphase]
+            record = self.get_phase_record(iphase)
+
+            phase.update(problem, iiter_phase, chains)
+            termination = phase.check_convergence(problem, iiter_phase, chains)
+            if termination is not None:
+                logger.info('%s: ending %s at %i/%i, %s' % (
+                    problem.name, phase.__class__.__name__, iiter, niter,
+                    termination))
+
+                record.iiter_end = iiter
+                record.termination = termination
+                continue
 
-            x = phase.get_sample(problem, iiter_phase, chains)
+            self.log_progress(problem, iiter, niter, phase, iiter_phase)
 
-            if isbad_mask is not None and num.any(isbad_mask):
-                isok_mask = num.logical_not(isbad_mask)
-            else:
-                isok_mask = None
+            nsamples = min(phase.nbatch, phase.niterations - iiter_phase)
+            self._random_states[iiter] = num.random.get_state()
+            xs = phase.get_samples(problem, iiter_phase, chains, nsamples)
+
+            yield iiter, xs, self.get_isok_mask(problem), \
+                self.get_rejection(chains)
+
+            iiter += nsamples
+
+        if self.sampler_phases:
+            record = self.get_phase_record(len(self.sampler_phases) - 1)
+            if record.iiter_end is None:
+                record.iiter_end = iiter
+
+    def replay(self, problem, chains, nmodels):
+        '''
+        Bring chains and the current sampler phase up to *nmodels*.
+
+        The models of the current phase are fed to the chains in the same
+        steps as during sampling, so that the phase sees the same sequence
+        of chain states as in the interrupted run and can restore the
+        bookkeeping of its samples.
+        '''
+
+        located = self.locate_sampler_phase(nmodels)
+        if located is not None:
+            iphase, iiter_phase = located
+            phase = self.sampler_phases[iphase]
+            iiter_begin = nmodels - iiter_phase
+            for iiter in range(iiter_begin, nmodels, phase.nbatch):
+                chains.goto(iiter)
+                phase.update(problem, iiter - iiter_begin, chains)
+                phase.check_convergence(problem, iiter - iiter_begin, chains)
+                phase.replay_samples(
+                    problem, iiter - iiter_begin, chains,
+                    chains.history.models[
+                        iiter:min(iiter + phase.nbatch, nmodels)])
+
+        chains.goto(nmodels)
+
+    def get_checkpoint(self, nmodels):
+        '''
+        Get checkpoint at *nmodels* models.
+
+        With several workers, samples are drawn ahead of the models written
+        to the history, so the random state is taken from before the sample
+        at *nmodels* was drawn.
+        '''
+
+        return HighScoreOptimiserCheckpoint.capture(
+            nmodels,
+            random_state=self._random_states.get(nmodels),
+            phase_records=copy.deepcopy(self._phase_records))
+
+    def open_history(self, problem, rundir):
+        '''
+        Reopen the model history of an interrupted run for appending.
+
+        Models written after the last checkpoint are discarded, so that the
+        run continues from the random state stored with the checkpoint.
+        '''
+
+        checkpoint = load_checkpoint(rundir)
+        nmodels = truncate_problem_data(
+            rundir, problem,
+            nmodels=checkpoint.nmodels if checkpoint else None,
+            nchains=self.nchains)
+
+        if checkpoint is not None and checkpoint.nmodels == nmodels:
+            checkpoint.restore_random_state()
+            self.set_phase_records(checkpoint.phase_records, nmodels)
+        else:
+            logger.warning(
+                'problem %s: no usable checkpoint found in rundir, '
+                'continuing with new random state' % problem.name)
+
+        history = ModelHistory(
+            problem, nchains=self.nchains, path=rundir, mode='a')
+
+        if history.nmodels != 0 and history.bootstrap_misfits is None:
+            raise GrondError(
+                'cannot resume: no bootstrap misfits found in rundir %s'
+                % rundir)
+
+        logger.info(
+            'problem %s: resuming at iteration %i/%i' % (
+                problem.name, history.nmodels, self.niterations))
+
+        return history
+
+    def optimise(self, problem, rundir=None, nworkers=1, resume=False):
+        '''
+        Run the optimisation.
+
+        :param problem: :py:class:`grond.Problem` instance
+        :param rundir: path to rundir, defaults to None
+        :param nworkers: number of worker processes to compute the misfits
+            of candidate models in parallel. The samples are drawn and the
+            model history and chains are kept by the calling process. With
+            more than one worker, up to *nworkers* batches of candidates are
+            in flight at any time, so new samples are drawn from slightly
+            outdated chains. Which results are available when a sample is
+            drawn depends on timing, so such runs are not reproducible.
+        :param resume: continue an interrupted run from the models and
+            checkpoint found in *rundir*. With a single worker, the resumed
+            run produces the same models as an uninterrupted one. With more
+            workers, it continues from the random state at the checkpoint,
+            but with up to date chains, so it takes a different course.
+        '''
+
+        if resume:
+            history = self.open_history(problem, rundir)
+        else:
+            if rundir is not None:
+                self.dump(filename=op.join(rundir, 'optimiser.yaml'))
 
-            misfits = problem.misfits(x, mask=isok_mask)
-            bootstrap_misfits = problem.combine_misfits(
-                misfits,
-                extra_weights=self.get_bootstrap_weights(problem),
-                extra_residuals=self.get_bootstrap_residuals(problem))
+            history = ModelHistory(problem,
+                                   nchains=self.nchains,
+                                   path=rundir, mode='w')
 
-            isbad_mask_new = num.isnan(misfits[:, 0])
-            if isbad_mask is not None and num.any(
-                    isbad_mask != isbad_mask_new):
+        chains = self.chains(problem, history)
+        if resume:
+            self.replay(problem, chains, history.nmodels)
+        else:
+            self._phase_records = []
 
-                errmess = [
-                    'problem %s: inconsistency in data availability'
-                    ' at iteration %i' %
-                    (problem.name, iiter)]
+        self._random_states = {}
+        self._rejected = [self.load_rejected(history)]
+        self._isbad_mask = None
+        self._misfits_ref = None
+        if history.nmodels != 0:
+            icomplete = num.where(num.logical_not(self._rejected[0]))[0]
+            ilast = icomplete[-1] if icomplete.size else -1
+            self._isbad_mask = num.logical_or(
+                num.isnan(history.misfits[ilast, :, 0]),
+                problem.get_misfit_mask(problem.get_prunable_mask()))
+            self.update_misfits_ref(history.misfits, self._rejected[0])
 
-                for target, isbad_new, isbad in zip(
-                        problem.targets, isbad_mask_new, isbad_mask):
+        bootstrap_weights = self.get_bootstrap_weights(problem)
+        bootstrap_residuals = self.get_bootstrap_residuals(problem)
 
-                    if isbad_new != isbad:
-                        errmess.append('  %s, %s -> %s' % (
-                            target.string_id(), isbad, isbad_new))
+        self.log_pruning(problem)
 
-                raise BadProblem('\n'.join(errmess))
+        self._early_rejection = self.early_rejection
+        if self.early_rejection and problem.norm_exponent != 2:
+            logger.warning(
+                'problem %s: early rejection is only available with '
+                'norm_exponent 2, disabling it' % problem.name)
 
-            isbad_mask = isbad_mask_new
+            self._early_rejection = False
 
-            if num.all(isbad_mask):
-                raise BadProblem(
-                    'problem %s: all target misfit values are NaN'
-                    % problem.name)
+        nevaluated = 0
+        nrejected = 0
+        nskipped = 0
 
-            history.append(x, misfits, bootstrap_misfits)
+        self._tlog_last = 0
+        tcheckpoint_last = time.time()
+
+        try:
+            for iiter, xs, misfits in self.evaluate_samples_parallel(
+                    problem,
+                    self.iter_samples(problem, chains, history.nmodels),
+                    nworkers):
+
+                for isample in range(xs.shape[0]):
+                    self.check_misfits(
+                        problem, iiter+isample, misfits[isample, :, :])
+
+                bootstrap_misfits = problem.combine_misfits(
+                    misfits,
+                    extra_weights=bootstrap_weights,
+                    extra_residuals=bootstrap_residuals)
+
+                skipped = num.isinf(misfits[:, :, 0])
+                rejected = num.any(skipped, axis=1)
+                if num.any(rejected):
+                    # misfits of early rejected models are unknown, they can
+                    # not enter the chains, which are full at that stage
+                    misfits[skipped, :] = num.nan
+                    bootstrap_misfits[rejected, :] = num.nan
+
+                history.extend(xs, misfits, bootstrap_misfits)
+                self._rejected.append(rejected)
+
+                for iiter_drawn in list(self._random_states.keys()):
+                    if iiter_drawn < history.nmodels:
+                        del self._random_states[iiter_drawn]
+
+                if self._early_rejection:
+                    nevaluated += xs.shape[0]
+                    nrejected += num.sum(rejected)
+                    nskipped += num.sum(skipped)
+                    self.update_misfits_ref(misfits, rejected)
+
+                t = time.time()
+                if rundir is not None \
+                        and t - tcheckpoint_last > self.checkpoint_interval:
+
+                    history.flush()
+                    self.dump_rejected(history)
+                    dump_checkpoint(
+                        self.get_checkpoint(history.nmodels), rundir)
+
+                    tcheckpoint_last = t
+
+            if rundir is not None:
+                history.flush()
+                self.dump_rejected(history)
+                dump_checkpoint(self.get_checkpoint(history.nmodels), rundir)
+
+            if self._early_rejection:
+                self.log_early_rejection(
+                    problem, nevaluated, nrejected, nskipped)
+
+            for phase in self.sampler_phases:
+                report = phase.get_report()
+                if report is not None:
+                    logger.info('problem %s: %s: %s' % (
+                        problem.name, phase.__class__.__name__, report))
+
+            self.log_cache_statistics(problem)
+
+        finally:
+            history.close()
+
+    def evaluate_models(self, problem, xs, mask=None, rejection=None):
+        '''
+        Compute misfits for a batch of models, allowing early rejection.
+
+        :param rejection: if given, tuple ``(thresholds, misfits_ref)``, see
+            :py:class:`EarlyRejection`
+        '''
+
+        if rejection is None:
+            return problem.misfits_many(xs, mask=mask)
+
+        thresholds, misfits_ref = rejection
+        reject = EarlyRejection(
+            problem,
+            self.get_bootstrap_weights(problem),
+            self.get_bootstrap_residuals(problem),
+            thresholds, misfits_ref)
+
+        return problem.misfits_many(
+            xs, mask=mask, reject=reject,
+            nstages=self.early_rejection_nstages)
+
+    def update_misfits_ref(self, misfits, rejected):
+        '''
+        Keep the last completely evaluated model as reference for the
+        normalisation of targets skipped by early rejection.
+        '''
+
+        complete = num.logical_not(rejected)
+        if num.any(complete):
+            self._misfits_ref = misfits[num.where(complete)[0][-1], :, :]
+
+    def load_rejected(self, history):
+        '''
+        Get flags of the models rejected early, as recorded in the rundir.
+
+        Models beyond the recorded flags are taken as completely evaluated.
+
+        :returns: boolean array ``rejected[imodel]``
+        '''
+
+        rejected = num.zeros(history.nmodels, dtype=num.bool)
+        if history.path is not None \
+                and 'rejected' in history.attribute_names:
+
+            fn = op.join(history.path, 'attributes', 'rejected')
+            flags = num.fromfile(fn, dtype='<i4', count=history.nmodels)
+            rejected[:flags.size] = flags != 0
+
+        return rejected
+
+    def dump_rejected(self, history):
+        '''
+        Record which models have been rejected early, as model attribute
+        ``rejected`` in the rundir.
+        '''
+
+        rejected = num.concatenate(self._rejected)
+        self._rejected = [rejected]
+        if num.any(rejected) or 'rejected' in history.attribute_names:
+            history.set_attribute('rejected', rejected)
+
+    def log_early_rejection(self, problem, nevaluated, nrejected, nskipped):
+        logger.info(
+            'problem %s: early rejection of %i of %i models, '
+            'skipped %.1f%% of misfit evaluations' % (
+                problem.name, nrejected, nevaluated,
+                100. * nskipped / max(1, nevaluated * problem.nmisfits)))
 
     @property
     def niterations(self):
@@ -659,12 +2053,22 @@ class HighScoreOptimiserConfig(OptimiserConfig):
         default=100,
         help='Number of bootstrap realisations to be tracked simultaneously in'
              ' the optimisation.')
+    early_rejection = Bool.T(
+        default=False,
+        help='Evaluate targets in stages and stop as soon as a candidate '
+             'model cannot be accepted into any of the chains anymore.')
+    early_rejection_nstages = Int.T(
+        default=4,
+        help='Number of target groups for the staged evaluation used with '
+             'early_rejection.')
 
     def get_optimiser(self):
         return HighScoreOptimiser(
             sampler_phases=list(self.sampler_phases),
             chain_length_factor=self.chain_length_factor,
-            nbootstrap=self.nbootstrap)
+            nbootstrap=self.nbootstrap,
+            early_rejection=self.early_rejection,
+            early_rejection_nstages=self.early_rejection_nstages)
 
 
 def load_optimiser_history(dirname, problem):
@@ -692,10 +2096,16 @@ def load_optimiser_history(dirname, problem):
 __all__ = '''
     SamplerDistributionChoice
     StandardDeviationEstimatorChoice
+    UniformSequenceChoice
+    ScatterScaleModeChoice
     SamplerPhase
     InjectionSamplerPhase
+    WarmStartSamplerPhase
     UniformSamplerPhase
     DirectedSamplerPhase
+    LocalRefinementSamplerPhase
+    SamplerPhaseRecord
+    HighScoreOptimiserCheckpoint
     Chains
     HighScoreOptimiserConfig
     HighScoreOptimiser
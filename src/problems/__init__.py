@@ -6,3 +6,4 @@ from .base import *  # noqa
 from .cmt.problem import *  # noqa
 from .rectangular.problem import *  # noqa
 from .double_dc.problem import *  # noqa
+from .history_file import *  # noqa
@@ -18,8 +18,9 @@ from pyrocko.guts import Object, String, List, Dict, Int
 
 from grond.meta import ADict, Parameter, GrondError, xjoin, Forbidden, \
     StringID, has_get_plot_classes
-from ..targets import MisfitResult, MisfitTarget, TargetGroup, \
-    WaveformMisfitTarget, SatelliteMisfitTarget, GNSSCampaignMisfitTarget
+from ..targets import MisfitResult, SparseMisfitResult, MisfitTarget, \
+    TargetGroup, WaveformMisfitTarget, SatelliteMisfitTarget, \
+    GNSSCampaignMisfitTarget
 
 from grond.version import __version__
 
@@ -34,6 +35,243 @@ def nextpow2(i):
     return 2**int(math.ceil(math.log(i)/math.log(2.)))
 
 
+class MisfitCombiner(object):
+    '''
+    Combination of misfit contributions to global or bootstrap misfits.
+
+    Everything which depends only on the problem setup (target weights,
+    normalisation family indices, norm functions) is prepared once, so that
+    repeated calls only do the arithmetic. The operations and their order
+    are the same as in the straightforward implementation, so the results
+    are bit-identical. Use :py:meth:`Problem.get_misfit_combiner` to get the
+    combiner of a problem.
+
+    Large sets of models are processed in blocks, so that the temporary
+    arrays stay within a memory budget of :py:attr:`memory_limit` bytes.
+    '''
+
+    # Default memory budget for temporary arrays [bytes].
+    memory_limit = 512 * 1024**2
+
+    # Number of temporary arrays of the size of the contributions alive at
+    # the same time while combining.
+    ntemporaries = 4
+
+    def __init__(self, problem):
+        self.norm_exponent = problem.norm_exponent
+        self.target_weights = problem.get_target_weights()
+        self.family_mask = problem.get_family_mask()
+        self.family, nfamilies = self.family_mask
+
+        if self.norm_exponent == 2:
+            self._exp = num.square
+            self._root = num.sqrt
+        elif self.norm_exponent == 1:
+            self._exp = None
+            self._root = num.abs
+        else:
+            problem.raise_invalid_norm_exponent()
+
+        # families occupying a contiguous range of misfits are selected by
+        # slicing, others by index arrays
+        self.family_indices = []
+        for ifamily in range(nfamilies):
+            indices = num.where(self.family == ifamily)[0]
+            if indices[-1] - indices[0] + 1 == indices.size:
+                indices = slice(indices[0], indices[-1] + 1)
+
+            self.family_indices.append(indices)
+
+        self._extra_weights = None
+        self._extra_target_weights = None
+
+    def is_valid_for(self, problem):
+        '''
+        Check if the combiner is up to date with the setup of *problem*.
+        '''
+        return self.norm_exponent == problem.norm_exponent \
+            and self.target_weights is problem.get_target_weights() \
+            and self.family_mask is problem.get_family_mask()
+
+    def exp(self, x):
+        '''
+        Apply the norm's power to a temporary array, in place.
+        '''
+        if self._exp is not None:
+            self._exp(x, out=x)
+
+        return x
+
+    def nansum(self, x, axis):
+        '''
+        Same as :py:func:`numpy.nansum` but replaces NaNs in place.
+
+        Sums are always accumulated in double precision.
+        '''
+        isnan = num.isnan(x)
+        if isnan.any():
+            x[isnan] = 0.0
+
+        if x.dtype != num.float64:
+            return x.sum(axis=axis, dtype=num.float64)
+
+        return x.sum(axis=axis)
+
+    def get_extra_target_weights(self, extra_weights):
+        if extra_weights is not self._extra_weights:
+            self._extra_target_weights = \
+                extra_weights[num.newaxis, :, :] \
+                * self.target_weights[num.newaxis, num.newaxis, :]
+            self._extra_weights = extra_weights
+
+        return self._extra_target_weights
+
+    def inter_family_weights2(self, ns):
+        '''
+        :param ns: 2D array with normalization factors ``ns[imodel, itarget]``
+        :returns: 2D array ``weights[imodel, itarget]``
+        '''
+
+        fws = num.empty((ns.shape[0], len(self.family_indices)))
+        for ifamily, indices in enumerate(self.family_indices):
+            fws[:, ifamily] = 1.0 / self._root(
+                self.nansum(self.exp(num.array(ns[:, indices])), axis=1))
+
+        return fws[:, self.family]
+
+    def get_block_size(
+            self, misfits, extra_weights, extra_residuals,
+            memory_limit=None, single_precision=False):
+
+        '''
+        Get number of models to be combined at once within the memory budget.
+        '''
+
+        if memory_limit is None:
+            memory_limit = self.memory_limit
+
+        nextra = 1
+        for extra in (extra_weights, extra_residuals):
+            if extra is not None:
+                nextra = extra.shape[0]
+
+        itemsize = 4 if single_precision else 8
+        nbytes_model = self.ntemporaries * nextra * misfits.shape[1] \
+            * itemsize
+
+        return max(1, int(memory_limit // nbytes_model))
+
+    def combine(
+            self, misfits,
+            extra_weights=None,
+            extra_residuals=None,
+            get_contributions=False,
+            memory_limit=None,
+            single_precision=False):
+
+        '''
+        Combine misfit contributions, see :py:meth:`Problem.combine_misfits`.
+
+        :param memory_limit: budget for temporary arrays [bytes], defaults
+            to :py:attr:`memory_limit`. Models are combined in blocks small
+            enough to meet the budget. The results do not depend on the
+            block size.
+        :param single_precision: compute the weighted contributions in single
+            precision, halving the memory needed per model. Sums are still
+            accumulated in double precision, but results are then only
+            accurate to about single precision.
+        '''
+
+        if misfits.ndim == 2:
+            misfits = misfits[num.newaxis, :, :]
+            return self.combine(
+                misfits,
+                extra_weights,
+                extra_residuals,
+                get_contributions,
+                memory_limit,
+                single_precision)[0, ...]
+
+        assert misfits.ndim == 3
+        assert extra_weights is None or extra_weights.ndim == 2
+        assert extra_residuals is None or extra_residuals.ndim == 2
+
+        nmodels = misfits.shape[0]
+        nblock = self.get_block_size(
+            misfits, extra_weights, extra_residuals,
+            memory_limit, single_precision)
+
+        if nblock >= nmodels:
+            return self.combine_block(
+                misfits, extra_weights, extra_residuals, get_contributions,
+                single_precision)
+
+        result = None
+        for imodel in range(0, nmodels, nblock):
+            result_block = self.combine_block(
+                misfits[imodel:imodel+nblock],
+                extra_weights, extra_residuals, get_contributions,
+                single_precision)
+
+            if result is None:
+                result = num.empty(
+                    (nmodels,) + result_block.shape[1:],
+                    dtype=result_block.dtype)
+
+            result[imodel:imodel+nblock] = result_block
+
+        return result
+
+    def combine_block(
+            self, misfits, extra_weights, extra_residuals, get_contributions,
+            single_precision=False):
+
+        wf = self.inter_family_weights2(misfits[:, :, 1])
+        target_weights = self.target_weights
+
+        if single_precision:
+            def single(x):
+                return x.astype(num.float32)
+
+            misfits = single(misfits)
+            wf = single(wf)
+            target_weights = single(target_weights)
+        else:
+            def single(x):
+                return x
+
+        if extra_weights is not None or extra_residuals is not None:
+            if extra_weights is not None:
+                w = single(self.get_extra_target_weights(extra_weights)) \
+                    * wf[:, num.newaxis, :]
+            else:
+                w = 1.0
+
+            if extra_residuals is not None:
+                r = single(extra_residuals[num.newaxis, :, :])
+            else:
+                r = 0.0
+
+            m = w * (misfits[:, num.newaxis, :, 0] + r)
+            n = w * misfits[:, num.newaxis, :, 1]
+            axis = 2
+
+        else:
+            w = target_weights[num.newaxis, :] * wf
+            m = w * misfits[:, :, 0]
+            n = w * misfits[:, :, 1]
+            axis = 1
+
+        m = self.exp(m)
+        n = self.exp(n)
+        if get_contributions:
+            return m / num.expand_dims(self.nansum(n, axis=axis), axis)
+
+        res = self._root(self.nansum(m, axis=axis) / self.nansum(n, axis=axis))
+        assert res[res < 0].size == 0
+        return res
+
+
 class ProblemConfig(Object):
     '''
     Base class for config section defining the objective function setup.
@@ -77,6 +315,10 @@ class Problem(Object):
         self._target_weights = None
         self._engine = None
         self._family_mask = None
+        self._prunable_mask = None
+        self._modelling_cache = None
+        self._solved_parameter_mask = None
+        self._misfit_combiner = None
 
         if hasattr(self, 'problem_waveform_parameters') and self.has_waveforms:
             self.problem_parameters =\
@@ -106,6 +348,9 @@ class Problem(Object):
     def copy(self):
         o = copy.copy(self)
         o._target_weights = None
+        o._prunable_mask = None
+        o._modelling_cache = None
+        o._misfit_combiner = None
         return o
 
     def set_target_parameter_values(self, x):
@@ -114,6 +359,72 @@ class Problem(Object):
             target.set_parameter_values(x[nprob:nprob+target.nparameters])
             nprob += target.nparameters
 
+    def get_solved_parameter_mask(self):
+        '''
+        Get mask of the target parameters which are solved for in the
+        modelling rather than sampled by the optimiser.
+
+        :returns: boolean array ``solved[iparameter]``
+        '''
+        if self._solved_parameter_mask is None:
+            solved = num.zeros(self.nparameters, dtype=num.bool)
+            nprob = len(self.problem_parameters)
+            for target in self.targets:
+                if target.solves_parameters:
+                    solved[nprob:nprob+target.nparameters] = True
+
+                nprob += target.nparameters
+
+            self._solved_parameter_mask = solved
+
+        return self._solved_parameter_mask
+
+    def set_solved_parameter_values(self, x, results):
+        '''
+        Insert values of target parameters solved for in the modelling into
+        the model vector *x* (in place).
+
+        Values are clipped to the parameter ranges.
+        '''
+        xbounds = None
+        nprob = len(self.problem_parameters)
+        for target, result in zip(self.targets, results):
+            values = target.get_solved_parameter_values(result)
+            if values is not None:
+                if xbounds is None:
+                    xbounds = self.get_parameter_bounds()
+
+                ipars = slice(nprob, nprob+target.nparameters)
+                x[ipars] = num.clip(
+                    values, xbounds[ipars, 0], xbounds[ipars, 1])
+
+            nprob += target.nparameters
+
+    def reset_solved_parameters(self, x):
+        '''
+        Set target parameters solved for in the modelling to the centre of
+        their ranges.
+
+        Applied to proposed models, so that these parameters are not sampled.
+
+        :returns: model vector, a modified copy of *x* if the problem has
+            solved parameters
+        '''
+        solved = self.get_solved_parameter_mask()
+        if num.any(solved):
+            xbounds = self.get_parameter_bounds()
+            x = num.array(x, dtype=num.float)
+            x[solved] = num.mean(xbounds[solved, :], axis=1)
+
+        return x
+
+    def get_model_key(self, x):
+        '''
+        Get key identifying a proposed model, independent of the values of
+        solved target parameters, which are replaced during evaluation.
+        '''
+        return x[num.logical_not(self.get_solved_parameter_mask())].tobytes()
+
     def get_parameter_dict(self, model, group=None):
         params = []
         for ip, p in enumerate(self.parameters):
@@ -249,9 +560,22 @@ class Problem(Object):
 
     def set_engine(self, engine):
         self._engine = engine
+        self._modelling_cache = None
+
+    def random_uniform(self, xbounds, u=None):
+        '''
+        Draw a model from the uniform distribution within given bounds.
+
+        :param xbounds: 2D array ``xbounds[iparameter, (min, max)]``
+        :param u: if given, array of numbers in [0, 1[, one for each
+            parameter, to be used instead of random numbers, e.g. from a
+            quasi-random sequence
+        '''
+        if u is None:
+            x = num.random.uniform(0., 1., self.nparameters)
+        else:
+            x = num.array(u, dtype=num.float)
 
-    def random_uniform(self, xbounds):
-        x = num.random.uniform(0., 1., self.nparameters)
         x *= (xbounds[:, 1] - xbounds[:, 0])
         x += xbounds[:, 0]
         return x
@@ -298,15 +622,7 @@ class Problem(Object):
         :returns: 2D array ``weights[imodel, itarget]``
         '''
 
-        exp, root = self.get_norm_functions()
-
-        family, nfamilies = self.get_family_mask()
-        ws = num.zeros(ns.shape)
-        for ifamily in range(nfamilies):
-            mask = family == ifamily
-            ws[:, mask] = (1.0 / root(
-                num.nansum(exp(ns[:, mask]), axis=1)))[:, num.newaxis]
-        return ws
+        return self.get_misfit_combiner().inter_family_weights2(ns)
 
     def get_reference_model(self, expand=False):
         if expand:
@@ -361,7 +677,9 @@ class Problem(Object):
             self, misfits,
             extra_weights=None,
             extra_residuals=None,
-            get_contributions=False):
+            get_contributions=False,
+            memory_limit=None,
+            single_precision=False):
 
         '''
         Combine misfit contributions (residuals) to global or bootstrap misfits
@@ -385,6 +703,13 @@ class Problem(Object):
         :param get_contributions: get the weighted and perturbed contributions
             (don't do the sum).
 
+        :param memory_limit: budget for temporary arrays in bytes, models are
+            processed in blocks to stay within it (see
+            :py:meth:`MisfitCombiner.combine`).
+
+        :param single_precision: compute the weighted contributions in single
+            precision to halve the memory needed.
+
         :returns: if no *extra_weights* or *extra_residuals* are given, a 1D
             array indexed as ``misfits[imodel]`` containing the global misfit
             for each model is returned, otherwise a 2D array
@@ -392,63 +717,42 @@ class Problem(Object):
             weighting/residual set is returned.
         '''
 
-        exp, root = self.get_norm_functions()
+        return self.get_misfit_combiner().combine(
+            misfits,
+            extra_weights,
+            extra_residuals,
+            get_contributions,
+            memory_limit,
+            single_precision)
 
-        if misfits.ndim == 2:
-            misfits = misfits[num.newaxis, :, :]
-            return self.combine_misfits(
-                misfits,
-                extra_weights,
-                extra_residuals,
-                get_contributions)[0, ...]
-
-        assert misfits.ndim == 3
-        assert extra_weights is None or extra_weights.ndim == 2
-        assert extra_residuals is None or extra_residuals.ndim == 2
+    def get_misfit_combiner(self):
+        '''
+        Get the :py:class:`MisfitCombiner` of this problem.
 
-        if extra_weights is not None or extra_residuals is not None:
-            if extra_weights is not None:
-                w = extra_weights[num.newaxis, :, :] \
-                    * self.get_target_weights()[num.newaxis, num.newaxis, :] \
-                    * self.inter_family_weights2(
-                        misfits[:, :, 1])[:, num.newaxis, :]
-            else:
-                w = 1.0
+        The combiner is rebuilt when target weights, normalisation families or
+        norm exponent of the problem have changed.
+        '''
 
-            if extra_residuals is not None:
-                r = extra_residuals[num.newaxis, :, :]
-            else:
-                r = 0.0
+        if self._misfit_combiner is None \
+                or not self._misfit_combiner.is_valid_for(self):
 
-            if get_contributions:
-                return exp(w*(misfits[:, num.newaxis, :, 0]+r)) \
-                    / num.nansum(
-                        exp(w*misfits[:, num.newaxis, :, 1]),
-                        axis=2)[:, :, num.newaxis]
-
-            res = root(
-                num.nansum(exp(w*(misfits[:, num.newaxis, :, 0]+r)), axis=2) /
-                num.nansum(exp(w*(misfits[:, num.newaxis, :, 1])), axis=2))
-            assert res[res < 0].size == 0
-            return res
-        else:
-            w = self.get_target_weights()[num.newaxis, :] \
-                * self.inter_family_weights2(misfits[:, :, 1])
+            self._misfit_combiner = MisfitCombiner(self)
 
-            r = self.get_target_weights()[num.newaxis, :] \
-                * self.inter_family_weights2(misfits[:, :, 1])
+        return self._misfit_combiner
 
-            if get_contributions:
-                return exp(w*misfits[:, :, 0]) \
-                    / num.nansum(
-                        exp(w*misfits[:, :, 1]),
-                        axis=1)[:, num.newaxis]
+    def make_family_mask(self):
+        '''
+        Get the normalisation family of each misfit.
 
-            return root(
-                num.nansum(exp(w*misfits[:, :, 0]), axis=1) /
-                num.nansum(exp(w*misfits[:, :, 1]), axis=1))
+        Families are numbered in order of the targets: a target introducing
+        a new family name starts the next family, any other target belongs
+        to the most recently introduced family. Targets of a family are
+        therefore only normalised together if no other family is introduced
+        between them.
 
-    def make_family_mask(self):
+        :returns: tuple ``(families, nfamilies)``, integer array
+            ``families[imisfit]`` and the number of families
+        '''
         family_names = set()
         families = num.zeros(self.nmisfits, dtype=num.int)
 
@@ -466,24 +770,22 @@ class Problem(Object):
 
         return self._family_mask
 
-    def evaluate(self, x, mask=None, result_mode='full', targets=None):
-        source = self.get_source(x)
-        engine = self.get_engine()
-
-        self.set_target_parameter_values(x)
-
-        if mask is not None and targets is not None:
-            raise ValueError('mask cannot be defined with targets set')
-        targets = targets if targets is not None else self.targets
+    def prepare_modelling(self, engine, source, targets, mask=None):
+        '''
+        Collect the modelling targets needed to evaluate *targets*.
 
-        for target in targets:
-            target.set_result_mode(result_mode)
+        :returns: tuple ``(t2m_map, u2m_map, modelling_targets_unique)``
+            with the modelling targets of each target, the positions of each
+            unique modelling target in the concatenated list of modelling
+            targets and the list of unique modelling targets
+        '''
 
         modelling_targets = []
         t2m_map = {}
         for itarget, target in enumerate(targets):
-            t2m_map[target] = target.prepare_modelling(engine, source, targets)
             if mask is None or mask[itarget]:
+                t2m_map[target] = target.prepare_modelling(
+                    engine, source, targets)
                 modelling_targets.extend(t2m_map[target])
 
         u2m_map = {}
@@ -495,10 +797,19 @@ class Problem(Object):
 
         modelling_targets_unique = list(u2m_map.keys())
 
-        resp = engine.process(source, modelling_targets_unique)
-        modelling_results_unique = list(resp.results_list[0])
+        return t2m_map, u2m_map, modelling_targets_unique
+
+    def finalize_modelling(
+            self, engine, source, targets, mask, t2m_map, u2m_map,
+            modelling_targets_unique, modelling_results_unique):
 
-        modelling_results = [None] * len(modelling_targets)
+        '''
+        Get the results of *targets* from the results of the unique
+        modelling targets, as set up by :py:meth:`prepare_modelling`.
+        '''
+
+        nmodelling_targets = sum(len(v) for v in u2m_map.values())
+        modelling_results = [None] * nmodelling_targets
 
         for mtarget, mresult in zip(
                 modelling_targets_unique, modelling_results_unique):
@@ -509,8 +820,8 @@ class Problem(Object):
         imt = 0
         results = []
         for itarget, target in enumerate(targets):
-            nmt_this = len(t2m_map[target])
             if mask is None or mask[itarget]:
+                nmt_this = len(t2m_map[target])
                 result = target.finalize_modelling(
                     engine, source,
                     t2m_map[target],
@@ -525,19 +836,372 @@ class Problem(Object):
 
         return results
 
+    def can_reuse_modelling(self, targets, mask=None):
+        '''
+        Check if modelling results may be reused for models which differ only
+        in target parameters.
+
+        This is the case if all targets to be modelled can be batched (see
+        :py:attr:`grond.targets.MisfitTarget.can_batch_modelling`): their
+        synthetics depend only on the problem parameters, the target
+        parameters are applied in the post-processing.
+        '''
+
+        return all(
+            target.can_batch_modelling
+            for (itarget, target) in enumerate(targets)
+            if mask is None or mask[itarget])
+
+    def get_modelling_key(self, x, mask, result_mode):
+        '''
+        Get key identifying the source-dependent modelling results of a model.
+
+        Models with equal keys differ at most in their target parameters.
+        '''
+
+        nprob = len(self.problem_parameters)
+        return (
+            num.asarray(x[:nprob], dtype=num.float).tobytes(),
+            None if mask is None else num.asarray(mask).tobytes(),
+            result_mode)
+
+    def get_cached_modelling(self, key):
+        if self._modelling_cache is not None \
+                and self._modelling_cache[0] == key:
+
+            return self._modelling_cache[1:]
+
+        return None
+
+    def set_cached_modelling(self, key, maps, modelling_results_unique):
+        self._modelling_cache = (key, maps, modelling_results_unique)
+
+    def evaluate(self, x, mask=None, result_mode='full', targets=None):
+        source = self.get_source(x)
+        engine = self.get_engine()
+
+        self.set_target_parameter_values(x)
+
+        if mask is not None and targets is not None:
+            raise ValueError('mask cannot be defined with targets set')
+
+        key = None
+        if targets is None and self.can_reuse_modelling(self.targets, mask):
+            key = self.get_modelling_key(x, mask, result_mode)
+
+        targets = targets if targets is not None else self.targets
+
+        for target in targets:
+            target.set_result_mode(result_mode)
+
+        cached = self.get_cached_modelling(key) if key is not None else None
+        if cached is not None:
+            maps, modelling_results_unique = cached
+            t2m_map, u2m_map, modelling_targets_unique = maps
+        else:
+            maps = self.prepare_modelling(engine, source, targets, mask)
+            t2m_map, u2m_map, modelling_targets_unique = maps
+
+            resp = engine.process(source, modelling_targets_unique)
+            modelling_results_unique = list(resp.results_list[0])
+            if key is not None:
+                self.set_cached_modelling(
+                    key, maps, modelling_results_unique)
+
+        return self.finalize_modelling(
+            engine, source, targets, mask, t2m_map, u2m_map,
+            modelling_targets_unique, modelling_results_unique)
+
+    def evaluate_many(self, xs, mask=None):
+        '''
+        Get misfits for a set of models, modelling all of them at once.
+
+        The sources of all models are passed to a single call of the
+        engine. Models differing only in target parameters share a single
+        source, and the synthetics of the previous evaluation are reused if
+        its source is requested again. The results are then post-processed
+        model by model. If any of the targets to be modelled cannot be
+        batched (see
+        :py:attr:`grond.targets.MisfitTarget.can_batch_modelling`), the
+        models are evaluated one by one.
+
+        :param xs: 2D array ``xs[imodel, iparameter]``, values of solved
+            target parameters are updated in place
+        :param mask: if given, boolean array to exclude targets from modelling
+        :returns: 3D array ``misfits[imodel, imisfit, 0]`` (misfit
+            contributions) and ``misfits[imodel, imisfit, 1]``
+            (normalisation contributions)
+        '''
+
+        misfits = num.full((len(xs), self.nmisfits, 2), num.nan)
+        if len(xs) == 0:
+            return misfits
+
+        targets = self.targets
+        if not self.can_reuse_modelling(targets, mask):
+            for imodel, x in enumerate(xs):
+                misfits[imodel, :, :] = self.misfits(x, mask=mask)
+
+            return misfits
+
+        engine = self.get_engine()
+
+        for target in targets:
+            target.set_result_mode('sparse')
+
+        keys = [self.get_modelling_key(x, mask, 'sparse') for x in xs]
+
+        key_cached = None
+        if self._modelling_cache is not None \
+                and self._modelling_cache[0] in keys:
+
+            key_cached, maps, modelling_results_cached = \
+                self._modelling_cache
+        else:
+            maps = self.prepare_modelling(
+                engine, self.get_source(xs[0]), targets, mask)
+
+        t2m_map, u2m_map, modelling_targets_unique = maps
+
+        isources = {}
+        sources = []
+        for key, x in zip(keys, xs):
+            if key not in isources and key != key_cached:
+                isources[key] = len(sources)
+                sources.append(self.get_source(x))
+
+        if sources:
+            resp = engine.process(sources, modelling_targets_unique)
+
+        for imodel, (key, x) in enumerate(zip(keys, xs)):
+            if key in isources:
+                modelling_results_unique = list(
+                    resp.results_list[isources[key]])
+            else:
+                modelling_results_unique = modelling_results_cached
+
+            self.set_target_parameter_values(x)
+            results = self.finalize_modelling(
+                engine, self.get_source(x), targets, mask, t2m_map, u2m_map,
+                modelling_targets_unique, modelling_results_unique)
+
+            self.set_solved_parameter_values(x, results)
+            misfits[imodel, :, :] = self.get_misfits(results)
+
+        self.set_cached_modelling(keys[-1], maps, modelling_results_unique)
+
+        return misfits
+
+    def make_prunable_mask(self):
+        weights = self.get_target_weights()
+        family, nfamilies = self.get_family_mask()
+
+        ioffsets = self.get_misfit_offsets()
+        iszero = num.logical_and.reduceat(weights == 0.0, ioffsets)
+        target_family = family[ioffsets]
+
+        contributing = set(target_family[~iszero])
+        if not contributing:
+            return num.zeros(self.ntargets, dtype=num.bool)
+
+        if len(contributing) == 1:
+            return iszero
+
+        return num.logical_and(
+            iszero,
+            [ifamily not in contributing for ifamily in target_family])
+
+    def get_prunable_mask(self):
+        '''
+        Get targets which cannot contribute to any global or bootstrap misfit.
+
+        A target with zero weight has no share in the misfit, but its
+        normalisation contributions still enter the weight of its
+        normalisation family. It can therefore only be left out, if none of
+        the targets in its family has a non-zero weight, or if there is only
+        a single family with non-zero weights (in which case the family
+        weight cancels out).
+
+        :returns: boolean array ``prunable[itarget]``
+        '''
+
+        if self._prunable_mask is None:
+            if self.ntargets == 0:
+                self._prunable_mask = num.zeros(0, dtype=num.bool)
+            else:
+                self._prunable_mask = self.make_prunable_mask()
+
+        return self._prunable_mask
+
+    def get_modelling_mask(self, mask=None):
+        '''
+        Exclude prunable targets from a modelling mask.
+
+        :param mask: if given, boolean array ``mask[itarget]`` of targets to
+            be modelled
+        :returns: boolean array ``mask[itarget]`` or ``None`` if all targets
+            are to be modelled
+        '''
+
+        prunable = self.get_prunable_mask()
+        if not num.any(prunable):
+            return mask
+
+        if mask is None:
+            return num.logical_not(prunable)
+
+        return num.logical_and(mask, num.logical_not(prunable))
+
+    def get_evaluation_stages(self, nstages):
+        '''
+        Split the targets into groups for staged evaluation.
+
+        Targets which have to be modelled together (e.g. a
+        :py:class:`~grond.targets.waveform_oac.WOACTarget` and the waveform
+        targets it is associated with) are kept in the same stage.
+        Independent units are distributed round-robin over the stages, so
+        that each stage sees a mix of all target families.
+
+        :param nstages: maximum number of stages
+        :returns: list of boolean arrays ``mask[itarget]``, one per stage
+        '''
+
+        associated_paths = set(
+            target.associated_path for target in self.targets
+            if getattr(target, 'associated_path', None) is not None)
+
+        units = {}
+        for itarget, target in enumerate(self.targets):
+            key = getattr(target, 'associated_path', None)
+            if key is None and target.path in associated_paths:
+                key = target.path
+
+            if key is None:
+                key = itarget
+
+            units.setdefault(key, []).append(itarget)
+
+        units = list(units.values())
+
+        nstages = max(1, min(nstages, len(units)))
+        stages = [num.zeros(self.ntargets, dtype=num.bool)
+                  for istage in range(nstages)]
+
+        for iunit, members in enumerate(units):
+            stages[iunit % nstages][members] = True
+
+        return stages
+
+    def get_misfit_offsets(self):
+        '''
+        Get index of the first misfit contribution of each target.
+        '''
+        return num.cumsum(
+            [0] + [target.nmisfits for target in self.targets[:-1]])
+
+    def get_misfit_mask(self, target_mask):
+        '''
+        Expand a target mask to a mask over the misfit contributions.
+        '''
+        return num.repeat(
+            target_mask,
+            [target.nmisfits for target in self.targets])
+
+    def get_target_mask(self, misfit_mask):
+        '''
+        Reduce a mask over the misfit contributions to a mask over the targets.
+
+        A target is selected, if all of its misfit contributions are selected.
+        '''
+        return num.logical_and.reduceat(
+            misfit_mask, self.get_misfit_offsets())
+
+    def misfits_staged(self, x, reject, mask=None, nstages=4):
+        '''
+        Get misfits for a model, evaluating the targets in stages.
+
+        After each stage but the last, the callable *reject* is called as
+        ``reject(misfits, evaluated)`` with the misfits gathered so far and a
+        boolean array marking the misfit contributions which have already
+        been evaluated. If it returns ``None``, evaluation continues with the
+        next stage, otherwise the returned misfits array is taken as the
+        final result and the remaining targets are not modelled.
+
+        :param x: model parameter vector
+        :param reject: rejection test, see above
+        :param mask: if given, boolean array to exclude targets from modelling
+        :param nstages: maximum number of stages
+        :returns: 2D array ``misfits[imisfit, :]``, see :py:meth:`misfits`
+        '''
+
+        misfits = num.full((self.nmisfits, 2), num.nan)
+        evaluated = num.zeros(self.nmisfits, dtype=num.bool)
+
+        stages = self.get_evaluation_stages(nstages)
+        for istage, stage in enumerate(stages):
+            stage_mask = stage if mask is None else stage & mask
+            stage_misfits = self.get_misfit_mask(stage)
+            if num.any(stage_mask):
+                misfits_stage = self.misfits(x, mask=stage_mask)
+                misfits[stage_misfits, :] = misfits_stage[stage_misfits, :]
+
+            evaluated |= stage_misfits
+
+            if istage < len(stages) - 1:
+                misfits_rejected = reject(misfits, evaluated)
+                if misfits_rejected is not None:
+                    return misfits_rejected
+
+        return misfits
+
     def misfits(self, x, mask=None):
         results = self.evaluate(x, mask=mask, result_mode='sparse')
+        self.set_solved_parameter_values(x, results)
+        return self.get_misfits(results)
+
+    def get_misfits(self, results):
+        '''
+        Gather the misfits from the results of all targets.
+
+        :returns: 2D array ``misfits[imisfit, :]``, NaN for targets without
+            a valid result
+        '''
+
         misfits = num.full((self.nmisfits, 2), num.nan)
 
         imisfit = 0
         for target, result in zip(self.targets, results):
-            if isinstance(result, MisfitResult):
+            if isinstance(result, (MisfitResult, SparseMisfitResult)):
                 misfits[imisfit:imisfit+target.nmisfits, :] = result.misfits
 
             imisfit += target.nmisfits
 
         return misfits
 
+    def misfits_many(self, xs, mask=None, reject=None, nstages=4):
+        '''
+        Get misfits for a set of models.
+
+        :param xs: 2D array ``xs[imodel, iparameter]``, values of solved
+            target parameters are updated in place
+        :param mask: if given, boolean array to exclude targets from modelling
+        :param reject: if given, evaluate targets in stages and allow early
+            rejection of models, see :py:meth:`misfits_staged`
+        :param nstages: maximum number of stages for staged evaluation
+        :returns: 3D array ``misfits[imodel, imisfit, 0]`` (misfit
+            contributions) and ``misfits[imodel, imisfit, 1]``
+            (normalisation contributions)
+        '''
+        if reject is None:
+            return self.evaluate_many(xs, mask=mask)
+
+        misfits = num.full((len(xs), self.nmisfits, 2), num.nan)
+        for imodel, x in enumerate(xs):
+            misfits[imodel, :, :] = self.misfits_staged(
+                x, reject, mask=mask, nstages=nstages)
+
+        return misfits
+
     def forward(self, x):
         source = self.get_source(x)
         engine = self.get_engine()
@@ -562,7 +1226,7 @@ class Problem(Object):
         xbounds = self.get_parameter_bounds()
 
         while True:
-            x = self.random_uniform(xbounds)
+            x = self.reset_solved_parameters(self.random_uniform(xbounds))
             try:
                 return self.preconstrain(x)
 
@@ -586,6 +1250,108 @@ class InvalidAttributeName(GrondError):
     pass
 
 
+class ModelHistoryWriter(object):
+    '''
+    Buffered writer for the model files of a rundir.
+
+    The files are kept open while the run lasts. Records are collected in
+    memory and written when *flush_nmodels* models have been buffered or
+    *flush_interval* seconds have passed since the last write, whichever
+    comes first.
+
+    :param path: path to rundir
+    :param flush_nmodels: maximum number of models to buffer
+    :param flush_interval: maximum time [s] to keep models in the buffer
+    :param fsync: when to force written data to disk: ``'never'``,
+        ``'close'`` (only when the writer is closed) or ``'flush'`` (after
+        each write)
+    '''
+
+    fsync_choices = ('never', 'close', 'flush')
+
+    def __init__(
+            self, path,
+            flush_nmodels=1000,
+            flush_interval=2.,
+            fsync='never'):
+
+        if fsync not in self.fsync_choices:
+            raise ValueError('invalid fsync policy: %s' % fsync)
+
+        self.path = path
+        self.flush_nmodels = flush_nmodels
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        self._files = {}
+        self._buffers = dict(
+            (name, []) for name in ('models', 'misfits', 'bootstraps'))
+        self._nbuffered = 0
+        self._tflush_last = time.time()
+
+    def get_file(self, name):
+        if name not in self._files:
+            self._files[name] = open(op.join(self.path, name), 'ab')
+
+        return self._files[name]
+
+    def write(self, models, misfits, bootstrap_misfits=None):
+        '''
+        Add models with their misfits to the buffer.
+
+        :param models: 2D array ``models[imodel, iparameter]``
+        :param misfits: 3D array ``misfits[imodel, imisfit, :]``
+        :param bootstrap_misfits: if given, 2D array
+            ``bootstrap_misfits[imodel, ibootstrap]``
+        '''
+
+        self._buffers['models'].append(models.astype('<f8').tobytes())
+        self._buffers['misfits'].append(misfits.astype('<f8').tobytes())
+        if bootstrap_misfits is not None:
+            self._buffers['bootstraps'].append(
+                bootstrap_misfits.astype('<f8').tobytes())
+
+        self._nbuffered += models.shape[0]
+
+        if self._nbuffered >= self.flush_nmodels \
+                or time.time() - self._tflush_last >= self.flush_interval:
+
+            self.flush()
+
+    def flush(self):
+        '''
+        Write all buffered models to the files.
+        '''
+
+        for name in ('models', 'misfits', 'bootstraps'):
+            buffer = self._buffers[name]
+            if buffer:
+                f = self.get_file(name)
+                f.write(b''.join(buffer))
+                f.flush()
+                if self.fsync == 'flush':
+                    os.fsync(f.fileno())
+
+                del buffer[:]
+
+        self._nbuffered = 0
+        self._tflush_last = time.time()
+
+    def close(self):
+        '''
+        Flush the buffer and close the files.
+        '''
+
+        self.flush()
+        for f in self._files.values():
+            if self.fsync == 'close':
+                os.fsync(f.fileno())
+
+            f.close()
+
+        self._files = {}
+
+
 class ModelHistory(object):
     '''
     Write, read and follow sequences of models produced in an optimisation run.
@@ -593,19 +1359,45 @@ class ModelHistory(object):
     :param problem: :class:`grond.Problem` instance
     :param path: path to rundir, defaults to None
     :type path: str, optional
-    :param mode: open mode, 'r': read, 'w': write
+    :param mode: open mode, 'r': read, 'w': write, 'a': read existing models
+        and append new ones
     :type mode: str, optional
+    :param writer_options: options for the :py:class:`ModelHistoryWriter`
+        used in modes 'w' and 'a'
+    :type writer_options: dict, optional
+    :param memmap: in mode 'r', map the model data files into memory instead
+        of reading them (see :py:func:`map_problem_data`)
+    :type memmap: bool, optional
+
+    In modes 'w' and 'a', new models are written to the rundir in a buffered
+    way. Call :py:meth:`flush` to make sure they are on disk, e.g. before
+    a checkpoint is written, and :py:meth:`close` when done.
+
+    With *memmap* enabled, :py:attr:`models`, :py:attr:`misfits` and
+    :py:attr:`bootstrap_misfits` are views on the files in the rundir, which
+    are remapped when :py:meth:`update` finds new models. Such a history
+    cannot be extended by other means.
     '''
 
     nmodels_capacity_min = 1024
 
-    def __init__(self, problem, nchains=None, path=None, mode='r'):
+    def __init__(self, problem, nchains=None, path=None, mode='r',
+                 writer_options={}, memmap=False):
+
+        if memmap and mode != 'r':
+            raise ValueError(
+                'memory-mapped model history is only available in mode "r"')
+
         self.mode = mode
+        self.memmap = memmap
 
         self.problem = problem
         self.path = path
         self.nchains = nchains
 
+        self._writer = None
+        self._writer_options = writer_options
+
         self._models_buffer = None
         self._misfits_buffer = None
         self._bootstraps_buffer = None
@@ -619,11 +1411,21 @@ class ModelHistory(object):
 
         self._attributes = {}
 
-        if mode == 'r':
+        if mode in ('r', 'a'):
             self.verify_rundir(self.path)
+            if mode == 'a':
+                truncate_problem_data(path, problem, nchains=self.nchains)
+
+            if memmap:
+                self.map()
+                return
+
             models, misfits, bootstraps = load_problem_data(
                 path, problem, nchains=self.nchains)
+
+            self.mode = 'r'
             self.extend(models, misfits, bootstraps)
+            self.mode = mode
 
     @staticmethod
     def verify_rundir(rundir):
@@ -669,7 +1471,7 @@ class ModelHistory(object):
         self.models = self._models_buffer[:nmodels_new, :]
         self.misfits = self._misfits_buffer[:nmodels_new, :, :]
         if self.nchains is not None:
-            self.bootstrap_misfits = self._bootstraps_buffer[:nmodels_new, :, :]  # noqa
+            self.bootstrap_misfits = self._bootstraps_buffer[:nmodels_new, :]
 
     @property
     def nmodels_capacity(self):
@@ -711,11 +1513,35 @@ class ModelHistory(object):
                         self._bootstraps_buffer[:ncopy, :]
                 self._bootstraps_buffer = bootstraps_buffer
 
+    def map(self, nmodels=None):
+        '''
+        Map the model data files of the rundir into memory.
+
+        :param nmodels: number of models to map, defaults to all available
+        '''
+
+        self._models_buffer, self._misfits_buffer, self._bootstraps_buffer = \
+            map_problem_data(
+                self.path, self.problem, nmodels=nmodels,
+                nchains=self.nchains)
+
+        self.models = self._models_buffer
+        self.misfits = self._misfits_buffer
+        if self._bootstraps_buffer is not None:
+            self.bootstrap_misfits = self._bootstraps_buffer
+
+    def check_not_mapped(self):
+        if self.memmap:
+            raise GrondError(
+                'cannot modify memory-mapped model history (%s)' % self.path)
+
     def clear(self):
+        self.check_not_mapped()
         self.nmodels = 0
         self.nmodels_capacity = self.nmodels_capacity_min
 
     def extend(self, models, misfits, bootstrap_misfits=None):
+        self.check_not_mapped()
         nmodels = self.nmodels
 
         n = models.shape[0]
@@ -736,14 +1562,13 @@ class ModelHistory(object):
             self._bootstraps_buffer[nmodels:nmodels+n, :] = bootstrap_misfits
             self.bootstrap_misfits = self._bootstraps_buffer[:nmodels+n, :]
 
-        if self.path and self.mode == 'w':
-            for i in range(n):
-                self.problem.dump_problem_data(
-                        self.path, models[i, :], misfits[i, :, :])
+        if self.path and self.mode in ('w', 'a'):
+            self.get_writer().write(models, misfits, bootstrap_misfits)
 
         self.emit('extend', nmodels, n, models, misfits)
 
     def append(self, model, misfits, bootstrap_misfits=None):
+        self.check_not_mapped()
         nmodels = self.nmodels
 
         nmodels_capacity_want = max(
@@ -762,20 +1587,62 @@ class ModelHistory(object):
             self._bootstraps_buffer[nmodels, :] = bootstrap_misfits
             self.bootstrap_misfits = self._bootstraps_buffer[:nmodels+1, :]
 
-        if self.path and self.mode == 'w':
-            self.problem.dump_problem_data(
-                self.path, model, misfits, bootstrap_misfits)
+        if self.path and self.mode in ('w', 'a'):
+            self.get_writer().write(
+                model[num.newaxis, :],
+                misfits[num.newaxis, :, :],
+                None if bootstrap_misfits is None
+                else bootstrap_misfits[num.newaxis, :])
 
         self.emit(
             'extend', nmodels, 1,
             model[num.newaxis, :], misfits[num.newaxis, :, :])
 
+    def get_writer(self):
+        if self._writer is None:
+            self._writer = ModelHistoryWriter(
+                self.path, **self._writer_options)
+
+        return self._writer
+
+    def flush(self):
+        '''
+        Write buffered models to the rundir.
+        '''
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        '''
+        Write buffered models to the rundir and close its files.
+        '''
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
     def update(self):
         ''' Update history from path '''
         nmodels_available = get_nmodels(self.path, self.problem)
         if self.nmodels == nmodels_available:
             return
 
+        if self.memmap:
+            nmodels = self.nmodels
+            try:
+                self.map(nmodels_available)
+            except ValueError:
+                return
+
+            n = self.nmodels - nmodels
+            if n <= 0:
+                return
+
+            self.emit(
+                'extend', nmodels, n,
+                self.models[nmodels:], self.misfits[nmodels:])
+
+            return
+
         try:
             new_models, new_misfits, new_bootstraps = load_problem_data(
                 self.path, self.problem,
@@ -859,10 +1726,87 @@ def get_nmodels(dirname, problem):
     return min(nmodels1, nmodels2)
 
 
-def load_problem_info_and_data(dirname, subset=None, nchains=None):
+def truncate_problem_data(dirname, problem, nmodels=None, nchains=None):
+    '''
+    Cut model data files in a rundir to a common number of complete models.
+
+    Removes partially written records, e.g. after an interrupted run, so
+    that new models can be appended.
+
+    :param nmodels: if given, truncate to at most this number of models
+    :param nchains: number of bootstrap chains, if given, the
+        ``bootstraps`` file is truncated as well
+    :returns: number of models kept
+    '''
+
+    record_sizes = [
+        ('models', problem.nparameters * 8),
+        ('misfits', problem.nmisfits * 2 * 8)]
+
+    if nchains is not None and op.exists(op.join(dirname, 'bootstraps')):
+        record_sizes.append(('bootstraps', nchains * 8))
+
+    nmodels_available = min(
+        os.stat(op.join(dirname, fn)).st_size // record_size
+        for (fn, record_size) in record_sizes)
+
+    if nmodels is None:
+        nmodels = nmodels_available
+    else:
+        nmodels = min(nmodels, nmodels_available)
+
+    for fn, record_size in record_sizes:
+        path = op.join(dirname, fn)
+        if os.stat(path).st_size != nmodels * record_size:
+            logger.warning(
+                'truncating %s to %i models' % (path, nmodels))
+
+            with open(path, 'r+b') as f:
+                f.truncate(nmodels * record_size)
+
+    return nmodels
+
+
+def mark_rejected(dirname, misfits, bootstraps=None, nmodels_skip=0):
+    '''
+    Mark the models rejected early by the optimiser as infinitely bad.
+
+    The misfit contributions skipped on early rejection are stored as NaN,
+    which would otherwise be ignored when combining the misfits. They are set
+    to infinity here, as are the bootstrap misfits of the rejected models.
+    The arrays are modified in place.
+
+    :param misfits: misfits of the models starting at index *nmodels_skip*
+    :param bootstraps: bootstrap misfits of the same models, or ``None``
+    '''
+
+    fn = op.join(dirname, 'attributes', 'rejected')
+    nmodels = misfits.shape[0]
+    if nmodels == 0 or not op.exists(fn):
+        return
+
+    with open(fn, 'rb') as f:
+        f.seek(nmodels_skip * 4)
+        flags = num.fromfile(f, dtype='<i4', count=nmodels)
+
+    irejected = num.where(flags != 0)[0]
+    if irejected.size == 0:
+        return
+
+    misfits_rejected = misfits[irejected, :, 0]
+    misfits_rejected[num.isnan(misfits_rejected)] = num.inf
+    misfits[irejected, :, 0] = misfits_rejected
+
+    if bootstraps is not None:
+        bootstraps[irejected, :] = num.inf
+
+
+def load_problem_info_and_data(
+        dirname, subset=None, nchains=None, memmap=False):
+
     problem = load_problem_info(dirname)
     models, misfits, bootstraps = load_problem_data(
-        xjoin(dirname, subset), problem, nchains=nchains)
+        xjoin(dirname, subset), problem, nchains=nchains, memmap=memmap)
     return problem, models, misfits, bootstraps
 
 
@@ -881,10 +1825,85 @@ def load_problem_info(dirname):
             'no problem info available (%s)' % dirname)
 
 
-def load_problem_data(dirname, problem, nmodels_skip=0, nchains=None):
+def map_problem_data(dirname, problem, nmodels=None, nchains=None):
+    '''
+    Get memory-mapped views of the model data files in a rundir.
+
+    The data is not read into memory, pages are loaded on access. The views
+    are copy-on-write: they may be modified in memory but changes are never
+    written back to the files.
+
+    :param nmodels: number of models to map, defaults to all complete
+        models available
+    :param nchains: number of bootstrap chains, if given and a
+        ``bootstraps`` file exists, it is mapped as well
+    :returns: tuple ``(models, misfits, bootstraps)``, ``bootstraps`` is
+        ``None`` if not available
+
+    If the ``bootstraps`` file holds fewer models, e.g. because it is still
+    being written, only the models available in all files are mapped.
+    '''
 
     try:
-        nmodels = get_nmodels(dirname, problem) - nmodels_skip
+        if nmodels is None:
+            nmodels = get_nmodels(dirname, problem)
+
+        fn = op.join(dirname, 'bootstraps')
+        with_bootstraps = op.exists(fn) and nchains is not None
+        if with_bootstraps:
+            nmodels = min(nmodels, os.stat(fn).st_size // (nchains * 8))
+
+        shapes = [
+            ('models', (nmodels, problem.nparameters)),
+            ('misfits', (nmodels, problem.nmisfits, 2))]
+
+        if with_bootstraps:
+            shapes.append(('bootstraps', (nmodels, nchains)))
+
+        arrays = []
+        for name, shape in shapes:
+            if nmodels == 0:
+                arrays.append(num.zeros(shape, dtype=float))
+            else:
+                arrays.append(num.memmap(
+                    op.join(dirname, name),
+                    dtype='<f8', mode='c', shape=shape))
+
+    except OSError as e:
+        logger.debug(str(e))
+        raise ProblemDataNotAvailable(
+            'no problem data available (%s)' % dirname)
+
+    if len(arrays) == 2:
+        arrays.append(None)
+
+    mark_rejected(dirname, arrays[1], arrays[2])
+
+    return tuple(arrays)
+
+
+def load_problem_data(
+        dirname, problem, nmodels_skip=0, nchains=None, memmap=False):
+
+    if memmap:
+        models, misfits, bootstraps = map_problem_data(
+            dirname, problem, nchains=nchains)
+
+        return (
+            models[nmodels_skip:],
+            misfits[nmodels_skip:],
+            None if bootstraps is None else bootstraps[nmodels_skip:])
+
+    try:
+        nmodels = get_nmodels(dirname, problem)
+
+        fn_bootstraps = op.join(dirname, 'bootstraps')
+        with_bootstraps = op.exists(fn_bootstraps) and nchains is not None
+        if with_bootstraps:
+            nmodels = min(
+                nmodels, os.stat(fn_bootstraps).st_size // (nchains * 8))
+
+        nmodels -= nmodels_skip
 
         fn = op.join(dirname, 'models')
         with open(fn, 'r') as f:
@@ -906,9 +1925,8 @@ def load_problem_data(dirname, problem, nmodels_skip=0, nchains=None):
         misfits = misfits.reshape((nmodels, problem.nmisfits, 2))
 
         bootstraps = None
-        fn = op.join(dirname, 'bootstraps')
-        if op.exists(fn) and nchains is not None:
-            with open(fn, 'r') as f:
+        if with_bootstraps:
+            with open(fn_bootstraps, 'r') as f:
                 f.seek(nmodels_skip * nchains * 8)
                 bootstraps = num.fromfile(
                         f, dtype='<f8',
@@ -917,6 +1935,9 @@ def load_problem_data(dirname, problem, nmodels_skip=0, nchains=None):
 
             bootstraps = bootstraps.reshape((nmodels, nchains))
 
+        mark_rejected(
+            dirname, misfits, bootstraps, nmodels_skip=nmodels_skip)
+
     except OSError as e:
         logger.debug(str(e))
         raise ProblemDataNotAvailable(
@@ -156,12 +156,18 @@ class CMTProblem(Problem):
 
         return x
 
-    def random_uniform(self, xbounds):
-        x = num.zeros(self.nparameters)
-        for i in range(self.nparameters):
-            x[i] = num.random.uniform(xbounds[i, 0], xbounds[i, 1])
-
-        x[5:11] = mtm.random_m6()
+    def random_uniform(self, xbounds, u=None):
+        if u is None:
+            x = num.zeros(self.nparameters)
+            for i in range(self.nparameters):
+                x[i] = num.random.uniform(xbounds[i, 0], xbounds[i, 1])
+
+            x[5:11] = mtm.random_m6()
+
+        else:
+            u = num.asarray(u, dtype=num.float)
+            x = xbounds[:, 0] + u * (xbounds[:, 1] - xbounds[:, 0])
+            x[5:11] = mtm.random_m6(x=u[5:11])
 
         return x.tolist()
 
@@ -101,10 +101,11 @@ class DoubleDCProblem(Problem):
                 arr[ip] = source.stf2.duration if source.stf2 else 0.0
         return arr
 
-    def random_uniform(self, xbounds):
-        x = num.zeros(self.nparameters)
-        for i in range(self.nparameters):
-            x[i] = num.random.uniform(xbounds[i, 0], xbounds[i, 1])
+    def random_uniform(self, xbounds, u=None):
+        if u is None:
+            u = num.random.uniform(0., 1., self.nparameters)
+
+        x = xbounds[:, 0] + u * (xbounds[:, 1] - xbounds[:, 0])
 
         return x.tolist()
 
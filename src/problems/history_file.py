@@ -0,0 +1,552 @@
+'''
+Self-describing single-file container for the model history of a rundir.
+
+The file starts with a fixed preamble::
+
+    magic (8 bytes) | version (<u4) | header size (<u4) | nmodels (<u8)
+
+followed by a YAML header (:py:class:`ModelHistoryFileHeader`) padded to a
+multiple of 8 bytes. The data section is a sequence of chunks of
+``chunk_nmodels`` models each. Within a chunk, the values are stored column
+by column (``<f8``): first the model parameters, then the misfits and misfit
+norms of all targets, then the bootstrap misfits. Any range of models can be
+read for any subset of columns without touching the rest of the file.
+
+The number of models in the preamble is updated after the data of an append
+has been written, so that readers never see incomplete models.
+'''
+
+import os
+import os.path as op
+import struct
+import logging
+
+import numpy as num
+
+from pyrocko import guts
+from pyrocko.guts import Object, Int, String, List
+
+from grond.meta import GrondError
+
+guts_prefix = 'grond'
+logger = logging.getLogger('grond.problems.history_file')
+
+magic = b'GRONDMH\x00'
+preamble_format = '<8sIIQ'
+preamble_size = struct.calcsize(preamble_format)
+nmodels_offset = 16
+format_version = 1
+
+history_file_name = 'history'
+
+
+class ModelHistoryFileError(GrondError):
+    pass
+
+
+class ModelHistoryFileHeader(Object):
+    '''
+    Description of the content of a :py:class:`ModelHistoryFile`.
+    '''
+
+    version = Int.T(
+        default=format_version,
+        help='Version of the file format.')
+    dtype = String.T(
+        default='<f8',
+        help='Data type of the stored values.')
+    chunk_nmodels = Int.T(
+        default=1024,
+        help='Number of models per chunk.')
+    nparameters = Int.T(
+        help='Number of model parameters.')
+    nmisfits = Int.T(
+        help='Number of misfit values, each with its misfit norm.')
+    nchains = Int.T(
+        optional=True,
+        help='Number of bootstrap chains, if bootstrap misfits are stored.')
+    problem_name = String.T(
+        optional=True,
+        help='Name of the problem the models belong to.')
+    parameter_names = List.T(
+        String.T(),
+        help='Names of the model parameters.')
+    misfit_names = List.T(
+        String.T(),
+        help='Names of the misfit values.')
+
+    @property
+    def nbootstraps(self):
+        return self.nchains or 0
+
+    @property
+    def ncolumns(self):
+        return self.nparameters + self.nmisfits * 2 + self.nbootstraps
+
+    @property
+    def chunk_size(self):
+        return self.ncolumns * self.chunk_nmodels * 8
+
+    def get_column_offsets(self):
+        return dict(
+            models=0,
+            misfits=self.nparameters,
+            bootstraps=self.nparameters + self.nmisfits * 2)
+
+
+def get_misfit_names(problem):
+    '''
+    Get names for the misfit values of a problem.
+
+    Targets without an id are named by their index, targets with more than
+    one misfit value get a running number appended.
+    '''
+
+    names = []
+    for itarget, target in enumerate(problem.targets):
+        try:
+            name = target.string_id()
+        except AttributeError:
+            name = 'target.%i' % itarget
+
+        if target.nmisfits == 1:
+            names.append(name)
+        else:
+            names.extend(
+                '%s.%i' % (name, imisfit)
+                for imisfit in range(target.nmisfits))
+
+    return names
+
+
+class ModelHistoryFile(object):
+    '''
+    Columnar single-file storage of models, misfits and bootstrap misfits.
+
+    Use :py:meth:`create` to make a new file.
+
+    :param filename: path to the file
+    :param mode: ``'r'``: read, ``'a'``: read and append
+    '''
+
+    def __init__(self, filename, mode='r'):
+        if mode not in ('r', 'a'):
+            raise ValueError('invalid mode: %s' % mode)
+
+        self.filename = filename
+        self.mode = mode
+        # unbuffered, so that the model count is always read from the file
+        self._file = open(
+            filename, 'rb' if mode == 'r' else 'r+b', buffering=0)
+        self._data = None
+        self._nchunks_mapped = 0
+
+        try:
+            self.header, self.data_offset = self._read_header()
+        except Exception:
+            self._file.close()
+            raise
+
+    @classmethod
+    def create(
+            cls, filename,
+            nparameters,
+            nmisfits,
+            nchains=None,
+            parameter_names=None,
+            misfit_names=None,
+            problem_name=None,
+            chunk_nmodels=1024,
+            force=False):
+
+        '''
+        Create a new, empty file (constructor).
+
+        :returns: :py:class:`ModelHistoryFile` instance opened in mode
+            ``'a'``
+        '''
+
+        if op.exists(filename) and not force:
+            raise ModelHistoryFileError('file exists: %s' % filename)
+
+        if parameter_names is None:
+            parameter_names = [
+                'parameter.%i' % iparameter
+                for iparameter in range(nparameters)]
+
+        if misfit_names is None:
+            misfit_names = [
+                'misfit.%i' % imisfit for imisfit in range(nmisfits)]
+
+        if len(parameter_names) != nparameters \
+                or len(misfit_names) != nmisfits:
+
+            raise ModelHistoryFileError(
+                'number of column names does not match the data shape')
+
+        header = ModelHistoryFileHeader(
+            chunk_nmodels=chunk_nmodels,
+            nparameters=nparameters,
+            nmisfits=nmisfits,
+            nchains=nchains,
+            problem_name=problem_name,
+            parameter_names=list(parameter_names),
+            misfit_names=list(misfit_names))
+
+        header_data = header.dump().encode('utf-8')
+        header_data += b' ' * (-len(header_data) % 8)
+
+        with open(filename, 'wb') as f:
+            f.write(struct.pack(
+                preamble_format, magic, format_version, len(header_data), 0))
+            f.write(header_data)
+
+        return cls(filename, mode='a')
+
+    @classmethod
+    def from_problem(cls, filename, problem, nchains=None, **kwargs):
+        '''
+        Create a new, empty file for the models of a problem (constructor).
+        '''
+
+        return cls.create(
+            filename,
+            nparameters=problem.nparameters,
+            nmisfits=problem.nmisfits,
+            nchains=nchains,
+            parameter_names=problem.parameter_names[:problem.nparameters],
+            misfit_names=get_misfit_names(problem),
+            problem_name=problem.name,
+            **kwargs)
+
+    def _read_header(self):
+        f = self._file
+        preamble = f.read(preamble_size)
+        if len(preamble) != preamble_size:
+            raise ModelHistoryFileError(
+                'not a model history file: %s' % self.filename)
+
+        magic_, version, header_size, _ = struct.unpack(
+            preamble_format, preamble)
+
+        if magic_ != magic:
+            raise ModelHistoryFileError(
+                'not a model history file: %s' % self.filename)
+
+        if version > format_version:
+            raise ModelHistoryFileError(
+                'unsupported model history file version %i: %s' % (
+                    version, self.filename))
+
+        header = guts.load(string=f.read(header_size).decode('utf-8'))
+        if header.dtype != '<f8':
+            raise ModelHistoryFileError(
+                'unsupported data type %s: %s' % (header.dtype, self.filename))
+
+        return header, preamble_size + header_size
+
+    def close(self):
+        self._data = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def nmodels(self):
+        '''
+        Number of complete models in the file.
+        '''
+        self._file.seek(nmodels_offset)
+        return struct.unpack('<Q', self._file.read(8))[0]
+
+    def _set_nmodels(self, nmodels):
+        self._file.seek(nmodels_offset)
+        self._file.write(struct.pack('<Q', nmodels))
+
+    def _get_nchunks(self, nmodels):
+        return (nmodels + self.header.chunk_nmodels - 1) \
+            // self.header.chunk_nmodels
+
+    def _map(self, nchunks):
+        if nchunks != self._nchunks_mapped:
+            h = self.header
+            if nchunks == 0:
+                self._data = None
+            else:
+                self._data = num.memmap(
+                    self._file,
+                    dtype='<f8',
+                    mode='r' if self.mode == 'r' else 'r+',
+                    offset=self.data_offset,
+                    shape=(nchunks, h.ncolumns, h.chunk_nmodels))
+
+            self._nchunks_mapped = nchunks
+
+        return self._data
+
+    def append(self, models, misfits, bootstrap_misfits=None):
+        '''
+        Append models to the file.
+
+        :param models: 2D array ``models[imodel, iparameter]``
+        :param misfits: 3D array ``misfits[imodel, imisfit, :]``
+        :param bootstrap_misfits: 2D array
+            ``bootstrap_misfits[imodel, ichain]``, required if the file
+            stores bootstrap misfits
+        '''
+
+        if self.mode != 'a':
+            raise ModelHistoryFileError(
+                'file not opened for appending: %s' % self.filename)
+
+        h = self.header
+        n = models.shape[0]
+        columns = [
+            models.reshape((n, h.nparameters)),
+            misfits.reshape((n, h.nmisfits * 2))]
+
+        if h.nchains is not None:
+            if bootstrap_misfits is None:
+                raise ModelHistoryFileError(
+                    'bootstrap misfits required: %s' % self.filename)
+
+            columns.append(bootstrap_misfits.reshape((n, h.nchains)))
+
+        values = num.hstack(columns)
+
+        nmodels = self.nmodels
+        nchunks = self._get_nchunks(nmodels + n)
+        self._file.truncate(self.data_offset + nchunks * h.chunk_size)
+        data = self._map(nchunks)
+
+        i = 0
+        while i < n:
+            ichunk, ioffset = divmod(nmodels + i, h.chunk_nmodels)
+            m = min(n - i, h.chunk_nmodels - ioffset)
+            data[ichunk, :, ioffset:ioffset+m] = values[i:i+m, :].T
+            i += m
+
+        data.flush()
+        self._set_nmodels(nmodels + n)
+
+    def _read_columns(self, icolumns, imodel_start, imodel_stop):
+        h = self.header
+        nmodels = self.nmodels
+        imodel_start, imodel_stop, _ = slice(
+            imodel_start, imodel_stop).indices(nmodels)
+
+        n = max(0, imodel_stop - imodel_start)
+        values = num.empty((n, len(icolumns)), dtype=float)
+        if n == 0:
+            return values
+
+        data = self._map(self._get_nchunks(nmodels))
+
+        i = 0
+        while i < n:
+            ichunk, ioffset = divmod(imodel_start + i, h.chunk_nmodels)
+            m = min(n - i, h.chunk_nmodels - ioffset)
+            values[i:i+m, :] = data[ichunk, icolumns, ioffset:ioffset+m].T
+            i += m
+
+        return values
+
+    def _get_indices(self, selection, names, what):
+        if selection is None:
+            return list(range(len(names)))
+
+        indices = []
+        for x in selection:
+            if isinstance(x, str):
+                try:
+                    indices.append(names.index(x))
+                except ValueError:
+                    raise ModelHistoryFileError(
+                        'no such %s: %s' % (what, x))
+            else:
+                indices.append(int(x))
+
+        return indices
+
+    def read_models(self, imodel_start=None, imodel_stop=None,
+                    parameters=None):
+        '''
+        Read a range of models.
+
+        :param imodel_start,imodel_stop: range of models to read, as for
+            Python slices
+        :param parameters: names or indices of the parameters to read,
+            defaults to all
+        :returns: 2D array ``models[imodel, iparameter]``
+        '''
+        h = self.header
+        iparameters = self._get_indices(
+            parameters, h.parameter_names, 'parameter')
+
+        return self._read_columns(iparameters, imodel_start, imodel_stop)
+
+    def read_misfits(self, imodel_start=None, imodel_stop=None,
+                     misfits=None):
+        '''
+        Read misfits and misfit norms for a range of models.
+
+        :param imodel_start,imodel_stop: range of models to read, as for
+            Python slices
+        :param misfits: names or indices of the misfits to read, defaults to
+            all
+        :returns: 3D array ``misfits[imodel, imisfit, :]``
+        '''
+        h = self.header
+        offset = h.get_column_offsets()['misfits']
+        icolumns = []
+        for imisfit in self._get_indices(misfits, h.misfit_names, 'misfit'):
+            icolumns.extend(
+                (offset + imisfit * 2, offset + imisfit * 2 + 1))
+
+        values = self._read_columns(icolumns, imodel_start, imodel_stop)
+        return values.reshape((values.shape[0], len(icolumns) // 2, 2))
+
+    def read_bootstrap_misfits(self, imodel_start=None, imodel_stop=None,
+                               ichains=None):
+        '''
+        Read bootstrap misfits for a range of models.
+
+        :param imodel_start,imodel_stop: range of models to read, as for
+            Python slices
+        :param ichains: indices of the chains to read, defaults to all
+        :returns: 2D array ``bootstrap_misfits[imodel, ichain]`` or ``None``
+            if the file does not store bootstrap misfits
+        '''
+        h = self.header
+        if h.nchains is None:
+            return None
+
+        offset = h.get_column_offsets()['bootstraps']
+        if ichains is None:
+            ichains = range(h.nchains)
+
+        return self._read_columns(
+            [offset + ichain for ichain in ichains],
+            imodel_start, imodel_stop)
+
+    def read(self, imodel_start=None, imodel_stop=None):
+        '''
+        Read all data for a range of models.
+
+        :returns: tuple ``(models, misfits, bootstrap_misfits)``
+        '''
+        return (
+            self.read_models(imodel_start, imodel_stop),
+            self.read_misfits(imodel_start, imodel_stop),
+            self.read_bootstrap_misfits(imodel_start, imodel_stop))
+
+
+def convert_rundir_to_history_file(
+        dirname, filename=None, nchains=None, block_nmodels=100000,
+        force=False, **kwargs):
+
+    '''
+    Convert the model data of a rundir into a :py:class:`ModelHistoryFile`.
+
+    :param dirname: path to the rundir (or to a subset like the harvest
+        directory), ``problem.yaml`` is taken from there or from its parent
+    :param filename: output file, defaults to ``history`` in *dirname*
+    :param nchains: number of bootstrap chains, defaults to the value from
+        ``optimiser.yaml``, if available
+    :param block_nmodels: number of models to convert at a time
+    :returns: path to the created file
+    '''
+
+    from .base import load_problem_info, map_problem_data, \
+        ProblemInfoNotAvailable
+
+    try:
+        problem = load_problem_info(dirname)
+        rundir = dirname
+    except ProblemInfoNotAvailable:
+        rundir = op.dirname(op.normpath(dirname))
+        problem = load_problem_info(rundir)
+
+    if nchains is None and op.normpath(rundir) == op.normpath(dirname):
+        fn = op.join(rundir, 'optimiser.yaml')
+        if op.exists(fn):
+            nchains = getattr(guts.load(filename=fn), 'nchains', None)
+
+    models, misfits, bootstraps = map_problem_data(
+        dirname, problem, nchains=nchains)
+
+    if bootstraps is None:
+        nchains = None
+
+    if filename is None:
+        filename = op.join(dirname, history_file_name)
+
+    nmodels = models.shape[0]
+    with ModelHistoryFile.from_problem(
+            filename, problem, nchains=nchains, force=force,
+            **kwargs) as hf:
+
+        for i in range(0, nmodels, block_nmodels):
+            j = min(nmodels, i + block_nmodels)
+            hf.append(
+                models[i:j],
+                misfits[i:j],
+                None if bootstraps is None else bootstraps[i:j])
+
+    logger.info('converted %i models from %s to %s' % (
+        nmodels, dirname, filename))
+
+    return filename
+
+
+def convert_history_file_to_rundir(
+        filename, dirname, block_nmodels=100000, force=False):
+
+    '''
+    Write the content of a :py:class:`ModelHistoryFile` in the raw rundir
+    layout (``models``, ``misfits`` and ``bootstraps`` files).
+
+    :param filename: input file
+    :param dirname: output directory
+    :param block_nmodels: number of models to convert at a time
+    '''
+
+    from .base import ModelHistoryWriter
+
+    names = ['models', 'misfits', 'bootstraps']
+    existing = [name for name in names if op.exists(op.join(dirname, name))]
+    if existing:
+        if not force:
+            raise ModelHistoryFileError(
+                'model data exists in %s' % dirname)
+
+        for name in existing:
+            os.unlink(op.join(dirname, name))
+
+    if not op.exists(dirname):
+        os.makedirs(dirname)
+
+    with ModelHistoryFile(filename) as hf:
+        nmodels = hf.nmodels
+        writer = ModelHistoryWriter(dirname, flush_nmodels=block_nmodels)
+        for i in range(0, nmodels, block_nmodels):
+            j = min(nmodels, i + block_nmodels)
+            writer.write(*hf.read(i, j))
+
+        writer.close()
+
+    logger.info('converted %i models from %s to %s' % (
+        nmodels, filename, dirname))
+
+
+__all__ = '''
+    ModelHistoryFileError
+    ModelHistoryFileHeader
+    ModelHistoryFile
+    convert_rundir_to_history_file
+    convert_history_file_to_rundir
+'''.split()
@@ -90,10 +90,11 @@ class RectangularProblem(Problem):
 
         return source
 
-    def random_uniform(self, xbounds):
-        x = num.zeros(self.nparameters)
-        for i in range(self.nparameters):
-            x[i] = num.random.uniform(xbounds[i, 0], xbounds[i, 1])
+    def random_uniform(self, xbounds, u=None):
+        if u is None:
+            u = num.random.uniform(0., 1., self.nparameters)
+
+        x = xbounds[:, 0] + u * (xbounds[:, 1] - xbounds[:, 0])
 
         return x
 
@@ -1,4 +1,5 @@
 import copy
+from collections import OrderedDict
 
 import numpy as num
 
@@ -13,6 +14,87 @@ from grond.meta import has_get_plot_classes
 guts_prefix = 'grond'
 
 
+class TravelTimeCache(object):
+    '''
+    Cache for travel times interpolated from GF stores.
+
+    With a *tolerance* given, travel times are computed at the GF index
+    arguments (e.g. source depth and distance) rounded to multiples of the
+    tolerance [m], so that they can be reused for similar source-receiver
+    geometries. Without tolerance, the store is queried directly.
+
+    The cache holds at most :py:attr:`nentries_max` travel times, the least
+    recently used ones are dropped first. Each process has its own cache and
+    counters, see :py:meth:`take_statistics`.
+    '''
+
+    nentries_max = 100000
+
+    def __init__(self):
+        self._cache = OrderedDict()
+        self.nhits = 0
+        self.nmisses = 0
+
+    def t(self, store, timing, source, target, tolerance=None):
+        if tolerance is None:
+            return store.t(timing, source, target)
+
+        args = store.config.make_indexing_args1(source, target)
+        iargs = tuple(int(round(arg / tolerance)) for arg in args)
+        key = (store.config.id, str(timing), tolerance, iargs)
+        try:
+            t = self._cache.pop(key)
+            self.nhits += 1
+
+        except KeyError:
+            if len(self._cache) >= self.nentries_max:
+                self._cache.popitem(last=False)
+
+            t = store.t(timing, tuple(iarg * tolerance for iarg in iargs))
+            self.nmisses += 1
+
+        self._cache[key] = t
+        return t
+
+    @property
+    def nentries(self):
+        return len(self._cache)
+
+    @property
+    def nlookups(self):
+        return self.nhits + self.nmisses
+
+    @property
+    def hit_rate(self):
+        return self.nhits / self.nlookups if self.nlookups else 0.0
+
+    def take_statistics(self, nhits_begin, nmisses_begin):
+        '''
+        Remove counts of lookups done since the given counter values.
+
+        Used to pass the statistics of worker processes back to the main
+        process, where they are re-added with :py:meth:`add_statistics`.
+
+        :returns: tuple ``(nhits, nmisses)`` with the removed counts
+        '''
+
+        stats = (self.nhits - nhits_begin, self.nmisses - nmisses_begin)
+        self.nhits, self.nmisses = nhits_begin, nmisses_begin
+        return stats
+
+    def add_statistics(self, nhits, nmisses):
+        self.nhits += nhits
+        self.nmisses += nmisses
+
+    def clear(self):
+        self._cache.clear()
+        self.nhits = 0
+        self.nmisses = 0
+
+
+traveltime_cache = TravelTimeCache()
+
+
 class TargetGroup(Object):
     normalisation_family = gf.StringID.T(
         optional=True,
@@ -41,6 +123,19 @@ class MisfitResult(Object):
         dtype=num.float)
 
 
+class SparseMisfitResult(object):
+    '''
+    Lightweight result of a target in ``sparse`` result mode.
+
+    Carries only the misfit contributions, so that the optimiser's inner loop
+    does not have to construct and validate a guts object for every target
+    and model.
+    '''
+
+    def __init__(self, misfits):
+        self.misfits = misfits
+
+
 class MisfitConfig(Object):
     pass
 
@@ -75,6 +170,16 @@ class MisfitTarget(Object):
     can_bootstrap_weights = False
     can_bootstrap_residuals = False
 
+    # Synthetics for several models can be computed in a single call to the
+    # engine: the modelling targets do not depend on the source and the
+    # post-processing done by the engine does not depend on the target
+    # parameters (those must be applied in finalize_modelling).
+    can_batch_modelling = True
+
+    # Target parameters are solved for in the modelling instead of being
+    # sampled by the optimiser (see get_solved_parameter_values).
+    solves_parameters = False
+
     def __init__(self, **kwargs):
         Object.__init__(self, **kwargs)
         self.parameters = []
@@ -124,6 +229,16 @@ class MisfitTarget(Object):
         for i, p in enumerate(self.parameters):
             self.parameter_values[p.name_nogroups] = model[i]
 
+    def get_solved_parameter_values(self, result):
+        '''
+        Get values of target parameters which are solved for in the modelling.
+
+        :param result: result of this target
+        :returns: array with values for all parameters of this target, or
+            ``None`` if the parameters are taken from the model
+        '''
+        return None
+
     def set_result_mode(self, result_mode):
         self._result_mode = result_mode
 
@@ -169,4 +284,5 @@ __all__ = '''
     TargetGroup
     MisfitTarget
     MisfitResult
+    SparseMisfitResult
 '''.split()
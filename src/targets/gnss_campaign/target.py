@@ -4,7 +4,8 @@ import numpy as num
 from pyrocko import gf
 from pyrocko.guts import String, Dict, List
 
-from ..base import MisfitConfig, MisfitTarget, MisfitResult, TargetGroup
+from ..base import MisfitConfig, MisfitTarget, MisfitResult, \
+    SparseMisfitResult, TargetGroup
 from grond.meta import has_get_plot_classes
 
 guts_prefix = 'grond'
@@ -183,6 +184,9 @@ class GNSSCampaignMisfitTarget(gf.GNSSCampaignTarget, MisfitTarget):
             misfit_norm.reshape((nstations, 3)), axis=1)
 
         mf = num.hstack((misfit_value, misfit_norm))
+        if self._result_mode == 'sparse':
+            return SparseMisfitResult(mf)
+
         result = GNSSCampaignMisfitResult(
             misfits=mf)
 
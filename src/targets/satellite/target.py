@@ -1,21 +1,34 @@
 import logging
 import numpy as num
+from scipy.optimize import lsq_linear
 
 from pyrocko import gf
-from pyrocko.guts import String, Bool, Dict, List
+from pyrocko.guts import String, Bool, Dict, List, Float, StringChoice
 
 from grond.meta import Parameter, has_get_plot_classes
-from ..base import MisfitConfig, MisfitTarget, MisfitResult, TargetGroup
+from ..base import MisfitConfig, MisfitTarget, MisfitResult, \
+    SparseMisfitResult, TargetGroup
 
 guts_prefix = 'grond'
 logger = logging.getLogger('grond.targets.satellite.target')
 
 
+class OrbitalRampModeChoice(StringChoice):
+    choices = ['sample', 'least_squares']
+
+
 class SatelliteMisfitConfig(MisfitConfig):
     """Carries the misfit configuration."""
     optimise_orbital_ramp = Bool.T(
         default=True,
         help='Switch to account for a linear orbital ramp or not')
+    orbital_ramp_mode = OrbitalRampModeChoice.T(
+        default='sample',
+        help='How the orbital ramp is determined: ``sample``: offset and'
+             ' gradients are parameters of the optimisation,'
+             ' ``least_squares``: they are solved for each source model by'
+             ' linear least squares against the residuals of the scene,'
+             ' within ``ranges``, and are not sampled.')
     ranges = Dict.T(
         String.T(), gf.Range.T(),
         default={'offset': '-0.5 .. 0.5',
@@ -109,6 +122,18 @@ class SatelliteMisfitResult(gf.Result, MisfitResult):
     statics_obs = Dict.T(
         optional=True,
         help='Observed static displacement for a target.')
+    orbital_ramp = Dict.T(
+        String.T(), Float.T(),
+        optional=True,
+        help='Orbital ramp parameters solved by least squares.')
+
+
+class SparseSatelliteMisfitResult(SparseMisfitResult):
+    '''Lightweight satellite result in ``sparse`` result mode.'''
+
+    def __init__(self, misfits, orbital_ramp=None):
+        SparseMisfitResult.__init__(self, misfits)
+        self.orbital_ramp = orbital_ramp
 
 
 @has_get_plot_classes
@@ -141,6 +166,7 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
             self.parameters = self.available_parameters
 
         self.parameter_values = {}
+        self._ramp_design = None
 
     @property
     def target_ranges(self):
@@ -160,38 +186,109 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
     def scene(self):
         return self._ds.get_kite_scene(self.scene_id)
 
+    @property
+    def solve_orbital_ramp(self):
+        return self.misfit_config.optimise_orbital_ramp \
+            and self.misfit_config.orbital_ramp_mode == 'least_squares'
+
+    @property
+    def solves_parameters(self):
+        return self.solve_orbital_ramp
+
+    def get_ramp_design(self):
+        '''
+        Get design matrix of the orbital ramp.
+
+        :returns: 2D array with the columns ordered as the ramp parameters
+            (``offset``, ``ramp_north``, ``ramp_east``)
+        '''
+        if self._ramp_design is None:
+            distance = self.scene.quadtree.leaf_center_distance
+            self._ramp_design = num.vstack((
+                num.ones(distance.shape[0]),
+                distance[:, 1],
+                distance[:, 0])).T
+
+        return self._ramp_design
+
+    def solve_ramp(self, res):
+        '''
+        Solve for the orbital ramp which best explains the residuals *res*.
+
+        The ramp minimises the sum of squared weighted residuals of the scene,
+        using the combined weights of the target, with the parameters
+        constrained to their ``ranges``. Leaves with non-finite residuals are
+        ignored.
+
+        :returns: array with the ramp parameters
+        '''
+        design = self.get_ramp_design()
+        weights = self.get_combined_weight()
+
+        usable = num.isfinite(res)
+        a = design[usable] * weights[usable, num.newaxis]
+        b = res[usable] * weights[usable]
+        params, _, _, _ = num.linalg.lstsq(a, b, rcond=None)
+
+        ranges = self.target_ranges
+        xmin, xmax = num.array([
+            (ranges[p.name].start, ranges[p.name].stop)
+            for p in self.available_parameters]).T
+
+        if num.all((xmin <= params) & (params <= xmax)):
+            return params
+
+        if num.all(xmin < xmax):
+            return lsq_linear(a, b, bounds=(xmin, xmax)).x
+
+        return num.clip(params, xmin, xmax)
+
     def post_process(self, engine, source, statics):
         """Applies the objective function.
 
         As a result the weighted misfits are given and the observed and
-        synthetic data. For the satellite target the orbital ramp is
-        calculated and applied here."""
+        synthetic data. The orbital ramp is applied afterwards, in
+        :py:meth:`finalize_modelling`, as it depends on the target
+        parameters of the model."""
         scene = self.scene
         quadtree = scene.quadtree
 
         obs = quadtree.leaf_medians
 
-        if self.misfit_config.optimise_orbital_ramp:
-            stat_level = num.full_like(obs, self.parameter_values['offset'])
-
-            stat_level += (quadtree.leaf_center_distance[:, 0]
-                           * self.parameter_values['ramp_east'])
-            stat_level += (quadtree.leaf_center_distance[:, 1]
-                           * self.parameter_values['ramp_north'])
-            statics['displacement.los'] += stat_level
-
         stat_syn = statics['displacement.los']
 
         res = obs - stat_syn
 
+        ramp = None
+        if self.solve_orbital_ramp:
+            ramp = self.solve_ramp(res)
+            stat_level = num.dot(self.get_ramp_design(), ramp)
+            res = res - stat_level
+
         misfit_value = res
         misfit_norm = obs
 
         mf = num.vstack([misfit_value, misfit_norm]).T
+
+        orbital_ramp = None
+        if ramp is not None:
+            orbital_ramp = dict(
+                (p.name, float(v))
+                for (p, v) in zip(self.available_parameters, ramp))
+
+        if self._result_mode == 'sparse':
+            return SparseSatelliteMisfitResult(mf, orbital_ramp)
+
         result = SatelliteMisfitResult(
-            misfits=mf)
+            misfits=mf,
+            orbital_ramp=orbital_ramp)
 
         if self._result_mode == 'full':
+            if ramp is not None:
+                statics = dict(statics)
+                statics['displacement.los'] = \
+                    statics['displacement.los'] + stat_level
+
             result.statics_syn = statics
             result.statics_obs = quadtree.leaf_medians
 
@@ -205,9 +302,56 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
     def prepare_modelling(self, engine, source, targets):
         return [self]
 
+    def get_orbital_ramp(self):
+        quadtree = self.scene.quadtree
+        stat_level = num.full(
+            quadtree.nleaves, self.parameter_values['offset'])
+
+        stat_level += (quadtree.leaf_center_distance[:, 0]
+                       * self.parameter_values['ramp_east'])
+        stat_level += (quadtree.leaf_center_distance[:, 1]
+                       * self.parameter_values['ramp_north'])
+
+        return stat_level
+
     def finalize_modelling(
             self, engine, source, modelling_targets, modelling_results):
-        return modelling_results[0]
+
+        result = modelling_results[0]
+        if not self.misfit_config.optimise_orbital_ramp \
+                or self.solve_orbital_ramp \
+                or isinstance(result, gf.SeismosizerError):
+            return result
+
+        stat_level = self.get_orbital_ramp()
+
+        misfits = result.misfits.copy()
+        misfits[:, 0] -= stat_level
+        if isinstance(result, SparseMisfitResult):
+            return SparseSatelliteMisfitResult(misfits)
+
+        result_ramp = SatelliteMisfitResult(misfits=misfits)
+
+        if result.statics_syn is not None:
+            statics_syn = dict(result.statics_syn)
+            statics_syn['displacement.los'] = \
+                statics_syn['displacement.los'] + stat_level
+            result_ramp.statics_syn = statics_syn
+            result_ramp.statics_obs = result.statics_obs
+
+        return result_ramp
+
+    def get_solved_parameter_values(self, result):
+        if not self.solve_orbital_ramp \
+                or not isinstance(
+                    result,
+                    (SatelliteMisfitResult, SparseSatelliteMisfitResult)) \
+                or result.orbital_ramp is None:
+            return None
+
+        return num.array(
+            [result.orbital_ramp[p.name] for p in self.parameters],
+            dtype=num.float)
 
     def init_bootstrap_residuals(self, nbootstraps, rstate=None):
         logger.info('Scene %s, bootstrapping residuals from noise pertubations'
@@ -237,8 +381,10 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
 
 
 __all__ = '''
+    OrbitalRampModeChoice
     SatelliteTargetGroup
     SatelliteMisfitConfig
     SatelliteMisfitTarget
     SatelliteMisfitResult
+    SparseSatelliteMisfitResult
 '''.split()
@@ -11,7 +11,8 @@ from pyrocko.guts_array import Array
 
 from grond.dataset import NotFound
 
-from ..base import (MisfitConfig, MisfitTarget, MisfitResult, TargetGroup)
+from ..base import (MisfitConfig, MisfitTarget, MisfitResult,
+                    SparseMisfitResult, TargetGroup, traveltime_cache)
 from grond.meta import has_get_plot_classes
 
 guts_prefix = 'grond'
@@ -66,6 +67,12 @@ class WaveformMisfitConfig(MisfitConfig):
         default=0.0,
         help='If non-zero, allow synthetic and observed traces to be shifted '
              'against each other by up to +/- the given value [s].')
+    traveltime_tolerance = Float.T(
+        optional=True,
+        help='If set, travel times for ``tmin``, ``tmax`` and '
+             '``pick_synthetic_traveltime`` are computed for source depth '
+             'and distance rounded to multiples of this value [m] and '
+             'cached.')
     autoshift_penalty_max = Float.T(
         default=0.0,
         help='If non-zero, a penalty misfit is added for non-zero shift '
@@ -253,6 +260,16 @@ class WaveformMisfitResult(gf.Result, MisfitResult):
     piggyback_subresults = List.T(WaveformPiggybackSubresult.T())
 
 
+class SparseWaveformMisfitResult(SparseMisfitResult):
+    '''Lightweight waveform result in ``sparse`` result mode.'''
+
+    def __init__(self, misfits, piggyback_subresults=None):
+        SparseMisfitResult.__init__(self, misfits)
+        self.piggyback_subresults = piggyback_subresults or []
+        self.tobs_shift = None
+        self.tsyn_pick = None
+
+
 @has_get_plot_classes
 class WaveformMisfitTarget(gf.Target, MisfitTarget):
     flip_norm = Bool.T(default=False)
@@ -287,8 +304,11 @@ class WaveformMisfitTarget(gf.Target, MisfitTarget):
     def get_taper_params(self, engine, source):
         store = engine.get_store(self.store_id)
         config = self.misfit_config
-        tmin_fit = source.time + store.t(config.tmin, source, self)
-        tmax_fit = source.time + store.t(config.tmax, source, self)
+        tolerance = config.traveltime_tolerance
+        tmin_fit = source.time + traveltime_cache.t(
+            store, config.tmin, source, self, tolerance)
+        tmax_fit = source.time + traveltime_cache.t(
+            store, config.tmax, source, self, tolerance)
         if config.fmin > 0.0:
             tfade = 1.0/config.fmin
         else:
@@ -320,8 +340,9 @@ class WaveformMisfitTarget(gf.Target, MisfitTarget):
 
         if config.pick_synthetic_traveltime and config.pick_phasename:
             store = engine.get_store(self.store_id)
-            tsyn = source.time + store.t(
-                config.pick_synthetic_traveltime, source, self)
+            tsyn = source.time + traveltime_cache.t(
+                store, config.pick_synthetic_traveltime, source, self,
+                config.traveltime_tolerance)
 
             marker = ds.get_pick(
                 source.name,
@@ -565,14 +586,15 @@ tautoshift**2 / tautoshift_max**2``
             tshift=tshift,
             cc=ctr)
 
+        result.piggyback_subresults = piggyback_results
+
     elif result_mode == 'sparse':
-        result = WaveformMisfitResult(
-            misfits=num.array([[m, n]], dtype=num.float))
+        result = SparseWaveformMisfitResult(
+            num.array([[m, n]], dtype=num.float),
+            piggyback_results)
     else:
         assert False
 
-    result.piggyback_subresults = piggyback_results
-
     return result
 
 
@@ -674,6 +696,7 @@ __all__ = '''
     WaveformMisfitConfig
     WaveformMisfitTarget
     WaveformMisfitResult
+    SparseWaveformMisfitResult
     WaveformPiggybackSubtarget
     WaveformPiggybackSubresult
 '''.split()
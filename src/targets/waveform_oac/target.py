@@ -6,7 +6,7 @@ from pyrocko.guts import Float, Int
 from pyrocko import gf
 
 from ..base import (
-    MisfitTarget, TargetGroup, MisfitResult)
+    MisfitTarget, TargetGroup, MisfitResult, SparseMisfitResult)
 
 from ..waveform.target import WaveformPiggybackSubtarget, \
     WaveformPiggybackSubresult
@@ -57,6 +57,9 @@ class WOACTarget(MisfitTarget):
 
     can_bootstrap_weights = True
 
+    # piggyback subtargets are attached to the waveform targets per source
+    can_batch_modelling = False
+
     def __init__(self, **kwargs):
         MisfitTarget.__init__(self, **kwargs)
         self.piggy_ids = set()
@@ -87,10 +90,14 @@ class WOACTarget(MisfitTarget):
     def finalize_modelling(
             self, engine, source, modelling_targets, modelling_results):
 
-        from ..waveform.target import WaveformMisfitResult
+        from ..waveform.target import WaveformMisfitResult, \
+            SparseWaveformMisfitResult
+
         amps = []
         for mtarget, mresult in zip(modelling_targets, modelling_results):
-            if isinstance(mresult, WaveformMisfitResult):
+            if isinstance(
+                    mresult,
+                    (WaveformMisfitResult, SparseWaveformMisfitResult)):
                 for sr in list(mresult.piggyback_subresults):
                     try:
                         self.piggy_ids.remove(sr.piggy_id)
@@ -109,10 +116,11 @@ class WOACTarget(MisfitTarget):
         amp_syn = num.median(amps[mask, 1])
         m = num.abs(num.log(amp_obs / amp_syn))**self.norm_exponent
 
-        result = WOACMisfitResult(
-            misfits=num.array([[m, 1.]], dtype=num.float))
+        misfits = num.array([[m, 1.]], dtype=num.float)
+        if self._result_mode == 'sparse':
+            return SparseMisfitResult(misfits)
 
-        return result
+        return WOACMisfitResult(misfits=misfits)
 
 
 class WOACMisfitResult(MisfitResult):
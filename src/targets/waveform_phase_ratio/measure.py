@@ -3,6 +3,8 @@ from pyrocko import gf, trace
 from pyrocko.guts import Object, Float, StringChoice, List, String
 from pyrocko.gui import marker
 
+from ..base import traveltime_cache
+
 
 guts_prefix = 'grond'
 
@@ -83,6 +85,11 @@ class FeatureMeasure(Object):
     channels = List.T(String.T())
     quantity = WaveformQuantity.T(default='displacement')
     method = FeatureMethod.T(default='peak_component')
+    traveltime_tolerance = Float.T(
+        optional=True,
+        help='If set, travel times for ``timing_tmin`` and ``timing_tmax`` '
+             'are computed for source depth and distance rounded to '
+             'multiples of this value [m] and cached.')
 
     def get_nmodelling_targets(self):
         return len(self.channels)
@@ -131,8 +138,12 @@ class FeatureMeasure(Object):
 
             store = engine.get_store(target.store_id)
 
-            tmin = source.time + store.t(self.timing_tmin, source, target)
-            tmax = source.time + store.t(self.timing_tmax, source, target)
+            tmin = source.time + traveltime_cache.t(
+                store, self.timing_tmin, source, target,
+                self.traveltime_tolerance)
+            tmax = source.time + traveltime_cache.t(
+                store, self.timing_tmax, source, target,
+                self.traveltime_tolerance)
 
             if self.fmin is not None and self.fmax is not None:
                 freqlimits = [
@@ -6,7 +6,7 @@ from pyrocko.guts import Float, Tuple, String, Bool
 from pyrocko import gf
 
 from ..base import (
-    MisfitTarget, TargetGroup, MisfitResult)
+    MisfitTarget, TargetGroup, MisfitResult, SparseMisfitResult)
 from . import measure as fm
 from grond import dataset
 from grond.meta import has_get_plot_classes
@@ -229,8 +229,12 @@ class PhaseRatioTarget(gf.Location, MisfitTarget):
             misfit = num.abs(res_a)
             norm = 1.0
 
+            misfits = num.array([[misfit, norm]], dtype=num.float)
+            if self._result_mode == 'sparse':
+                return SparseMisfitResult(misfits)
+
             result = PhaseRatioResult(
-                misfits=num.array([[misfit, norm]], dtype=num.float),
+                misfits=misfits,
                 a_obs=a_obs,
                 b_obs=b_obs,
                 a_syn=a_syn,
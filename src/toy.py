@@ -93,6 +93,9 @@ class ToyProblem(Problem):
                 [t.obs_distance for t in self.targets],
                 dtype=num.float)
 
+    def evaluate_many(self, xs, mask=None):
+        return self.misfits_many(xs, mask=mask)
+
     def misfits(self, x, mask=None):
         self._setup_modelling()
         distances = num.sqrt(
@@ -102,9 +105,17 @@ class ToyProblem(Problem):
         misfits[:, 0] = num.abs(distances - self._obs_distances)
         misfits[:, 1] = num.ones(self.ntargets) \
             * num.mean(num.abs(self._obs_distances))
+
+        if mask is not None:
+            misfits[num.logical_not(mask), :] = num.nan
+
         return misfits
 
-    def misfits_many(self, xs):
+    def misfits_many(self, xs, mask=None, reject=None, nstages=4):
+        if reject is not None:
+            return Problem.misfits_many(
+                self, xs, mask=mask, reject=reject, nstages=nstages)
+
         self._setup_modelling()
         distances = num.sqrt(
             num.sum(
@@ -118,6 +129,9 @@ class ToyProblem(Problem):
 
         misfits[:, :, 1] = num.mean(num.abs(self._obs_distances))
 
+        if mask is not None:
+            misfits[:, num.logical_not(mask), :] = num.nan
+
         return misfits
 
     def xref(self):
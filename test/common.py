@@ -0,0 +1,62 @@
+import numpy as num
+
+from pyrocko import gf
+from grond.toy import scenario, ToyProblem
+from grond.problems.base import ModelHistory
+from grond.optimisers.highscore.optimiser import Chains
+
+
+def make_toy_problem(
+        station_setup='wellposed', noise_setup='noisefree', **kwargs):
+
+    '''
+    Get a toy problem with the search ranges used throughout the tests.
+
+    Extra keyword arguments are passed on to :py:class:`ToyProblem`.
+    '''
+
+    source, targets = scenario(station_setup, noise_setup)
+
+    return ToyProblem(
+        name='toy_problem',
+        ranges={
+            'north': gf.Range(start=-10., stop=10.),
+            'east': gf.Range(start=-10., stop=10.),
+            'depth': gf.Range(start=0., stop=10.)},
+        base_source=source,
+        targets=targets,
+        **kwargs)
+
+
+def make_chains(problem, nmodels=200, nchains=5, rstate=None):
+    '''
+    Get chains filled with uniformly drawn models, misfit is the distance of
+    a model to the centre of the search space, differently scaled for each
+    chain.
+    '''
+
+    if rstate is None:
+        rstate = num.random.RandomState(23)
+
+    xbounds = problem.get_parameter_bounds()
+    xs = rstate.uniform(
+        xbounds[:, 0], xbounds[:, 1], size=(nmodels, problem.nparameters))
+
+    history = ModelHistory(problem, nchains=nchains, mode='w')
+    chains = Chains(
+        problem, history, nchains=nchains,
+        nlinks_cap=int(round(8. * problem.nparameters + 1)))
+
+    history.extend(
+        xs,
+        num.zeros((nmodels, problem.nmisfits, 2)),
+        model_misfits(problem, xs, nchains))
+
+    return chains
+
+
+def model_misfits(problem, xs, nchains):
+    xbounds = problem.get_parameter_bounds()
+    xcentre = num.mean(xbounds, axis=1)
+    distances = num.sqrt(num.sum((xs - xcentre[num.newaxis, :])**2, axis=1))
+    return distances[:, num.newaxis] * (1.0 + 0.1 * num.arange(nchains))
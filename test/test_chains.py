@@ -0,0 +1,142 @@
+from __future__ import print_function
+
+import shutil
+import tempfile
+
+import numpy as num
+
+from numpy.testing import assert_equal
+from grond.problems.base import ModelHistory
+from grond.optimisers.highscore.optimiser import Chains, \
+    HighScoreOptimiser, UniformSamplerPhase, DirectedSamplerPhase
+
+from .common import make_toy_problem
+
+
+def reference_chains(gbmss, nlinks_cap):
+    nmodels, nchains = gbmss.shape
+    chains_m = num.zeros((nchains, nlinks_cap))
+    chains_i = num.zeros((nchains, nlinks_cap), dtype=num.int)
+    accept = num.zeros((nmodels, nchains), dtype=num.bool)
+    nlinks = 0
+    for imodel in range(nmodels):
+        chains_m[:, nlinks] = gbmss[imodel, :]
+        chains_i[:, nlinks] = imodel
+        nlinks += 1
+        for ichain in range(nchains):
+            isort = num.argsort(chains_m[ichain, :nlinks], kind='stable')
+            chains_m[ichain, :nlinks] = chains_m[ichain, isort]
+            chains_i[ichain, :nlinks] = chains_i[ichain, isort]
+
+        if nlinks == nlinks_cap:
+            accept[imodel, :] = chains_i[:, nlinks_cap-1] != imodel
+            nlinks -= 1
+        else:
+            accept[imodel, :] = True
+
+    return chains_m[:, :nlinks], chains_i[:, :nlinks], accept
+
+
+def test_chains_insert():
+    problem = make_toy_problem()
+    nchains = 7
+    nlinks_cap = 12
+
+    num.random.seed(23)
+    nmodels = 500
+    gbmss = num.random.random((nmodels, nchains))
+    # ties and failed models
+    gbmss[::5, :] = num.round(gbmss[::5, :], 1)
+    gbmss[::17, 3] = num.nan
+
+    chains_m_ref, chains_i_ref, accept_ref = reference_chains(
+        gbmss, nlinks_cap)
+
+    for nblock in [1, 3, 100]:
+        history = ModelHistory(problem, nchains=nchains, mode='w')
+        chains = Chains(problem, history, nchains, nlinks_cap)
+
+        accept_sum = num.zeros(nchains, dtype=num.int)
+        for ioffset in range(0, nmodels, nblock):
+            n = min(nblock, nmodels - ioffset)
+            history.extend(
+                num.zeros((n, problem.nparameters)),
+                num.zeros((n, problem.nmisfits, 2)),
+                gbmss[ioffset:ioffset+n, :])
+
+            accept_sum += num.sum(accept_ref[ioffset:ioffset+n, :], axis=0)
+            assert_equal(chains.accept_sum, accept_sum)
+
+        assert chains.nlinks == nlinks_cap - 1
+        assert_equal(chains.chains_m[:, :chains.nlinks], chains_m_ref)
+        assert_equal(chains.chains_i[:, :chains.nlinks], chains_i_ref)
+        assert_equal(chains.accept_log, accept_ref[-100:, :].T)
+
+
+def test_early_rejection():
+    # with model independent normalisation, early rejection must not change
+    # the outcome of the optimisation
+
+    rundir = tempfile.mkdtemp(prefix='grond-test-')
+    results = []
+    try:
+        for early_rejection in [False, True]:
+            num.random.seed(23)
+            problem = make_toy_problem()
+            optimiser = HighScoreOptimiser(
+                sampler_phases=[
+                    UniformSamplerPhase(niterations=100),
+                    DirectedSamplerPhase(niterations=400)],
+                nbootstrap=10,
+                early_rejection=early_rejection)
+
+            optimiser.init_bootstraps(problem)
+
+            chains_all = []
+
+            def chains(problem, history):
+                chains = HighScoreOptimiser.chains(
+                    optimiser, problem, history)
+                chains_all.append(chains)
+                return chains
+
+            optimiser.chains = chains
+            optimiser.optimise(
+                problem, rundir=rundir if early_rejection else None)
+
+            results.append(chains_all[0])
+
+        chains_ref, chains = results
+        assert_equal(chains.chains_i, chains_ref.chains_i)
+        assert_equal(chains.chains_m, chains_ref.chains_m)
+        assert_equal(chains.accept_sum, chains_ref.accept_sum)
+
+        # skipped targets are recorded as NaN, evaluated ones as usual
+        history = chains.history
+        misfits = history.misfits
+        assert not num.any(num.isinf(misfits))
+        evaluated = num.logical_not(num.isnan(misfits[:, :, 0]))
+        rejected = num.logical_not(num.all(evaluated, axis=1))
+        assert num.any(rejected)
+        assert_equal(
+            misfits[evaluated], chains_ref.history.misfits[evaluated])
+
+        assert num.all(num.isnan(history.bootstrap_misfits[rejected, :]))
+        assert_equal(
+            history.bootstrap_misfits[~rejected, :],
+            chains_ref.history.bootstrap_misfits[~rejected, :])
+
+        history = ModelHistory(
+            problem, nchains=optimiser.nchains, path=rundir, mode='r')
+
+        assert_equal(history.get_attribute('rejected'), rejected)
+
+        # when read back, rejected models are infinitely bad
+        assert_equal(num.isinf(history.misfits[:, :, 0]), ~evaluated)
+        assert num.all(num.isinf(history.bootstrap_misfits[rejected, :]))
+        gms = problem.combine_misfits(history.misfits)
+        assert num.all(num.isinf(gms[rejected]))
+        assert num.all(num.isfinite(gms[~rejected]))
+
+    finally:
+        shutil.rmtree(rundir)
@@ -0,0 +1,206 @@
+from __future__ import print_function
+
+import time
+
+import numpy as num
+
+from numpy.testing import assert_equal, assert_allclose
+
+from .common import make_toy_problem
+
+
+def make_problem(norm_exponent=2, families=('a',)):
+    problem = make_toy_problem(norm_exponent=norm_exponent)
+    for itarget, target in enumerate(problem.targets):
+        target.normalisation_family = families[itarget % len(families)]
+        target.manual_weight = 1.0 + 0.1 * itarget
+
+    return problem
+
+
+def family_mask_reference(problem):
+    '''
+    Family numbering of the original implementation.
+    '''
+
+    family_names = set()
+    families = []
+    for target in problem.targets:
+        family_names.add(target.normalisation_family)
+        families.extend([len(family_names) - 1] * target.nmisfits)
+
+    return num.array(families), len(family_names)
+
+
+def combine_misfits_reference(
+        problem, misfits,
+        extra_weights=None,
+        extra_residuals=None,
+        get_contributions=False):
+
+    '''
+    Plain implementation of Problem.combine_misfits, for comparison.
+    '''
+
+    exp, root = problem.get_norm_functions()
+
+    def inter_family_weights2(ns):
+        family, nfamilies = family_mask_reference(problem)
+        ws = num.zeros(ns.shape)
+        for ifamily in range(nfamilies):
+            mask = family == ifamily
+            ws[:, mask] = (1.0 / root(
+                num.nansum(exp(ns[:, mask]), axis=1)))[:, num.newaxis]
+        return ws
+
+    if misfits.ndim == 2:
+        misfits = misfits[num.newaxis, :, :]
+        return combine_misfits_reference(
+            problem,
+            misfits,
+            extra_weights,
+            extra_residuals,
+            get_contributions)[0, ...]
+
+    if extra_weights is not None or extra_residuals is not None:
+        if extra_weights is not None:
+            w = extra_weights[num.newaxis, :, :] \
+                * problem.get_target_weights()[num.newaxis, num.newaxis, :] \
+                * inter_family_weights2(
+                    misfits[:, :, 1])[:, num.newaxis, :]
+        else:
+            w = 1.0
+
+        if extra_residuals is not None:
+            r = extra_residuals[num.newaxis, :, :]
+        else:
+            r = 0.0
+
+        if get_contributions:
+            return exp(w*(misfits[:, num.newaxis, :, 0]+r)) \
+                / num.nansum(
+                    exp(w*misfits[:, num.newaxis, :, 1]),
+                    axis=2)[:, :, num.newaxis]
+
+        return root(
+            num.nansum(exp(w*(misfits[:, num.newaxis, :, 0]+r)), axis=2) /
+            num.nansum(exp(w*(misfits[:, num.newaxis, :, 1])), axis=2))
+    else:
+        w = problem.get_target_weights()[num.newaxis, :] \
+            * inter_family_weights2(misfits[:, :, 1])
+
+        if get_contributions:
+            return exp(w*misfits[:, :, 0]) \
+                / num.nansum(
+                    exp(w*misfits[:, :, 1]),
+                    axis=1)[:, num.newaxis]
+
+        return root(
+            num.nansum(exp(w*misfits[:, :, 0]), axis=1) /
+            num.nansum(exp(w*misfits[:, :, 1]), axis=1))
+
+
+def make_misfits(problem, nmodels, nbootstrap=10):
+    rstate = num.random.RandomState(123)
+    xs = rstate.uniform(-10., 10., size=(nmodels, problem.nparameters))
+    misfits = problem.misfits_many(xs)
+    misfits[::7, 3, :] = num.nan
+
+    bweights = rstate.uniform(0., 2., size=(nbootstrap, problem.nmisfits))
+    bresiduals = rstate.normal(size=(nbootstrap, problem.nmisfits))
+    return misfits, bweights, bresiduals
+
+
+def test_combine_misfits_bit_compatible():
+    for norm_exponent in (1, 2):
+        for families in (
+                ('a',), ('a', 'b'), ('a', 'a', 'b', 'c'),
+                ('a', 'b', 'a', 'c', 'b')):
+            problem = make_problem(norm_exponent, families)
+            misfits, bweights, bresiduals = make_misfits(problem, 200)
+
+            for extra in (
+                    {},
+                    dict(extra_weights=bweights),
+                    dict(extra_residuals=bresiduals),
+                    dict(extra_weights=bweights,
+                         extra_residuals=bresiduals)):
+
+                for get_contributions in (False, True):
+                    kwargs = dict(extra, get_contributions=get_contributions)
+                    assert_equal(
+                        problem.combine_misfits(misfits, **kwargs),
+                        combine_misfits_reference(
+                            problem, misfits, **kwargs))
+
+                    assert_equal(
+                        problem.combine_misfits(misfits[5], **kwargs),
+                        combine_misfits_reference(
+                            problem, misfits[5], **kwargs))
+
+
+def benchmark_combine_misfits(nmodels=10000, nbootstrap=100, nrepeat=10):
+    problem = make_problem(2, ('a', 'b'))
+    misfits, bweights, bresiduals = make_misfits(
+        problem, nmodels, nbootstrap)
+
+    for name, kwargs in [
+            ('global', {}),
+            ('bootstrap', dict(
+                extra_weights=bweights, extra_residuals=bresiduals))]:
+
+        for label, combine in [
+                ('reference', lambda **kwargs: combine_misfits_reference(
+                    problem, misfits, **kwargs)),
+                ('combiner', lambda **kwargs: problem.combine_misfits(
+                    misfits, **kwargs))]:
+
+            t0 = time.time()
+            for i in range(nrepeat):
+                combine(**kwargs)
+
+            print('%-10s %-10s %8.2f ms' % (
+                name, label, (time.time() - t0) / nrepeat * 1000.))
+
+
+def test_combine_misfits_blocks():
+    problem = make_problem(2, ('a', 'b'))
+    misfits, bweights, bresiduals = make_misfits(problem, 500)
+
+    for kwargs in (
+            {},
+            dict(extra_weights=bweights, extra_residuals=bresiduals),
+            dict(extra_weights=bweights, get_contributions=True)):
+
+        expect = combine_misfits_reference(problem, misfits, **kwargs)
+
+        # memory budget for a few models per block, with a partial last block
+        nbytes_model = 4 * 8 * bweights.shape[0] * problem.nmisfits
+        for memory_limit in (1, nbytes_model * 7, nbytes_model * 1000):
+            assert_equal(
+                problem.combine_misfits(
+                    misfits, memory_limit=memory_limit, **kwargs),
+                expect)
+
+        assert_allclose(
+            problem.combine_misfits(
+                misfits, single_precision=True, memory_limit=nbytes_model*7,
+                **kwargs),
+            expect, rtol=1e-5)
+
+
+def test_family_mask_non_contiguous():
+    families = ('a', 'b', 'a', 'c', 'b')
+    problem = make_problem(2, families)
+    assert problem.nmisfits == problem.ntargets == 10
+
+    # targets of a family seen before join the most recently introduced
+    # family
+    family, nfamilies = problem.get_family_mask()
+    assert nfamilies == 3
+    assert_equal(family, [0, 1, 1, 2, 2, 2, 2, 2, 2, 2])
+    assert_equal(family, family_mask_reference(problem)[0])
+
+
+if __name__ == '__main__':
+    benchmark_combine_misfits()
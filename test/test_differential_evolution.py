@@ -0,0 +1,101 @@
+from __future__ import print_function
+
+import shutil
+import tempfile
+
+import numpy as num
+
+from numpy.testing import assert_equal
+from grond.problems.base import ModelHistory, load_problem_data
+from grond.optimisers.differential_evolution import \
+    DifferentialEvolutionOptimiser
+
+from .common import make_toy_problem
+
+
+def test_differential_evolution():
+    num.random.seed(23)
+    problem = make_toy_problem()
+
+    for mutation_strategy in ['rand_1', 'current_to_best_1']:
+        optimiser = DifferentialEvolutionOptimiser(
+            ngenerations=50,
+            nbootstrap=10,
+            mutation_strategy=mutation_strategy)
+
+        optimiser.init_bootstraps(problem)
+
+        histories = []
+
+        def population(problem, history):
+            histories.append(history)
+            return DifferentialEvolutionOptimiser.population(
+                optimiser, problem, history)
+
+        optimiser.population = population
+        optimiser.optimise(problem)
+
+        history = histories[0]
+        assert history.nmodels == optimiser.niterations
+        assert history.bootstrap_misfits.shape == (
+            optimiser.niterations, optimiser.nchains)
+
+        gms_initial = history.bootstrap_misfits[:optimiser.npop, 0]
+        gms_final = history.bootstrap_misfits[-optimiser.npop:, 0]
+        assert num.min(gms_final) < 0.1 * num.min(gms_initial)
+
+        status = optimiser.get_status(history)
+        assert status.ncolumns == 3
+
+
+def test_differential_evolution_workers():
+    problem = make_toy_problem()
+
+    results = []
+    for nworkers in [1, 2]:
+        num.random.seed(23)
+        optimiser = DifferentialEvolutionOptimiser(
+            ngenerations=3, nbootstrap=4)
+
+        optimiser.init_bootstraps(problem)
+        rundir = tempfile.mkdtemp(prefix='grond-test-')
+        try:
+            optimiser.optimise(problem, rundir=rundir, nworkers=nworkers)
+            results.append(load_problem_data(
+                rundir, problem, nchains=optimiser.nchains))
+        finally:
+            shutil.rmtree(rundir)
+
+    # generations are drawn before being evaluated, independent of nworkers
+    for a, b in zip(*results):
+        assert_equal(a, b)
+
+
+def test_differential_evolution_no_misfits():
+    num.random.seed(23)
+    problem = make_toy_problem()
+    optimiser = DifferentialEvolutionOptimiser(ngenerations=2, nbootstrap=4)
+    optimiser._tlog_last = 0
+
+    # no member with a valid global misfit
+    history = ModelHistory(problem, nchains=optimiser.nchains, mode='w')
+    xs = num.array([problem.get_random_model() for i in range(optimiser.npop)])
+    history.extend(
+        xs,
+        num.zeros((optimiser.npop, problem.nmisfits, 2)),
+        num.full((optimiser.npop, optimiser.nchains), num.nan))
+
+    population = optimiser.population(problem, history)
+    assert population.complete
+    assert population.best_member(0) is None
+
+    optimiser.log_progress(problem, 1, population)
+
+    status = optimiser.get_status(history)
+    assert num.all(num.isnan(list(status.values)[2]))
+
+
+if __name__ == '__main__':
+    test_differential_evolution()
+    test_differential_evolution_workers()
+    test_differential_evolution_no_misfits()
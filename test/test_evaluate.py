@@ -0,0 +1,242 @@
+from __future__ import print_function
+
+import numpy as num
+
+from numpy.testing import assert_equal
+from pyrocko import gf
+from pyrocko.guts import Float
+from grond.meta import Parameter
+from grond.problems.base import Problem
+from grond.targets import MisfitTarget, MisfitResult, SparseMisfitResult
+
+
+class CountingEngine(object):
+    '''
+    Stand-in for the GF engine, the "synthetics" are the source locations.
+    '''
+
+    def __init__(self):
+        self.nsources = []
+
+    def process(self, sources, targets):
+        if not isinstance(sources, list):
+            sources = [sources]
+
+        self.nsources.append(len(sources))
+
+        class Response(object):
+            pass
+
+        resp = Response()
+        resp.results_list = [
+            [(source.north_shift, source.east_shift) for target in targets]
+            for source in sources]
+
+        return resp
+
+
+class PointTarget(MisfitTarget):
+    '''
+    Misfit is the distance of the source to a point, plus an offset which is
+    a target parameter.
+    '''
+
+    north = Float.T(default=0.)
+    east = Float.T(default=0.)
+
+    def __init__(self, **kwargs):
+        MisfitTarget.__init__(self, **kwargs)
+        self.parameters = [Parameter('offset', 'm')]
+        self.parameter_values = {}
+
+    def string_id(self):
+        return self.path
+
+    @property
+    def target_ranges(self):
+        return {'offset': gf.Range(start=0., stop=1.)}
+
+    def prepare_modelling(self, engine, source, targets):
+        return [self]
+
+    def finalize_modelling(
+            self, engine, source, modelling_targets, modelling_results):
+
+        north, east = modelling_results[0]
+        misfit = num.sqrt((north - self.north)**2 + (east - self.east)**2) \
+            + self.parameter_values['offset']
+
+        misfits = num.array([[misfit, 1.]])
+        if self._result_mode == 'sparse':
+            return SparseMisfitResult(misfits)
+
+        return MisfitResult(misfits=misfits)
+
+
+class UnbatchablePointTarget(PointTarget):
+    can_batch_modelling = False
+
+
+class ComponentsPointTarget(PointTarget):
+    '''
+    Separate misfits for the north and east distances.
+    '''
+
+    @property
+    def nmisfits(self):
+        return 2
+
+    def finalize_modelling(
+            self, engine, source, modelling_targets, modelling_results):
+
+        north, east = modelling_results[0]
+        offset = self.parameter_values['offset']
+        misfits = num.array([
+            [abs(north - self.north) + offset, 1.],
+            [abs(east - self.east) + offset, 1.]])
+
+        if self._result_mode == 'sparse':
+            return SparseMisfitResult(misfits)
+
+        return MisfitResult(misfits=misfits)
+
+
+class PointProblem(Problem):
+    problem_parameters = [
+        Parameter('north', 'm'),
+        Parameter('east', 'm')]
+
+    def get_source(self, x):
+        return gf.ExplosionSource(
+            north_shift=float(x[0]), east_shift=float(x[1]))
+
+
+def make_point_problem(target_class=PointTarget):
+    problem = PointProblem(
+        name='point_problem',
+        ranges={
+            'north': gf.Range(start=-10., stop=10.),
+            'east': gf.Range(start=-10., stop=10.)},
+        targets=[
+            target_class(path='t%i' % i, north=float(i), east=-float(i))
+            for i in range(3)])
+
+    problem._engine = CountingEngine()
+    return problem
+
+
+def make_models(problem, nmodels=10, nduplicates=0):
+    '''
+    Get random models, the last *nduplicates* differ from the first ones only
+    in their target parameters.
+    '''
+
+    rstate = num.random.RandomState(23)
+    xbounds = problem.get_parameter_bounds()
+    xs = rstate.uniform(
+        xbounds[:, 0], xbounds[:, 1], size=(nmodels, problem.nparameters))
+
+    nprob = len(problem.problem_parameters)
+    xs[nmodels-nduplicates:, :nprob] = xs[:nduplicates, :nprob]
+    return xs
+
+
+def test_evaluate_many():
+    problem = make_point_problem()
+    engine = problem.get_engine()
+    xs = make_models(problem, nmodels=10, nduplicates=3)
+
+    misfits_ref = num.array([problem.misfits(x) for x in xs])
+    assert not num.any(num.isnan(misfits_ref))
+    assert_equal(engine.nsources, [1] * 10)
+
+    # all sources in a single call, duplicate sources modelled once
+    engine.nsources = []
+    problem._modelling_cache = None
+    assert_equal(problem.evaluate_many(xs), misfits_ref)
+    assert_equal(engine.nsources, [7])
+
+    # targets which cannot be batched are evaluated model by model
+    problem = make_point_problem(UnbatchablePointTarget)
+    engine = problem.get_engine()
+    xs = make_models(problem, nmodels=10, nduplicates=3)
+    assert_equal(problem.evaluate_many(xs), misfits_ref)
+    assert_equal(engine.nsources, [1] * 10)
+
+    assert problem.evaluate_many(xs[:0]).shape == (0, problem.nmisfits, 2)
+
+
+def test_modelling_cache():
+    problem = make_point_problem()
+    engine = problem.get_engine()
+    x = make_models(problem, nmodels=1)[0]
+
+    def nsources(*args, **kwargs):
+        engine.nsources = []
+        problem.evaluate(*args, **kwargs)
+        return sum(engine.nsources)
+
+    assert nsources(x) == 1
+
+    # models differing only in target parameters reuse the synthetics
+    x2 = x.copy()
+    x2[2:] = 1. - x[2:]
+    assert nsources(x2) == 0
+    misfits = problem.misfits(x2)
+    assert not num.allclose(misfits, problem.misfits(x))
+
+    # different source
+    x3 = x.copy()
+    x3[0] += 1.
+    assert nsources(x3) == 1
+    assert nsources(x3) == 0
+
+    # the cache is invalidated if mask or result mode change
+    mask = num.array([True, False, True])
+    assert nsources(x3, mask=mask) == 1
+    assert nsources(x3, mask=mask) == 0
+    assert nsources(x3, mask=~mask) == 1
+    assert nsources(x3, mask=~mask, result_mode='sparse') == 1
+    assert nsources(x3, mask=~mask, result_mode='sparse') == 0
+    assert nsources(x3, result_mode='sparse') == 1
+
+    results = problem.evaluate(x3, mask=mask, result_mode='sparse')
+    assert isinstance(results[0], SparseMisfitResult)
+    assert isinstance(results[1], gf.SeismosizerError)
+
+    results = problem.evaluate(x3, mask=mask)
+    assert isinstance(results[0], MisfitResult)
+
+    # targets which cannot be batched are always modelled
+    problem = make_point_problem(UnbatchablePointTarget)
+    engine = problem.get_engine()
+    x = make_models(problem, nmodels=1)[0]
+    assert nsources(x) == 1
+    assert nsources(x) == 1
+
+
+def test_get_misfits():
+    problem = make_point_problem()
+    problem.targets[1] = ComponentsPointTarget(path='c', north=1., east=2.)
+    assert problem.nmisfits == 4
+
+    x = make_models(problem, nmodels=1)[0]
+
+    # sparse and full results are gathered alike
+    results_sparse = problem.evaluate(x, result_mode='sparse')
+    results_full = problem.evaluate(x, result_mode='full')
+    assert isinstance(results_sparse[1], SparseMisfitResult)
+    assert isinstance(results_full[1], MisfitResult)
+
+    misfits = problem.get_misfits(results_sparse)
+    assert_equal(misfits, problem.get_misfits(results_full))
+    assert not num.any(num.isnan(misfits))
+    assert_equal(misfits[1:3, :], results_sparse[1].misfits)
+
+    # targets without valid result get NaN
+    mask = num.array([True, False, True])
+    misfits_masked = problem.get_misfits(
+        problem.evaluate(x, mask=mask, result_mode='sparse'))
+
+    assert num.all(num.isnan(misfits_masked[1:3, :]))
+    assert_equal(misfits_masked[[0, 3], :], misfits[[0, 3], :])
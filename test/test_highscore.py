@@ -0,0 +1,356 @@
+from __future__ import print_function
+
+import shutil
+import tempfile
+
+import numpy as num
+
+from numpy.testing import assert_equal
+from nose.tools import assert_raises
+from pyrocko import gf
+from grond.meta import Parameter, Forbidden, GrondError
+from grond.problems.base import ModelHistory, load_problem_data
+from grond.optimisers.highscore.optimiser import HighScoreOptimiser, \
+    UniformSamplerPhase, DirectedSamplerPhase, LocalRefinementSamplerPhase, \
+    WarmStartSamplerPhase
+
+from .common import make_toy_problem, make_chains, model_misfits
+
+
+def make_optimiser(**kwargs):
+    return HighScoreOptimiser(
+        sampler_phases=[
+            UniformSamplerPhase(niterations=100),
+            DirectedSamplerPhase(niterations=300, surrogate=True),
+            LocalRefinementSamplerPhase(niterations=100)],
+        chain_length_factor=4.,
+        nbootstrap=5,
+        **kwargs)
+
+
+def run(problem, rundir, nmodels_stop=None, resume=False, nworkers=1,
+        **kwargs):
+    '''
+    Run the optimisation, the run is interrupted after *nmodels_stop*
+    models.
+    '''
+
+    num.random.seed(23)
+    optimiser = make_optimiser(**kwargs)
+    optimiser.init_bootstraps(problem)
+
+    if nmodels_stop is not None:
+        iter_samples = optimiser.iter_samples
+
+        def iter_samples_interrupted(problem, chains, iiter_start=0):
+            for task in iter_samples(problem, chains, iiter_start):
+                if task[0] >= nmodels_stop:
+                    break
+
+                yield task
+
+        optimiser.iter_samples = iter_samples_interrupted
+
+    optimiser.optimise(
+        problem, rundir=rundir, nworkers=nworkers, resume=resume)
+
+    return load_problem_data(rundir, problem, nchains=optimiser.nchains)
+
+
+def test_resume():
+    problem = make_toy_problem()
+    rundir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        xs_ref, misfits_ref, bootstraps_ref = run(problem, rundir)
+        assert xs_ref.shape[0] > 420
+    finally:
+        shutil.rmtree(rundir)
+
+    # interrupt in the directed phase and in the local refinement
+    for nmodels_stop in [150, 420]:
+        rundir = tempfile.mkdtemp(prefix='grond-test-')
+        try:
+            xs, _, _ = run(problem, rundir, nmodels_stop=nmodels_stop)
+            assert xs.shape[0] == nmodels_stop
+            assert_equal(xs, xs_ref[:nmodels_stop])
+
+            xs, misfits, bootstraps = run(problem, rundir, resume=True)
+            assert_equal(xs, xs_ref)
+            assert_equal(misfits, misfits_ref)
+            assert_equal(bootstraps, bootstraps_ref)
+
+        finally:
+            shutil.rmtree(rundir)
+
+
+def test_resume_early_rejection():
+    problem = make_toy_problem()
+    nchains = make_optimiser().nchains
+
+    def rejected(rundir):
+        history = ModelHistory(
+            problem, nchains=nchains, path=rundir, mode='r')
+        return history.get_attribute('rejected')
+
+    rundir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        xs_ref, misfits_ref, _ = run(problem, rundir, early_rejection=True)
+        rejected_ref = rejected(rundir)
+        assert num.any(rejected_ref)
+    finally:
+        shutil.rmtree(rundir)
+
+    rundir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        run(problem, rundir, nmodels_stop=300, early_rejection=True)
+        assert num.any(rejected(rundir))
+
+        xs, misfits, _ = run(
+            problem, rundir, resume=True, early_rejection=True)
+
+        assert_equal(xs, xs_ref)
+        assert_equal(misfits, misfits_ref)
+        assert_equal(rejected(rundir), rejected_ref)
+
+    finally:
+        shutil.rmtree(rundir)
+
+
+def test_workers():
+    problem = make_toy_problem()
+    rundir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        xs, misfits, _ = run(
+            problem, rundir, nworkers=2, early_rejection=True)
+
+    finally:
+        shutil.rmtree(rundir)
+
+    assert xs.shape[0] > 420
+
+    # models not rejected early have the misfits computed here
+    rejected = num.any(num.isinf(misfits[:, :, 0]), axis=1)
+    assert num.sum(~rejected) > 100
+    assert_equal(misfits[~rejected], problem.misfits_many(xs[~rejected]))
+
+
+def run_capturing_history(optimiser, problem):
+    histories = []
+
+    def chains(problem, history):
+        histories.append(history)
+        return HighScoreOptimiser.chains(optimiser, problem, history)
+
+    optimiser.chains = chains
+    optimiser.init_bootstraps(problem)
+    optimiser.optimise(problem)
+    return histories[0]
+
+
+def test_convergence_check():
+    problem = make_toy_problem()
+    chains = make_chains(problem)
+
+    phase = DirectedSamplerPhase(niterations=10000)
+    for iiter in range(0, 1000, 100):
+        assert phase.check_convergence(problem, iiter, chains) is None
+
+    # chains do not change, the phase is ended after the first window
+    phase = DirectedSamplerPhase(
+        niterations=10000,
+        convergence_window=100,
+        convergence_misfit_rtol=0.01,
+        convergence_spread_rtol=0.01)
+
+    for iiter in range(0, 100, 10):
+        assert phase.check_convergence(problem, iiter, chains) is None
+
+    termination = phase.check_convergence(problem, 100, chains)
+    assert termination.startswith('converged after 100 iterations')
+    assert 'best misfits' in termination and 'spread' in termination
+
+    # restarting the phase discards old snapshots
+    assert phase.check_convergence(problem, 0, chains) is None
+
+    # the model spread is only computed for snapshots and comparisons
+    nspread = []
+    standard_deviation_models = chains.standard_deviation_models
+
+    def standard_deviation_models_counting(*args):
+        nspread.append(1)
+        return standard_deviation_models(*args)
+
+    chains.standard_deviation_models = standard_deviation_models_counting
+    for iiter in range(0, 100):
+        assert phase.check_convergence(problem, iiter, chains) is None
+
+    assert len(nspread) == 9
+    assert phase.check_convergence(problem, 105, chains) is not None
+    assert len(nspread) == 10
+
+    phase = DirectedSamplerPhase(
+        niterations=10000,
+        convergence_window=100,
+        convergence_acceptance_rate_min=0.)
+
+    for iiter in range(0, 200, 10):
+        assert phase.check_convergence(problem, iiter, chains) is None
+
+
+def test_convergence_termination():
+    num.random.seed(23)
+    problem = make_toy_problem()
+
+    niterations_directed = 100000
+    optimiser = HighScoreOptimiser(
+        sampler_phases=[
+            UniformSamplerPhase(niterations=200),
+            DirectedSamplerPhase(
+                niterations=niterations_directed,
+                convergence_window=500,
+                convergence_misfit_rtol=0.01),
+            UniformSamplerPhase(niterations=50)],
+        nbootstrap=5)
+
+    history = run_capturing_history(optimiser, problem)
+
+    records = optimiser._phase_records
+    assert [record.phase for record in records] == [
+        'UniformSamplerPhase', 'DirectedSamplerPhase', 'UniformSamplerPhase']
+
+    assert records[0].iiter_end == records[1].iiter_begin == 200
+    assert records[0].termination is None
+
+    iiter_end = records[1].iiter_end
+    assert iiter_end < 200 + niterations_directed
+    assert records[1].termination.startswith('converged')
+
+    # the following phase is run completely
+    assert records[2].iiter_begin == iiter_end
+    assert history.nmodels == iiter_end + 50
+    assert optimiser.locate_sampler_phase(history.nmodels) is None
+
+
+def test_warm_start():
+    problem_old = make_toy_problem()
+    xs_old = num.array([
+        [1., 2., 3.],
+        [-8., 9., 1.],
+        [4., -5., 6.],
+        [1., 2., 3.]])
+    misfits_old = num.ones((xs_old.shape[0], problem_old.nmisfits, 2))
+    misfits_old[:, :, 0] = num.array([3., 1., 2., 3.])[:, num.newaxis]
+
+    rundir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        problem_old.dump_problem_info(rundir)
+        problem_old.dump_problem_data(rundir, xs_old, misfits_old)
+
+        # parameters are matched by name, new parameters start at the centre
+        # of their range and values are clipped to the new ranges
+        problem = make_toy_problem()
+        problem.problem_parameters = [
+            Parameter('depth', 'm'),
+            Parameter('north', 'm'),
+            Parameter('width', 'm')]
+        problem.ranges['north'] = gf.Range(start=-5., stop=5.)
+        problem.ranges['width'] = gf.Range(start=0., stop=2.)
+
+        phase = WarmStartSamplerPhase(
+            rundir=rundir, subset=None, niterations=10)
+
+        xs = phase.get_warm_models(problem)
+
+        # duplicates removed, best models first
+        assert_equal(xs, [
+            [1., -5., 1.],
+            [6., 4., 1.],
+            [3., 1., 1.]])
+
+        xbounds = problem.get_parameter_bounds()
+        for iiter in range(phase.niterations):
+            x = phase.get_sample(problem, iiter, None)
+            if iiter < xs.shape[0]:
+                assert_equal(x, xs[iiter])
+
+            assert num.all(xbounds[:, 0] <= x) and num.all(x <= xbounds[:, 1])
+
+        # forbidden warm models are replaced by uniform samples
+        def preconstrain(x):
+            if x[0] > 5.:
+                raise Forbidden()
+
+            return x
+
+        problem.preconstrain = preconstrain
+        x = phase.get_sample(problem, 1, None)
+        assert x[0] <= 5.
+        assert num.all(xbounds[:, 0] <= x) and num.all(x <= xbounds[:, 1])
+
+    finally:
+        shutil.rmtree(rundir)
+
+    phase = WarmStartSamplerPhase(rundir=rundir, niterations=10)
+    assert_raises(GrondError, phase.get_warm_models, problem)
+
+
+def test_local_refinement_poll():
+    num.random.seed(23)
+    problem = make_toy_problem()
+    chains = make_chains(problem)
+    history = chains.history
+    xbounds = problem.get_parameter_bounds()
+    xranges = xbounds[:, 1] - xbounds[:, 0]
+
+    phase = LocalRefinementSamplerPhase(niterations=1000, ichains=[1])
+    phase.update(problem, 0, chains)
+    x_centre = chains.best_model(1).copy()
+    misfit_centre = chains.best_model_misfit(1)
+
+    # compass search: each parameter stepped up and down, one at a time
+    npoll = 2 * problem.nparameters
+    xs = phase.get_samples(problem, 0, chains, npoll)
+    steps = (xs - x_centre[num.newaxis, :]) / xranges[num.newaxis, :]
+    assert_equal(num.sum(steps != 0., axis=1), 1)
+    assert_equal(
+        num.sort(steps[steps != 0.]),
+        num.repeat([-phase.step_begin, phase.step_begin], problem.nparameters))
+
+    history.extend(
+        xs,
+        num.zeros((npoll, problem.nmisfits, 2)),
+        model_misfits(problem, xs, history.nchains))
+
+    phase.update(problem, npoll, chains)
+    state = phase._states[0]
+    misfits_poll = model_misfits(problem, xs, history.nchains)[:, 1]
+    if num.min(misfits_poll) < misfit_centre:
+        # the search moves to the best poll model
+        assert_equal(state.x, xs[num.argmin(misfits_poll)])
+        assert state.step == phase.step_begin
+    else:
+        # the step size is reduced
+        assert_equal(state.x, x_centre)
+        assert state.step == phase.step_begin * phase.step_factor
+
+
+def test_local_refinement():
+    num.random.seed(23)
+    problem = make_toy_problem()
+
+    niterations_uniform = 200
+    optimiser = HighScoreOptimiser(
+        sampler_phases=[
+            UniformSamplerPhase(niterations=niterations_uniform),
+            LocalRefinementSamplerPhase(niterations=10000)],
+        nbootstrap=5)
+
+    history = run_capturing_history(optimiser, problem)
+
+    record = optimiser._phase_records[1]
+    assert record.termination.startswith('step size of all searches below')
+    assert history.nmodels == record.iiter_end < niterations_uniform + 10000
+
+    gms = problem.combine_misfits(history.misfits)
+    assert num.min(gms[niterations_uniform:]) \
+        < 0.1 * num.min(gms[:niterations_uniform])
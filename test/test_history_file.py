@@ -0,0 +1,114 @@
+from __future__ import print_function
+import os.path as op
+import shutil
+import tempfile
+import nose.tools as t
+
+import numpy as num
+
+from numpy.testing import assert_equal
+from grond.problems.base import ModelHistory, load_problem_data
+from grond.problems.history_file import ModelHistoryFile, \
+    ModelHistoryFileError, convert_rundir_to_history_file, \
+    convert_history_file_to_rundir
+
+from .common import make_toy_problem
+
+
+def test_history_file():
+    nparameters, nmisfits, nchains = 4, 7, 3
+    nmodels = 2500
+
+    rstate = num.random.RandomState(123)
+    xs = rstate.normal(size=(nmodels, nparameters))
+    misfits = rstate.uniform(0., 1., size=(nmodels, nmisfits, 2))
+    bootstraps = rstate.uniform(0., 1., size=(nmodels, nchains))
+
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        fn = op.join(tempdir, 'history')
+        hf = ModelHistoryFile.create(
+            fn, nparameters, nmisfits, nchains=nchains,
+            parameter_names=['a', 'b', 'c', 'd'], chunk_nmodels=100)
+
+        t.assert_raises(
+            ModelHistoryFileError,
+            ModelHistoryFile.create, fn, nparameters, nmisfits)
+
+        reader = ModelHistoryFile(fn)
+        t.assert_equal(reader.nmodels, 0)
+        t.assert_equal(reader.read_models().shape, (0, nparameters))
+
+        for i, j in [(0, 1), (1, 150), (150, 1000), (1000, nmodels)]:
+            hf.append(xs[i:j], misfits[i:j], bootstraps[i:j])
+
+        hf.close()
+
+        t.assert_equal(reader.nmodels, nmodels)
+        assert_equal(reader.read_models(), xs)
+        assert_equal(reader.read_misfits(), misfits)
+        assert_equal(reader.read_bootstrap_misfits(), bootstraps)
+
+        assert_equal(
+            reader.read_models(95, 1234, parameters=['d', 1]),
+            xs[95:1234, [3, 1]])
+
+        assert_equal(
+            reader.read_misfits(-10, None, misfits=[6, 'misfit.2']),
+            misfits[-10:, [6, 2], :])
+
+        assert_equal(
+            reader.read_bootstrap_misfits(99, 101, ichains=[2]),
+            bootstraps[99:101, [2]])
+
+        t.assert_raises(
+            ModelHistoryFileError, reader.read_models, parameters=['x'])
+
+        t.assert_raises(
+            ModelHistoryFileError, reader.append, xs, misfits, bootstraps)
+
+        reader.close()
+
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_history_file_convert():
+    p = make_toy_problem()
+
+    nchains = 3
+    nmodels = 30
+    rstate = num.random.RandomState(123)
+    xs = rstate.uniform(-10., 10., size=(nmodels, p.nparameters))
+    misfits = rstate.uniform(0., 1., size=(nmodels, p.nmisfits, 2))
+    bootstraps = rstate.uniform(0., 1., size=(nmodels, nchains))
+
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        rundir = op.join(tempdir, 'run')
+        p.dump_problem_info(rundir)
+        history = ModelHistory(p, nchains=nchains, path=rundir, mode='w')
+        history.extend(xs, misfits, bootstraps)
+        history.close()
+
+        fn = convert_rundir_to_history_file(
+            rundir, nchains=nchains, block_nmodels=7, chunk_nmodels=8)
+
+        with ModelHistoryFile(fn) as hf:
+            t.assert_equal(hf.header.problem_name, p.name)
+            t.assert_equal(
+                hf.header.parameter_names, ['north', 'east', 'depth'])
+            assert_equal(hf.read_models(parameters=['depth']), xs[:, 2:3])
+
+        rundir2 = op.join(tempdir, 'run2')
+        convert_history_file_to_rundir(fn, rundir2, block_nmodels=7)
+
+        xs2, misfits2, bootstraps2 = load_problem_data(
+            rundir2, p, nchains=nchains)
+
+        assert_equal(xs2, xs)
+        assert_equal(misfits2, misfits)
+        assert_equal(bootstraps2, bootstraps)
+
+    finally:
+        shutil.rmtree(tempdir)
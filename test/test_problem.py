@@ -1,24 +1,23 @@
 from __future__ import print_function
+import os.path as op
+import shutil
+import tempfile
 import nose.tools as t
 
 import numpy as num
 
 from numpy.testing import assert_almost_equal as assert_ae
-from pyrocko import gf
-from grond.toy import scenario, ToyProblem
+from pyrocko import gf, moment_tensor as mtm
+from grond.meta import GrondError
+from grond.problems.cmt.problem import CMTProblem
+from grond.problems.base import ModelHistory, load_problem_data, \
+    ProblemDataNotAvailable
 
+from .common import make_toy_problem
 
-def test_combine_misfits():
-    source, targets = scenario('wellposed', 'noisefree')
 
-    p = ToyProblem(
-        name='toy_problem',
-        ranges={
-            'north': gf.Range(start=-10., stop=10.),
-            'east': gf.Range(start=-10., stop=10.),
-            'depth': gf.Range(start=0., stop=10.)},
-        base_source=source,
-        targets=targets)
+def test_combine_misfits():
+    p = make_toy_problem()
 
     ngx, ngy, ngz = 11, 11, 11
     xg = num.zeros((ngz*ngy*ngx, 3))
@@ -51,7 +50,7 @@ def test_combine_misfits():
     # gms_2_contrib[imodel, ibootstrap, itarget]
 
     for ix, x in enumerate(xg):
-        misfits = p.evaluate(x)
+        misfits = p.misfits(x)
         # misfits[itarget, 0], misfits[itarget, 1]
         gm = p.combine_misfits(misfits)
         # gm is scalar
@@ -78,3 +77,232 @@ def test_combine_misfits():
         assert_ae(gm_2_contrib[1, :], gm_contrib)
         assert_ae(gms_2_contrib[ix, 0, :], gm_contrib)
         assert_ae(gms_2_contrib[ix, 1, :], gm_contrib)
+
+
+def test_prune_zero_weight_targets():
+    p = make_toy_problem()
+
+    ntargets = p.ntargets
+    iszero = num.zeros(ntargets, dtype=num.bool)
+    iszero[::3] = True
+
+    xs = num.random.RandomState(123).uniform(
+        -10., 10., size=(100, p.nparameters))
+
+    bweights = num.random.RandomState(23).uniform(
+        0., 2., size=(5, p.nmisfits))
+
+    def check(expect):
+        p._target_weights = None
+        p._family_mask = None
+        p._prunable_mask = None
+        p._misfit_combiner = None
+        for itarget, target in enumerate(p.targets):
+            target._combined_weight = num.array(
+                [0.0 if iszero[itarget] else 1.0])
+
+        prunable = p.get_prunable_mask()
+        num.testing.assert_equal(prunable, expect)
+
+        mask = p.get_modelling_mask()
+        misfits = p.misfits_many(xs)
+        misfits_pruned = p.misfits_many(xs, mask=mask)
+        if num.any(prunable):
+            t.assert_true(num.all(num.isnan(misfits_pruned[:, prunable, :])))
+
+        assert_ae(
+            p.combine_misfits(misfits),
+            p.combine_misfits(misfits_pruned))
+
+        assert_ae(
+            p.combine_misfits(misfits, extra_weights=bweights),
+            p.combine_misfits(misfits_pruned, extra_weights=bweights))
+
+    # single family: all zero-weight targets can be left out
+    check(iszero)
+
+    # zero-weight targets in a family with weighted targets enter the family
+    # normalisation and must be kept, unless there is only one such family
+    for itarget, target in enumerate(p.targets):
+        target.normalisation_family = 'a' if itarget < ntargets // 2 else 'b'
+
+    check(num.zeros(ntargets, dtype=num.bool))
+
+    # a family without any weight can be left out completely
+    order = num.argsort(~iszero, kind='mergesort')
+    p.targets = [p.targets[i] for i in order]
+    iszero = iszero[order]
+    for itarget, target in enumerate(p.targets):
+        target.normalisation_family = 'a' if iszero[itarget] else 'b'
+
+    check(iszero)
+
+
+def test_cmt_random_uniform():
+    p = CMTProblem(
+        name='cmt_problem',
+        base_source=gf.MTSource(),
+        ranges=dict(
+            time=gf.Range(-5., 5., relative='add'),
+            north_shift=gf.Range(-10e3, 10e3),
+            east_shift=gf.Range(-10e3, 10e3),
+            depth=gf.Range(1e3, 20e3),
+            magnitude=gf.Range(4., 7.),
+            rmnn=gf.Range(-1.41421, 1.41421),
+            rmee=gf.Range(-1.41421, 1.41421),
+            rmdd=gf.Range(-1.41421, 1.41421),
+            rmne=gf.Range(-1., 1.),
+            rmnd=gf.Range(-1., 1.),
+            rmed=gf.Range(-1., 1.),
+            duration=gf.Range(1., 10.)))
+
+    xbounds = p.get_parameter_bounds()
+
+    # random models are drawn as before sequences could be given
+    num.random.seed(23)
+    x_ref = num.zeros(p.nparameters)
+    for i in range(p.nparameters):
+        x_ref[i] = num.random.uniform(xbounds[i, 0], xbounds[i, 1])
+
+    x_ref[5:11] = mtm.random_m6()
+    state_ref = num.random.get_state()[1]
+
+    num.random.seed(23)
+    x = p.random_uniform(xbounds)
+    num.testing.assert_equal(x, x_ref)
+    num.testing.assert_equal(num.random.get_state()[1], state_ref)
+
+    # given numbers are used for the moment tensor too
+    u = num.random.RandomState(123).uniform(0., 1., p.nparameters)
+    x = num.array(p.random_uniform(xbounds, u=u))
+    x_scaled = xbounds[:, 0] + u * (xbounds[:, 1] - xbounds[:, 0])
+    assert_ae(x[:5], x_scaled[:5])
+    assert_ae(x[5:11], mtm.random_m6(x=u[5:11]))
+    assert_ae(x[11], x_scaled[11])
+
+
+def test_model_history_writer():
+    p = make_toy_problem()
+
+    nchains = 3
+    nmodels = 25
+    rstate = num.random.RandomState(123)
+    xs = rstate.uniform(-10., 10., size=(nmodels, p.nparameters))
+    misfits = rstate.uniform(0., 1., size=(nmodels, p.nmisfits, 2))
+    bootstraps = rstate.uniform(0., 1., size=(nmodels, nchains))
+
+    rundir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        history = ModelHistory(
+            p, nchains=nchains, path=rundir, mode='w',
+            writer_options=dict(flush_nmodels=10, flush_interval=1e9))
+
+        for imodel in range(5):
+            history.append(
+                xs[imodel], misfits[imodel], bootstraps[imodel])
+
+        # still buffered
+        t.assert_raises(
+            ProblemDataNotAvailable, load_problem_data, rundir, p,
+            nchains=nchains)
+
+        history.flush()
+        history.extend(xs[5:20], misfits[5:20], bootstraps[5:20])
+
+        # flushed by count
+        xs_, misfits_, bootstraps_ = load_problem_data(
+            rundir, p, nchains=nchains)
+
+        assert_ae(xs_, xs[:20])
+
+        history.extend(xs[20:], misfits[20:], bootstraps[20:])
+        history.close()
+
+        xs_, misfits_, bootstraps_ = load_problem_data(
+            rundir, p, nchains=nchains)
+
+        assert_ae(xs_, xs)
+        assert_ae(misfits_, misfits)
+        assert_ae(bootstraps_, bootstraps)
+
+    finally:
+        shutil.rmtree(rundir)
+
+
+def test_model_history_memmap():
+    p = make_toy_problem()
+
+    nchains = 3
+    nmodels = 25
+    rstate = num.random.RandomState(123)
+    xs = rstate.uniform(-10., 10., size=(nmodels, p.nparameters))
+    misfits = rstate.uniform(0., 1., size=(nmodels, p.nmisfits, 2))
+    bootstraps = rstate.uniform(0., 1., size=(nmodels, nchains))
+
+    class Listener(object):
+        def __init__(self, nmodels):
+            self.nmodels = nmodels
+
+        def extend(self, imodel, n, models, misfits):
+            t.assert_equal(imodel, self.nmodels)
+            t.assert_equal(models.shape[0], n)
+            self.nmodels += n
+
+    rundir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        history_w = ModelHistory(p, nchains=nchains, path=rundir, mode='w')
+        history_w.extend(xs[:10], misfits[:10], bootstraps[:10])
+        history_w.flush()
+
+        history = ModelHistory(
+            p, nchains=nchains, path=rundir, mode='r', memmap=True)
+
+        listener = Listener(history.nmodels)
+        history.add_listener(listener)
+
+        t.assert_equal(history.nmodels, 10)
+        assert_ae(history.models, xs[:10])
+        assert_ae(history.misfits, misfits[:10])
+        assert_ae(history.bootstrap_misfits, bootstraps[:10])
+
+        history_w.extend(xs[10:], misfits[10:], bootstraps[10:])
+        history_w.close()
+
+        history.update()
+        t.assert_equal(listener.nmodels, nmodels)
+        assert_ae(history.models, xs)
+        assert_ae(history.misfits, misfits)
+        assert_ae(history.bootstrap_misfits, bootstraps)
+
+        # copy-on-write, files are not modified
+        history.models[:] = 0.0
+        xs_, _, _ = load_problem_data(rundir, p, nchains=nchains)
+        assert_ae(xs_, xs)
+
+        t.assert_raises(
+            GrondError, history.extend, xs, misfits, bootstraps)
+
+        del history
+
+        # bootstraps file lagging behind, only complete models are loaded
+        with open(op.join(rundir, 'bootstraps'), 'r+b') as f:
+            f.truncate(20 * nchains * 8 + 4)
+
+        for memmap in (False, True):
+            xs_, misfits_, bootstraps_ = load_problem_data(
+                rundir, p, nchains=nchains, memmap=memmap)
+
+            assert_ae(xs_, xs[:20])
+            assert_ae(misfits_, misfits[:20])
+            assert_ae(bootstraps_, bootstraps[:20])
+
+        history = ModelHistory(
+            p, nchains=nchains, path=rundir, mode='r', memmap=True)
+        t.assert_equal(history.nmodels, 20)
+        history.update()
+        t.assert_equal(history.nmodels, 20)
+
+        del history
+
+    finally:
+        shutil.rmtree(rundir)
@@ -0,0 +1,378 @@
+from __future__ import print_function
+
+import numpy as num
+
+from numpy.testing import assert_equal, assert_allclose
+from scipy import stats
+from grond.optimisers.highscore.optimiser import \
+    excentricity_compensated_probabilities, truncated_normal, \
+    scrambled_halton, latin_hypercube, first_primes, \
+    DirectedSamplerPhase, UniformSamplerPhase
+
+from .common import make_toy_problem, make_chains, model_misfits
+
+
+def excentricity_compensated_probabilities_reference(xs, sbx, factor):
+    '''
+    Plain implementation with all pairwise distances, for comparison.
+    '''
+
+    inonflat = num.where(sbx != 0.0)[0]
+    scale = num.zeros_like(sbx)
+    scale[inonflat] = 1.0 / (sbx[inonflat] * (factor if factor != 0. else 1.0))
+    distances_sqr_all = num.sum(
+        ((xs[num.newaxis, :, :] - xs[:, num.newaxis, :]) *
+         scale[num.newaxis, num.newaxis, :])**2, axis=2)
+    probabilities = 1.0 / num.sum(distances_sqr_all < 1.0, axis=1)
+    probabilities /= num.sum(probabilities)
+    return probabilities
+
+
+def test_excentricity_compensated_probabilities():
+    rstate = num.random.RandomState(23)
+    for nmodels, npar in [(1, 3), (25, 3), (200, 5)]:
+        xs = rstate.normal(size=(nmodels, npar))
+        sbx = rstate.uniform(0.1, 1.0, size=npar)
+        for factor in (0., 0.5, 2.):
+            assert_allclose(
+                excentricity_compensated_probabilities(xs, sbx, factor),
+                excentricity_compensated_probabilities_reference(
+                    xs, sbx, factor),
+                rtol=1e-12)
+
+    # flat dimensions are ignored
+    xs = rstate.normal(size=(50, 4))
+    sbx = num.array([0.5, 0., 0.8, 0.])
+    assert_allclose(
+        excentricity_compensated_probabilities(xs, sbx, 2.),
+        excentricity_compensated_probabilities_reference(xs, sbx, 2.),
+        rtol=1e-12)
+
+    # neighbours at exactly unit distance are not counted
+    xs = num.array(
+        [(i, j) for i in range(5) for j in range(4)], dtype=num.float)
+    sbx = num.ones(2)
+    probabilities = excentricity_compensated_probabilities(xs, sbx, 1.)
+    assert_equal(
+        probabilities,
+        excentricity_compensated_probabilities_reference(xs, sbx, 1.))
+    assert_allclose(probabilities, 1.0 / xs.shape[0])
+
+    # all dimensions flat
+    xs = num.zeros((10, 3))
+    sbx = num.zeros(3)
+    assert_allclose(
+        excentricity_compensated_probabilities(xs, sbx, 2.),
+        excentricity_compensated_probabilities_reference(xs, sbx, 2.))
+
+
+def assert_stratified(u, nstrata):
+    '''
+    Check that each of *nstrata* equal intervals of [0, 1[ holds the same
+    number of points in each dimension. *nstrata* may also be given for each
+    dimension.
+    '''
+
+    nstrata = num.broadcast_to(nstrata, u.shape[1:])
+    assert num.all(0. <= u) and num.all(u < 1.)
+    for idim in range(u.shape[1]):
+        # points on the lower boundary of a stratum may be rounded down
+        istrata = num.floor(
+            u[:, idim] * nstrata[idim] + 1e-9).astype(num.int)
+
+        counts = num.bincount(istrata, minlength=nstrata[idim])
+        assert_equal(counts, u.shape[0] // nstrata[idim])
+
+
+def test_scrambled_halton():
+    # without scrambling, the van der Corput sequence in each dimension
+    identity = [num.arange(base) for base in (2, 3)]
+    assert_allclose(
+        scrambled_halton(num.arange(1, 5), identity),
+        [[1./2., 1./3.], [1./4., 2./3.], [3./4., 1./9.], [1./8., 4./9.]])
+
+    rstate = num.random.RandomState(23)
+    bases = first_primes(4)
+    assert bases == [2, 3, 5, 7]
+    permutations = [rstate.permutation(base) for base in bases]
+
+    # any base**k consecutive points fall into separate strata of size
+    # base**-k
+    for idim, base in enumerate(bases):
+        for k in (1, 2, 3):
+            for istart in (0, 1, 17):
+                u = scrambled_halton(
+                    num.arange(istart, istart + base**k),
+                    permutations[idim:idim+1])
+
+                assert_stratified(u, base**k)
+
+
+def test_latin_hypercube():
+    npoints, ndim = 50, 4
+    u = latin_hypercube(npoints, ndim, num.random.RandomState(23))
+    assert u.shape == (npoints, ndim)
+    assert_stratified(u, npoints)
+
+    assert_equal(
+        u, latin_hypercube(npoints, ndim, num.random.RandomState(23)))
+
+    assert not num.any(
+        u == latin_hypercube(npoints, ndim, num.random.RandomState(24)))
+
+
+def test_uniform_sequences():
+    problem = make_toy_problem()
+    xbounds = problem.get_parameter_bounds()
+    xranges = xbounds[:, 1] - xbounds[:, 0]
+
+    def samples(**kwargs):
+        phase = UniformSamplerPhase(niterations=30, **kwargs)
+        return num.array([
+            phase.get_sample(problem, iiter, None)
+            for iiter in range(phase.niterations)])
+
+    for sequence, nstrata in [('halton', [2, 3, 5]), ('latin_hypercube', 30)]:
+        xs = samples(sequence=sequence)
+        assert_stratified((xs - xbounds[:, 0]) / xranges, nstrata)
+
+        # samples depend only on the seed, not on the global random state
+        num.random.seed(123)
+        assert_equal(xs, samples(sequence=sequence))
+        assert not num.all(xs == samples(sequence=sequence, seed=24))
+
+
+def truncnorm_pvalue(xs, mean, std, xmin, xmax):
+    return stats.kstest(
+        xs, stats.truncnorm(
+            (xmin - mean) / std, (xmax - mean) / std,
+            loc=mean, scale=std).cdf).pvalue
+
+
+def test_truncated_normal_bounds():
+    num.random.seed(23)
+    rstate = num.random.RandomState(23)
+    n = 10000
+    mean = rstate.normal(scale=5., size=n)
+    std = rstate.uniform(0., 3., size=n)
+    xmin = rstate.uniform(-10., 0., size=n)
+    xmax = xmin + rstate.uniform(0., 10., size=n)
+
+    x, ok = truncated_normal(mean, std, xmin, xmax)
+    assert num.all(xmin[ok] <= x[ok]) and num.all(x[ok] <= xmax[ok])
+
+    # only intervals without numerically representable probability mass
+    # are refused
+    with num.errstate(divide='ignore'):
+        distance = num.minimum(
+            num.abs(xmin - mean), num.abs(xmax - mean)) / std
+
+    inside = num.logical_and(xmin <= mean, mean <= xmax)
+    assert num.all(ok[inside])
+    assert num.all(distance[~ok] > 35.)
+    assert num.sum(ok) > 0.9 * n
+
+    # zero width distributions
+    x, ok = truncated_normal([0., 2.], [0., 0.], [-1., -1.], [1., 1.])
+    assert_equal(x, [0., 2.])
+    assert_equal(ok, [True, False])
+
+    # no probability mass left within the bounds
+    x, ok = truncated_normal([0., 0.], [1., 1.], [50., -51.], [51., -50.])
+    assert_equal(ok, [False, False])
+
+
+def test_truncated_normal_distribution():
+    num.random.seed(23)
+    n = 5000
+    for (mean, std, xmin, xmax) in [
+            (0., 1., -1., 2.),
+            (0., 1., 5., 6.),         # upper tail, mirrored
+            (0., 1., -6., -5.),       # lower tail
+            (3., 0.5, 10., 10.5),     # deep in the upper tail
+            (3., 0.5, -4.5, -4.)]:    # deep in the lower tail
+
+        x, ok = truncated_normal(
+            num.full(n, mean), num.full(n, std),
+            num.full(n, xmin), num.full(n, xmax))
+
+        assert num.all(ok)
+        assert num.all(xmin <= x) and num.all(x <= xmax)
+        assert truncnorm_pvalue(x, mean, std, xmin, xmax) > 0.001
+
+        # the mass is concentrated at the bound closer to the mean
+        if xmin > mean:
+            assert num.median(x) - xmin < 0.5 * (xmax - xmin)
+        elif xmax < mean:
+            assert xmax - num.median(x) < 0.5 * (xmax - xmin)
+
+
+def test_multivariate_normal_sampling():
+    num.random.seed(23)
+    problem = make_toy_problem()
+    chains = make_chains(problem)
+    xbounds = problem.get_parameter_bounds()
+
+    phase = DirectedSamplerPhase(
+        niterations=1000,
+        sampler_distribution='multivariate_normal',
+        starting_point='mean')
+
+    ichain, _, _, cov_factor = phase.get_chains_state(chains)
+    assert_allclose(
+        num.dot(cov_factor.T, cov_factor),
+        chains.covariance_models(ichain), atol=1e-12)
+
+    xs = phase.get_samples(problem, 0, chains, 1000)
+    assert num.all(xbounds[:, 0] <= xs) and num.all(xs <= xbounds[:, 1])
+
+    # candidates scatter with the covariance of the chain
+    xs = num.array([
+        phase.get_raw_sample(problem, 0, chains) for i in range(2000)])
+    assert_allclose(
+        num.cov(xs.T), chains.covariance_models(ichain),
+        rtol=0.2, atol=0.2)
+
+
+def test_scatter_scale():
+    def phase(**kwargs):
+        return DirectedSamplerPhase(niterations=101, **kwargs)
+
+    p = phase(scatter_scale_begin=2., scatter_scale_end=0.5)
+    assert_allclose(
+        [p.get_scatter_scale_factor(iiter) for iiter in (0, 50, 100)],
+        [2., 1., 0.5])
+    assert p.get_scatter_scale_limits() == (2., 0.5, 2.)
+
+    # a missing end of the schedule defaults to its begin and vice versa
+    for p in [phase(scatter_scale_begin=2.), phase(scatter_scale_end=2.)]:
+        assert p.get_scatter_scale_factor(50) == 2.
+        assert p.get_scatter_scale_limits() == (2., 2., 2.)
+
+    p = phase(scatter_scale_begin=2., scatter_scale_end=2.)
+    assert p.get_scatter_scale_factor(50) == 2.
+
+    p = phase(scatter_scale=3.)
+    assert p.get_scatter_scale_factor(50) == 3.
+    assert p.get_scatter_scale_limits() == (3., 0.3, 30.)
+
+    p = phase()
+    assert p.get_scatter_scale_factor(50) == 1.
+    assert p.get_scatter_scale_limits() == (1., 0.1, 10.)
+
+
+def test_surrogate_accounting():
+    num.random.seed(23)
+    problem = make_toy_problem()
+    chains = make_chains(problem)
+    history = chains.history
+
+    def evaluate(xs):
+        history.extend(
+            xs,
+            num.zeros((len(xs), problem.nmisfits, 2)),
+            model_misfits(problem, xs, history.nchains))
+
+    # all candidates predicted to be accepted
+    phase = DirectedSamplerPhase(
+        niterations=1000, surrogate=True, surrogate_margin=1e9)
+
+    phase.update(problem, 0, chains)
+    thresholds = chains.acceptance_thresholds()
+    xs = phase.get_samples(problem, 0, chains, 50)
+    assert phase.predict_rejection(xs[0], thresholds) is False
+
+    evaluate(xs)
+    phase.update(problem, 50, chains)
+
+    naccepted = num.sum(num.any(
+        model_misfits(problem, xs, history.nchains) < thresholds, axis=1))
+
+    stats = phase._surrogate_stats
+    assert stats['naccept_predicted'] == 50
+    assert stats['naccept_predicted_ok'] == naccepted
+    assert stats['nreject_predicted'] == 0
+    assert stats['ndiscarded'] == 0
+    assert phase.get_report() == \
+        'surrogate discarded 0 candidates, hit rate %.2f, ' \
+        'false rejection rate n/a (0 audited)' % (naccepted / 50.)
+
+    # all candidates predicted to be rejected, none is audited
+    phase = DirectedSamplerPhase(
+        niterations=1000, surrogate=True, surrogate_margin=0.,
+        surrogate_audit_fraction=0.)
+
+    phase.update(problem, 0, chains)
+    phase.get_sample(problem, 0, chains)
+    stats = phase._surrogate_stats
+    assert stats['ndiscarded'] == phase.surrogate_ntries_limit
+    assert not phase._surrogate_pending
+
+
+def test_surrogate_audit():
+    num.random.seed(23)
+    problem = make_toy_problem()
+    chains = make_chains(problem)
+    history = chains.history
+
+    # candidates predicted to be rejected are all audited
+    phase = DirectedSamplerPhase(
+        niterations=1000, surrogate=True, surrogate_margin=0.,
+        surrogate_audit_fraction=1.)
+
+    phase.update(problem, 0, chains)
+    thresholds = chains.acceptance_thresholds()
+    xs = phase.get_samples(problem, 0, chains, 20)
+    assert len(phase._surrogate_pending) == 20
+    for x in xs:
+        reject_predicted, thresholds_pending = \
+            phase._surrogate_pending[problem.get_model_key(x)]
+
+        assert reject_predicted
+        assert_equal(thresholds_pending, thresholds)
+
+    gbmss = model_misfits(problem, xs, history.nchains)
+    history.extend(xs, num.zeros((20, problem.nmisfits, 2)), gbmss)
+    phase.update(problem, 20, chains)
+
+    nfalse = num.sum(num.any(gbmss < thresholds, axis=1))
+    stats = phase._surrogate_stats
+    assert stats['ndiscarded'] == 0
+    assert stats['nreject_predicted'] == 20
+    assert stats['nreject_predicted_false'] == nfalse
+    assert not phase._surrogate_pending
+    assert phase.get_report().endswith(
+        'false rejection rate %.2f (20 audited)' % (nfalse / 20.))
+
+
+def test_surrogate_window():
+    num.random.seed(23)
+    problem = make_toy_problem()
+    chains = make_chains(problem, nmodels=1000)
+    history = chains.history
+
+    phase = DirectedSamplerPhase(niterations=1000, surrogate=True)
+    phase.surrogate_nmodels_max = 300
+    phase.update(problem, 0, chains)
+    nmodels, imodel_begin, tree, _, _ = phase._surrogate_state
+    assert (nmodels, imodel_begin, tree.n) == (1000, 700, 300)
+
+    # refitted after growth by 10% of the window, at least 100 models
+    xs = num.array([phase.get_raw_sample(problem, 0, chains)
+                    for i in range(100)])
+
+    for i in range(2):
+        history.extend(
+            xs[i*50:(i+1)*50],
+            num.zeros((50, problem.nmisfits, 2)),
+            model_misfits(problem, xs[i*50:(i+1)*50], history.nchains))
+
+        phase.update(problem, (i+1)*50, chains)
+
+    nmodels, imodel_begin, tree, _, _ = phase._surrogate_state
+    assert (nmodels, imodel_begin, tree.n) == (1100, 800, 300)
+
+    # neighbours are looked up in the model history
+    x = xs[-1]
+    _, imodels = tree.query(x / phase._surrogate_state[4], k=1)
+    assert_equal(history.models[imodel_begin + imodels], x)
@@ -0,0 +1,212 @@
+from __future__ import print_function
+
+import logging
+import shutil
+import tempfile
+
+import numpy as num
+
+from numpy.testing import assert_allclose
+from pyrocko import gf
+from grond.meta import Parameter
+from grond.problems.base import Problem, load_problem_data
+from grond.targets.satellite import SatelliteMisfitTarget, \
+    SatelliteMisfitConfig
+from grond.optimisers.highscore.optimiser import HighScoreOptimiser, \
+    UniformSamplerPhase, DirectedSamplerPhase, LocalRefinementSamplerPhase
+
+nleaves = 60
+
+
+class Scene(object):
+    '''
+    Stand-in for a kite scene, observing a known pattern of amplitude 2 and
+    an orbital ramp.
+    '''
+
+    def __init__(self, ramp):
+        rstate = num.random.RandomState(23)
+
+        class Quadtree(object):
+            pass
+
+        self.pattern = rstate.uniform(-1., 1., nleaves)
+        self.ramp = ramp
+
+        qt = self.quadtree = Quadtree()
+        qt.nleaves = nleaves
+        qt.leaf_center_distance = rstate.uniform(0., 50e3, (nleaves, 2))
+        qt.leaf_medians = 2.0 * self.pattern \
+            + ramp['offset'] \
+            + ramp['ramp_east'] * qt.leaf_center_distance[:, 0] \
+            + ramp['ramp_north'] * qt.leaf_center_distance[:, 1]
+
+        class Covariance(object):
+            def getQuadtreeNoise(self, rstate):
+                return num.zeros(nleaves)
+
+        self.covariance = Covariance()
+
+
+class Dataset(object):
+    def __init__(self, scene):
+        self.scene = scene
+
+    def get_kite_scene(self, scene_id):
+        return self.scene
+
+
+class Engine(object):
+    '''
+    Stand-in for the GF engine, the synthetics are the scene's pattern
+    scaled by the source's north shift.
+    '''
+
+    def __init__(self, scene):
+        self.scene = scene
+
+    def process(self, sources, targets):
+        if not isinstance(sources, list):
+            sources = [sources]
+
+        class Response(object):
+            pass
+
+        resp = Response()
+        resp.results_list = [
+            [target.post_process(self, source, {
+                'displacement.los': source.north_shift * self.scene.pattern})
+             for target in targets]
+            for source in sources]
+
+        return resp
+
+
+class AmplitudeProblem(Problem):
+    problem_parameters = [Parameter('amplitude', 'm')]
+
+    def get_source(self, x):
+        return gf.ExplosionSource(north_shift=float(x[0]))
+
+
+def make_problem(ramp):
+    scene = Scene(ramp)
+    target = SatelliteMisfitTarget(
+        path='insar',
+        scene_id='scene',
+        lats=num.zeros(nleaves),
+        lons=num.zeros(nleaves),
+        east_shifts=num.zeros(nleaves),
+        north_shifts=num.zeros(nleaves),
+        theta=num.zeros(nleaves),
+        phi=num.zeros(nleaves),
+        misfit_config=SatelliteMisfitConfig(
+            orbital_ramp_mode='least_squares',
+            ranges={
+                'offset': gf.Range(start=-0.5, stop=0.5),
+                'ramp_east': gf.Range(start=-1e-5, stop=1e-5),
+                'ramp_north': gf.Range(start=-1e-5, stop=1e-5)}))
+
+    target.set_dataset(Dataset(scene))
+
+    problem = AmplitudeProblem(
+        name='amplitude_problem',
+        ranges={'amplitude': gf.Range(start=0., stop=5.)},
+        targets=[target])
+
+    problem._engine = Engine(scene)
+    return problem
+
+
+def test_orbital_ramp_least_squares():
+    ramp = dict(offset=0.2, ramp_north=3e-6, ramp_east=-2e-6)
+    problem = make_problem(ramp)
+    xbounds = problem.get_parameter_bounds()
+    solved = problem.get_solved_parameter_mask()
+    assert_allclose(solved, [False, True, True, True])
+
+    xs_proposed = []
+    preconstrain = problem.preconstrain
+
+    def preconstrain_recording(x):
+        xs_proposed.append(x.copy())
+        return preconstrain(x)
+
+    problem.preconstrain = preconstrain_recording
+
+    warnings = []
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            warnings.append(record)
+
+    handler = Handler(level=logging.WARNING)
+    logger = logging.getLogger('grond')
+    logger.addHandler(handler)
+
+    num.random.seed(23)
+    optimiser = HighScoreOptimiser(
+        sampler_phases=[
+            UniformSamplerPhase(niterations=50),
+            DirectedSamplerPhase(niterations=150),
+            LocalRefinementSamplerPhase(niterations=50)],
+        chain_length_factor=4.,
+        nbootstrap=5)
+
+    rundir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        optimiser.optimise(problem, rundir=rundir)
+        xs, misfits, _ = load_problem_data(
+            rundir, problem, nchains=optimiser.nchains)
+    finally:
+        logger.removeHandler(handler)
+        shutil.rmtree(rundir)
+
+    # solved parameters are proposed at the centre of their ranges
+    xs_proposed = num.array(xs_proposed)
+    assert xs_proposed.shape[0] >= xs.shape[0]
+    assert_allclose(
+        xs_proposed[:, solved],
+        num.tile(num.mean(xbounds[solved], axis=1), (len(xs_proposed), 1)))
+
+    assert not warnings
+    assert num.all(xbounds[:, 0] <= xs) and num.all(xs <= xbounds[:, 1])
+
+    # the best model recovers amplitude and ramp
+    ibest = num.argmin(problem.combine_misfits(misfits))
+    assert_allclose(xs[ibest, 0], 2.0, atol=0.05)
+    assert_allclose(
+        xs[ibest, 1:],
+        [ramp['offset'], ramp['ramp_north'], ramp['ramp_east']],
+        rtol=0.1, atol=0.01)
+
+    # for the true amplitude, the ramp is exact
+    x = num.array([2.0, 0., 0., 0.])
+    problem.misfits(x)
+    assert_allclose(
+        x, [2.0, ramp['offset'], ramp['ramp_north'], ramp['ramp_east']],
+        rtol=1e-6)
+
+
+def test_orbital_ramp_least_squares_bounds():
+    # offset outside of its range, the solution is constrained to it
+    ramp = dict(offset=0.8, ramp_north=3e-6, ramp_east=-2e-6)
+    problem = make_problem(ramp)
+    xbounds = problem.get_parameter_bounds()
+
+    for amplitude in [0., 2., 5.]:
+        x = num.array([amplitude, 0., 0., 0.])
+        problem.misfits(x)
+        assert num.all(xbounds[:, 0] <= x) and num.all(x <= xbounds[:, 1])
+
+    # gradients are the least squares solution for the offset at its bound
+    scene = problem.targets[0].scene
+    qt = scene.quadtree
+    gradients, _, _, _ = num.linalg.lstsq(
+        qt.leaf_center_distance[:, ::-1],
+        qt.leaf_medians - 2.0 * scene.pattern - 0.5,
+        rcond=None)
+
+    x = num.array([2.0, 0., 0., 0.])
+    problem.misfits(x)
+    assert_allclose(x, [2.0, 0.5, gradients[0], gradients[1]], rtol=1e-4)
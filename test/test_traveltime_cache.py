@@ -0,0 +1,102 @@
+from __future__ import print_function
+
+import numpy as num
+
+from pyrocko import gf
+from grond.targets.base import TravelTimeCache
+
+
+class HomogeneousStore(object):
+    '''
+    Stand-in for a GF store, travel times for a homogeneous medium.
+    '''
+
+    def __init__(self, velocity=5000.):
+        self.velocity = velocity
+        self.config = gf.ConfigTypeA(
+            id='homogeneous',
+            sample_rate=1.0,
+            source_depth_min=0.,
+            source_depth_max=20e3,
+            source_depth_delta=1e3,
+            distance_min=0.,
+            distance_max=100e3,
+            distance_delta=1e3)
+
+        self.args = []
+
+    def t(self, timing, *args):
+        if len(args) == 2:
+            args = self.config.make_indexing_args1(*args)
+        else:
+            args, = args
+
+        self.args.append(args)
+        depth, distance = args
+        return num.sqrt(depth**2 + distance**2) / self.velocity
+
+
+def make_geometries(n):
+    rstate = num.random.RandomState(23)
+    return [
+        (gf.DCSource(depth=float(depth)),
+         gf.Target(north_shift=float(north), east_shift=float(east)))
+        for (depth, north, east) in zip(
+            rstate.uniform(1e3, 20e3, n),
+            rstate.uniform(-50e3, 50e3, n),
+            rstate.uniform(-50e3, 50e3, n))]
+
+
+def test_traveltime_cache_tolerance():
+    store = HomogeneousStore()
+    cache = TravelTimeCache()
+    tolerance = 500.
+
+    for source, target in make_geometries(200) * 2:
+        t_exact = cache.t(store, 'P', source, target)
+        args_exact = store.args[-1]
+        t = cache.t(store, 'P', source, target, tolerance)
+
+        # looked up geometry is within half the tolerance in each argument
+        assert num.all(
+            num.abs(num.array(store.args[-1]) - args_exact)
+            <= 0.5 * tolerance + 1e-6)
+
+        # so that the travel time error is bounded by the tolerance
+        assert abs(t - t_exact) <= tolerance / store.velocity
+
+    assert cache.nlookups == 400
+    assert cache.nhits >= 200
+    assert cache.nmisses == cache.nentries
+
+    nhits, nmisses = cache.nhits, cache.nmisses
+    cache.t(store, 'P', source, target, tolerance)
+    assert cache.take_statistics(nhits, nmisses) == (1, 0)
+    assert (cache.nhits, cache.nmisses) == (nhits, nmisses)
+
+    cache.add_statistics(1, 0)
+    assert cache.nhits == nhits + 1
+
+
+def test_traveltime_cache_lru():
+    store = HomogeneousStore()
+    cache = TravelTimeCache()
+    cache.nentries_max = 10
+    geometries = make_geometries(11)
+
+    for source, target in geometries[:10]:
+        cache.t(store, 'P', source, target, 1.)
+
+    # keep the first entry in use, the second is dropped instead
+    cache.t(store, 'P', geometries[0][0], geometries[0][1], 1.)
+    cache.t(store, 'P', geometries[10][0], geometries[10][1], 1.)
+    assert cache.nentries == 10
+    assert (cache.nhits, cache.nmisses) == (1, 11)
+
+    cache.t(store, 'P', geometries[0][0], geometries[0][1], 1.)
+    assert cache.nhits == 2
+    cache.t(store, 'P', geometries[1][0], geometries[1][1], 1.)
+    assert cache.nmisses == 12
+
+    cache.clear()
+    assert cache.nentries == 0 and cache.nlookups == 0